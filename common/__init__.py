@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+# 各任务共用的数据 / 训练工具
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/11 9:20
+# @Author  : tk
+# @FileName: collate.py
+import typing
+
+import numpy as np
+import torch
+
+__all__ = [
+    'collate_with_seqlen',
+    'encode_points',
+    'points_target_len',
+    'pad_points',
+]
+
+# 默认按 seqlen 截断的键, 值为样本内需要截断的维度
+DEFAULT_SEQ_KEYS = {
+    'input_ids': (0,),
+    'attention_mask': (0,),
+    'token_type_ids': (0,),
+}
+
+
+def _torch_dtype(dtype: np.dtype):
+    return torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+
+
+def collate_with_seqlen(batch: typing.List[typing.Dict],
+                        seq_keys: typing.Union[typing.Dict[str, tuple], typing.Iterable[str]] = None,
+                        pad_values: typing.Dict[str, typing.Union[int, float]] = None,
+                        pin_memory: bool = False,
+                        pop_seqlen: bool = True,
+                        with_attention_mask: bool = False):
+    '''
+        样本可以是补齐到 max_seq_length 的定长记录, 也可以是按真实长度存储的变长记录.
+        先读取 seqlen 得到 batch 内最大长度 max_len, 为每个键预分配 [bs, ...max_len...] 张量,
+        每个样本只拷贝有效部分, 不再对整条 max_seq_length 做 torch.tensor + stack 再截断.
+        seq_keys: 需要按 max_len 截断的键, dict 时值为样本内需要截断的维度, 默认维度 (0,);
+                  input_ids / attention_mask / token_type_ids 总是包含在内
+        pad_values: 各键的填充值, 默认 0 (样本不足 max_len 时使用)
+        pin_memory: 预分配锁页内存, 加速 H2D 拷贝
+        with_attention_mask: 样本未存储 attention_mask 时 (变长记录), 由 seqlen 生成
+    '''
+    axes_map = dict(DEFAULT_SEQ_KEYS)
+    if seq_keys is not None:
+        if isinstance(seq_keys, dict):
+            axes_map.update(seq_keys)
+        else:
+            axes_map.update({k: (0,) for k in seq_keys})
+    pad_values = pad_values or {}
+    pin_memory = pin_memory and torch.cuda.is_available()
+
+    bs = len(batch)
+    seqlens = np.asarray([b['seqlen'] for b in batch], dtype=np.int64).reshape(-1)
+    max_len = int(seqlens.max())
+
+    o = {}
+    for k in batch[0]:
+        if k == 'seqlen':
+            continue
+        values = [np.asarray(b[k]) for b in batch]
+        if k not in axes_map:
+            o[k] = torch.from_numpy(np.stack(values))
+            if pin_memory:
+                o[k] = o[k].pin_memory()
+            continue
+
+        axes = axes_map[k]
+        shape = list(values[0].shape)
+        for axis in axes:
+            shape[axis] = max_len
+        out = torch.full([bs] + shape, pad_values.get(k, 0), dtype=_torch_dtype(values[0].dtype),
+                         pin_memory=pin_memory)
+        for i, v in enumerate(values):
+            region = [slice(None)] * v.ndim
+            for axis in axes:
+                region[axis] = slice(0, min(v.shape[axis], max_len))
+            region = tuple(region)
+            out[i][region] = torch.from_numpy(np.ascontiguousarray(v[region]))
+        o[k] = out
+
+    if with_attention_mask and 'attention_mask' not in o:
+        attention_mask = torch.arange(max_len).unsqueeze(0) < torch.from_numpy(seqlens).unsqueeze(1)
+        o['attention_mask'] = attention_mask.long().pin_memory() if pin_memory else attention_mask.long()
+
+    if not pop_seqlen:
+        o['seqlen'] = torch.from_numpy(seqlens)
+    return o
+
+
+def encode_points(pts_list: typing.Sequence[typing.Iterable[tuple]]) -> np.ndarray:
+    '''
+        每个类别的点集合 [{(x, y), ...}, ...] 编码为 [n, 3] (class, x, y), 只存储真实的点
+    '''
+    pts = sorted((c, x, y) for c, pts in enumerate(pts_list) for x, y in pts)
+    return np.asarray(pts, dtype=np.int32).reshape(-1, 3)
+
+
+def points_target_len(batch_points: typing.Sequence[np.ndarray], num_classes: int, min_len: int = 1) -> int:
+    # batch 内单个样本单个类别的最多点数
+    target_len = min_len
+    for pts in batch_points:
+        pts = np.asarray(pts).reshape(-1, 3)
+        if len(pts):
+            target_len = max(target_len, int(np.bincount(pts[:, 0], minlength=num_classes).max()))
+    return target_len
+
+
+def pad_points(batch_points: typing.Sequence[np.ndarray], num_classes: int, target_len: int = None) -> torch.Tensor:
+    '''
+        encode_points 的结果按 batch 还原为 [bs, num_classes, target_len, 2], 不足补 0
+        target_len: 默认为 batch 内最大点数, 多个标签需要共用长度时由 points_target_len 计算后传入
+    '''
+    if target_len is None:
+        target_len = points_target_len(batch_points, num_classes)
+    bs = len(batch_points)
+    batch_points = [np.asarray(pts, dtype=np.int64).reshape(-1, 3) for pts in batch_points]
+    bids = np.concatenate([np.full(len(pts), i, dtype=np.int64) for i, pts in enumerate(batch_points)])
+    pts = np.concatenate(batch_points)
+    # 每个点在 (样本, 类别) 内的序号
+    order = np.lexsort((pts[:, 0], bids))
+    bids, pts = bids[order], pts[order]
+    group = bids * num_classes + pts[:, 0]
+    first = np.searchsorted(group, group, side='left')
+    seq = np.arange(len(group)) - first
+    out = np.zeros((bs, num_classes, target_len, 2), dtype=np.int32)
+    out[bids, pts[:, 0], seq] = pts[:, 1:]
+    return torch.from_numpy(out)
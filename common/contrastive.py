@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/19 15:20
+# @Author  : tk
+# @FileName: contrastive.py
+import typing
+
+import torch
+import torch.distributed as dist
+from torch.nn import functional as F
+
+__all__ = [
+    'get_world_size',
+    'all_gather_with_grad',
+    'info_nce_with_gathered_negatives',
+]
+
+
+def _is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_world_size():
+    return dist.get_world_size() if _is_distributed() else 1
+
+
+def all_gather_with_grad(x: torch.Tensor) -> torch.Tensor:
+    '''
+        各进程的 [n_r, ...] 按 rank 顺序拼接, 本进程的分片保留梯度, 其余分片不带梯度, n_r 可以不同; 单进程原样返回.
+        各进程在拼接结果上计算相同的全局 loss, 每个进程只把梯度传回本分片, DDP 再对梯度取平均,
+        因此全局 loss 乘以 world_size 后与单卡使用全部样本的梯度一致
+    '''
+    if not _is_distributed():
+        return x
+    world_size, rank = dist.get_world_size(), dist.get_rank()
+    size = torch.tensor([x.size(0)], dtype=torch.long, device=x.device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    dist.all_gather(sizes, size)
+    sizes = [int(s.item()) for s in sizes]
+
+    padded = x.new_zeros((max(sizes),) + tuple(x.shape[1:]))
+    padded[:x.size(0)] = x.detach()
+    gathered = [torch.empty_like(padded) for _ in range(world_size)]
+    dist.all_gather(gathered, padded)
+    gathered = [g[:n] for g, n in zip(gathered, sizes)]
+    gathered[rank] = x
+    return torch.cat(gathered, dim=0)
+
+
+def info_nce_with_gathered_negatives(query: torch.Tensor,
+                                     pos_key: torch.Tensor,
+                                     neg_key: torch.Tensor,
+                                     query_labels: typing.Optional[torch.Tensor] = None,
+                                     neg_labels: typing.Optional[torch.Tensor] = None,
+                                     temperature: float = 0.1,
+                                     reduction: str = 'sum'):
+    '''
+        跨进程共享负样本的 InfoNCE: query / pos_key [bs, D], neg_key [bs, n_neg, D] 汇总所有进程后,
+        每个 query 与自己的正样本以及所有进程的全部负样本对比; 标签给出时屏蔽与 query 同类的负样本
+        (其他组的负样本可能是本组的类别). 返回全局 loss * world_size, 见 all_gather_with_grad
+    '''
+    dim = query.size(-1)
+    query = all_gather_with_grad(F.normalize(query, dim=-1))
+    pos_key = all_gather_with_grad(F.normalize(pos_key, dim=-1))
+    neg_key = all_gather_with_grad(F.normalize(neg_key, dim=-1).reshape(-1, dim))
+
+    pos_logits = torch.sum(query * pos_key, dim=-1, keepdim=True)
+    neg_logits = query @ neg_key.t()
+    if query_labels is not None and neg_labels is not None:
+        query_labels = all_gather_with_grad(query_labels.reshape(-1))
+        neg_labels = all_gather_with_grad(neg_labels.reshape(-1))
+        neg_logits = neg_logits.masked_fill(query_labels.unsqueeze(1) == neg_labels.unsqueeze(0), float('-inf'))
+    logits = torch.cat([pos_logits, neg_logits], dim=1) / temperature
+    labels = torch.zeros(len(logits), dtype=torch.long, device=logits.device)
+    return F.cross_entropy(logits, labels, reduction=reduction) * get_world_size()
@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/10 10:12
+# @Author  : tk
+# @FileName: corpus.py
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import random
+import typing
+
+import numpy as np
+
+from fastdatasets.utils.numpyadapter import NumpyWriterAdapter
+
+try:
+    import orjson as _json_backend
+except ImportError:
+    try:
+        import ujson as _json_backend
+    except ImportError:
+        import json as _json_backend
+
+__all__ = [
+    'json_loads',
+    'iter_lines',
+    'iter_jsonl',
+    'make_dataset_with_stream',
+    'make_dataset_with_shards',
+    'load_shard_index',
+]
+
+
+def json_loads(line: typing.Union[bytes, str]):
+    # orjson / ujson / json 均可直接解析 bytes
+    return _json_backend.loads(line)
+
+
+def iter_lines(files: typing.Union[typing.List[str], str], chunk_size: int = 1 << 22):
+    '''
+        按块读取文件, 逐行返回 bytes (不含换行符, 跳过空行)
+        chunk_size: 每次读取字节数, 内存占用与文件大小无关
+    '''
+    if isinstance(files, str):
+        files = [files]
+    for filename in files:
+        with open(filename, mode='rb') as f:
+            remain = b''
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                lines = (remain + chunk).split(b'\n')
+                remain = lines.pop()
+                for line in lines:
+                    line = line.rstrip(b'\r')
+                    if line:
+                        yield line
+            remain = remain.rstrip(b'\r')
+            if remain:
+                yield remain
+
+
+def iter_jsonl(files: typing.Union[typing.List[str], str], chunk_size: int = 1 << 22):
+    '''
+        流式读取 jsonl 文件, 逐行返回解析后的对象, 跳过空对象
+    '''
+    for line in iter_lines(files, chunk_size=chunk_size):
+        jd = json_loads(line)
+        if not jd:
+            continue
+        yield jd
+
+
+def _shuffle_iter(data: typing.Iterable, buffer_size: int):
+    # 有界缓冲区随机打乱
+    buffer = []
+    for x in data:
+        if len(buffer) < buffer_size:
+            buffer.append(x)
+            continue
+        idx = random.randint(0, buffer_size - 1)
+        yield buffer[idx]
+        buffer[idx] = x
+    random.shuffle(buffer)
+    yield from buffer
+
+
+def _write_corpus(data_helper, data: typing.Iterable, fn_args, outfile, backend: str,
+                  shuffle_buffer_size: int, write_batch_size: int):
+    if shuffle_buffer_size > 1:
+        data = _shuffle_iter(data, shuffle_buffer_size)
+    data_helper.on_data_ready()
+    writer = _StreamWriter(outfile, backend, write_batch_size)
+    for x in data:
+        writer.write(data_helper.on_data_process(x, fn_args))
+    writer.close()
+    return writer.total_num
+
+
+class _StreamWriter:
+    def __init__(self, outfile: typing.Union[str, list], backend: str, write_batch_size: int):
+        self.numpy_writer = NumpyWriterAdapter(outfile, backend)
+        self.write_batch_size = write_batch_size
+        self.batch_keys = []
+        self.batch_values = []
+        self.total_num = 0
+
+    def write(self, x):
+        if x is None:
+            return
+        # 返回多个结果
+        for one in (x if isinstance(x, (list, tuple)) else [x]):
+            self.batch_keys.append('input{}'.format(self.total_num))
+            self.batch_values.append(one)
+            self.total_num += 1
+        if len(self.batch_values) >= self.write_batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.batch_values:
+            return
+        if self.numpy_writer.is_kv_writer:
+            self.numpy_writer.writer.put_batch(self.batch_keys, self.batch_values)
+        else:
+            self.numpy_writer.writer.write_batch(self.batch_values)
+        self.batch_keys.clear()
+        self.batch_values.clear()
+
+    def close(self):
+        self.flush()
+        if self.numpy_writer.is_kv_writer:
+            self.numpy_writer.writer.file_writer.put('total_num', str(self.total_num))
+        self.numpy_writer.close()
+
+
+def make_dataset_with_stream(data_helper,
+                             input_files: typing.Union[typing.List[str], str],
+                             fn_args: tuple,
+                             data_args,
+                             intermediate_name: str,
+                             shuffle: bool = False,
+                             mode: str = 'train',
+                             shuffle_buffer_size: int = 100000,
+                             write_batch_size: int = 2000,
+                             overwrite: bool = False):
+    '''
+        与 make_dataset_with_args 参数一致, 区别在于 on_get_corpus 可以返回生成器,
+        语料边读取边转换边写入, 常量内存完成大语料转换.
+        shuffle: 使用 shuffle_buffer_size 大小的缓冲区打乱, 完全打乱交给 load_dataset(shuffle=True)
+        返回值: 记录文件名 (内存后端返回 list)
+    '''
+    if not input_files:
+        return None
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    # 语料已经制作好，不需要在转换
+    if not getattr(data_args, 'convert_file', True):
+        return input_files[0] if len(input_files) == 1 else input_files
+
+    backend = data_args.data_backend
+    if backend.startswith('memory'):
+        outfile = []
+    else:
+        outfile = os.path.join(data_args.output_dir, intermediate_name + '-' + mode + '.' + backend)
+        if os.path.exists(outfile) and not overwrite:
+            logging.info('{} exists, skip convert'.format(outfile))
+            return outfile
+        if not os.path.exists(data_args.output_dir):
+            os.makedirs(data_args.output_dir)
+    logging.info('make data {} {}...'.format(mode, outfile if isinstance(outfile, str) else backend))
+
+    data = data_helper.on_get_corpus(input_files, mode)
+    total_num = _write_corpus(data_helper, data, fn_args, outfile, backend,
+                              shuffle_buffer_size if shuffle else 0, write_batch_size)
+    if hasattr(data_helper, 'on_data_finalize'):
+        data_helper.on_data_finalize()
+    logging.info('make data {} total {}'.format(mode, total_num))
+    return outfile
+
+
+def _reseed(seed: int, fn_args):
+    random.seed(seed)
+    np.random.seed(seed % (1 << 32))
+    # 任务参数里的随机数生成器 (例如 mlm 的 rng) 也按分片重新设置种子
+    for arg in (fn_args if isinstance(fn_args, (tuple, list)) else ()):
+        if isinstance(arg, random.Random):
+            arg.seed(seed)
+
+
+def _convert_shard(data_helper, data, fn_args, outfile, backend, shard_id, seed,
+                   shuffle, shuffle_buffer_size, write_batch_size):
+    _reseed(seed + shard_id, fn_args)
+    return _write_corpus(data_helper, data, fn_args, outfile, backend,
+                         shuffle_buffer_size if shuffle else 0, write_batch_size)
+
+
+_shard_context = None
+
+
+def _iter_queue(q):
+    while True:
+        items = q.get()
+        if items is None:
+            break
+        yield from items
+
+
+def _convert_shard_worker(shard_id, q, result_queue):
+    data_helper, fn_args, shard_kwargs = _shard_context
+    num = _convert_shard(data_helper, _iter_queue(q), fn_args, shard_id=shard_id, **shard_kwargs[shard_id])
+    result_queue.put((shard_id, num))
+
+
+def _put_alive(q, obj, proc):
+    # 分片进程异常退出时不再阻塞
+    while True:
+        try:
+            q.put(obj, timeout=1)
+            return
+        except queue.Full:
+            if not proc.is_alive():
+                raise RuntimeError('shard worker exited with code {}'.format(proc.exitcode))
+
+
+def _feed_shards(data: typing.Iterable, queues: list, procs: list, read_batch_size: int):
+    # 语料只读取解析一次, 按序号轮流分配给各分片 (第 i 条属于分片 i % num_shards)
+    batches = [[] for _ in queues]
+    for i, x in enumerate(data):
+        k = i % len(queues)
+        batches[k].append(x)
+        if len(batches[k]) >= read_batch_size:
+            _put_alive(queues[k], batches[k], procs[k])
+            batches[k] = []
+    for k, q in enumerate(queues):
+        if batches[k]:
+            _put_alive(q, batches[k], procs[k])
+        _put_alive(q, None, procs[k])
+
+
+def load_shard_index(index_file: str):
+    '''
+        读取分片索引, 返回分片文件列表, 可直接传给 load_dataset
+    '''
+    with open(index_file, mode='r', encoding='utf-8') as f:
+        index = json.load(f)
+    base_dir = os.path.dirname(index_file)
+    return [os.path.join(base_dir, shard['file']) for shard in index['shards']]
+
+
+def make_dataset_with_shards(data_helper,
+                             input_files: typing.Union[typing.List[str], str],
+                             fn_args: tuple,
+                             data_args,
+                             intermediate_name: str,
+                             shuffle: bool = False,
+                             mode: str = 'train',
+                             num_process_worker: int = 8,
+                             shuffle_buffer_size: int = 100000,
+                             write_batch_size: int = 2000,
+                             overwrite: bool = False,
+                             read_batch_size: int = 1000,
+                             queue_size: int = 8):
+    '''
+        多进程分片转换: 主进程调用 on_get_corpus 读取解析一次语料, 按条轮流分配, 每 read_batch_size 条经队列
+        (每个分片最多缓存 queue_size 批) 发给分片进程, 每个进程处理语料的 1/num_process_worker 并写入自己的分片,
+        最后写入分片索引 {intermediate_name}-{mode}.shards.json
+        返回值: 分片文件列表, load_dataset 视为一个数据集
+        注意: 在 on_data_process 中收集的状态 (例如 eval_labels) 不会回传主进程, 评估集请用 make_dataset_with_stream
+    '''
+    if not input_files:
+        return []
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    if not getattr(data_args, 'convert_file', True):
+        return input_files
+
+    backend = data_args.data_backend
+    if backend.startswith('memory') or num_process_worker <= 1 \
+            or 'fork' not in multiprocessing.get_all_start_methods():
+        outfile = make_dataset_with_stream(data_helper, input_files, fn_args, data_args, intermediate_name,
+                                           shuffle=shuffle, mode=mode, shuffle_buffer_size=shuffle_buffer_size,
+                                           write_batch_size=write_batch_size, overwrite=overwrite)
+        return [outfile]
+
+    if not os.path.exists(data_args.output_dir):
+        os.makedirs(data_args.output_dir)
+    index_file = os.path.join(data_args.output_dir, intermediate_name + '-' + mode + '.shards.json')
+    if os.path.exists(index_file) and not overwrite:
+        logging.info('{} exists, skip convert'.format(index_file))
+        return load_shard_index(index_file)
+
+    shard_files = [intermediate_name + '-' + mode + '-{:05d}-of-{:05d}.'.format(i, num_process_worker) + backend
+                   for i in range(num_process_worker)]
+    logging.info('make data {} with {} shards...'.format(mode, num_process_worker))
+
+    global _shard_context
+    seed = random.getrandbits(31)
+    shard_kwargs = [dict(outfile=os.path.join(data_args.output_dir, shard_files[i]),
+                         backend=backend, seed=seed, shuffle=shuffle,
+                         shuffle_buffer_size=shuffle_buffer_size, write_batch_size=write_batch_size)
+                    for i in range(num_process_worker)]
+    # fork 方式共享 data_helper / tokenizer, 无需序列化; 主进程读取语料, 分片进程只做转换与写入
+    counts = [0] * num_process_worker
+    ctx = multiprocessing.get_context('fork')
+    queues = [ctx.Queue(queue_size) for _ in range(num_process_worker)]
+    result_queue = ctx.Queue()
+    _shard_context = (data_helper, fn_args, shard_kwargs)
+    procs = [ctx.Process(target=_convert_shard_worker, args=(i, queues[i], result_queue), daemon=True)
+             for i in range(num_process_worker)]
+    try:
+        for proc in procs:
+            proc.start()
+        _feed_shards(data_helper.on_get_corpus(input_files, mode), queues, procs, read_batch_size)
+        for _ in range(num_process_worker):
+            while True:
+                try:
+                    shard_id, num = result_queue.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not any(proc.is_alive() for proc in procs):
+                        raise RuntimeError('shard workers exited with codes {}'.format([p.exitcode for p in procs]))
+            counts[shard_id] = num
+        for proc in procs:
+            proc.join()
+    finally:
+        _shard_context = None
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+
+    index = {
+        'backend': backend,
+        'total': sum(counts),
+        'shards': [{'file': f, 'num': n} for f, n in zip(shard_files, counts)],
+    }
+    with open(index_file, mode='w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    logging.info('make data {} total {} in {} shards'.format(mode, index['total'], num_process_worker))
+    return load_shard_index(index_file)
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/21 10:20
+# @Author  : tk
+# @FileName: distill_cache.py
+import typing
+
+import numpy as np
+import torch
+from fastdatasets.record import load_dataset as Loader, RECORD, NumpyWriter
+from tqdm import tqdm
+
+from .collate import collate_with_seqlen
+
+__all__ = [
+    'encode_teacher_topk',
+    'decode_teacher_topk',
+    'write_teacher_topk_records',
+    'load_teacher_topk_dataset',
+    'collate_with_teacher_topk',
+    'topk_kl_loss',
+]
+
+TOPK_IDS_KEY = 'teacher_topk_ids'
+TOPK_VALUES_KEY = 'teacher_topk_values'
+
+
+def encode_teacher_topk(ids: np.ndarray, values: np.ndarray):
+    '''
+        [seqlen, k] 的教师 top-k 序号与 logits 编码为记录字段:
+        序号为 int32, logits 为 fp16 (NumpyWriter 不支持 fp16, 以字节存储)
+    '''
+    return {
+        TOPK_IDS_KEY: np.asarray(ids, dtype=np.int32),
+        TOPK_VALUES_KEY: np.asarray(np.asarray(values, dtype=np.float16).tobytes()),
+    }
+
+
+def decode_teacher_topk(record: typing.Dict):
+    ids = np.asarray(record[TOPK_IDS_KEY], dtype=np.int32)
+    values = np.frombuffer(np.asarray(record[TOPK_VALUES_KEY]).tobytes(), dtype=np.float16)
+    return ids, values.reshape(ids.shape)
+
+
+@torch.no_grad()
+def write_teacher_topk_records(teacher_fn: typing.Callable[[typing.Dict[str, torch.Tensor]], torch.Tensor],
+                               dataset,
+                               output_file: str,
+                               collate_fn: typing.Callable,
+                               topk: int = 32,
+                               batch_size: int = 32,
+                               device=None,
+                               compression_type=RECORD.TFRecordCompressionType.NONE):
+    '''
+        教师离线推理: 按顺序读取 dataset (随机访问) 的样本, teacher_fn(batch) -> logits [bs, L, V],
+        每条样本写出原字段 + 有效长度内每个位置的 top-k 序号与 logits, 与训练样本一一对应;
+        学生训练直接读取该文件, 不再逐步运行教师, 教师推理也可以在其他机器完成.
+        默认不压缩: 学生训练 shuffle 随机读取, GZIP 每次随机读取都从文件头解压
+    '''
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    writer = NumpyWriter(output_file, options=options)
+    for start in tqdm(range(0, len(dataset), batch_size), desc='teacher topk'):
+        records = [dataset[i] for i in range(start, min(start + batch_size, len(dataset)))]
+        batch = {k: v.to(device) if device is not None else v for k, v in collate_fn(records).items()}
+        values, ids = torch.topk(teacher_fn(batch).float(), topk, dim=-1)
+        values, ids = values.cpu().numpy(), ids.cpu().numpy()
+        for i, record in enumerate(records):
+            seqlen = int(np.reshape(record['seqlen'], -1)[0])
+            d = {k: np.asarray(v) for k, v in record.items()}
+            d.update(encode_teacher_topk(ids[i, :seqlen], values[i, :seqlen]))
+            writer.write(d)
+    writer.close()
+
+
+def load_teacher_topk_dataset(filename: str, compression_type=RECORD.TFRecordCompressionType.NONE):
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    return Loader.RandomDataset(filename, options=options).parse_from_numpy_writer()
+
+
+def collate_with_teacher_topk(batch: typing.List[typing.Dict], seq_keys: typing.Iterable[str] = ('labels',)):
+    '''
+        教师 top-k 还原为 teacher_topk_ids / teacher_topk_values [bs, max_len, k] (fp32) 与有效位置 teacher_mask [bs, max_len],
+        其余字段同 collate_with_seqlen
+    '''
+    records = []
+    for record in batch:
+        record = dict(record)
+        ids, values = decode_teacher_topk(record)
+        record[TOPK_IDS_KEY], record[TOPK_VALUES_KEY] = ids, values.astype(np.float32)
+        records.append(record)
+    o = collate_with_seqlen(records, seq_keys=tuple(seq_keys) + (TOPK_IDS_KEY, TOPK_VALUES_KEY), pop_seqlen=False)
+    seqlen = o.pop('seqlen')
+    o['teacher_mask'] = torch.arange(o[TOPK_IDS_KEY].size(1)).unsqueeze(0) < seqlen.unsqueeze(1)
+    return o
+
+
+def topk_kl_loss(student_logits: torch.Tensor,
+                 topk_ids: torch.Tensor,
+                 topk_values: torch.Tensor,
+                 mask: typing.Optional[torch.Tensor] = None,
+                 temperature: float = 1.0,
+                 reduction: str = 'sum'):
+    '''
+        教师 top-k 支撑集上的 KL(teacher || student): 教师分布为 top-k logits 的 softmax,
+        学生为全词表 log_softmax 在 top-k 序号处的取值 (支撑集之外的概率质量同样受到惩罚)
+        student_logits [bs, L, V], topk_ids / topk_values [bs, L, k], mask [bs, L]
+    '''
+    log_q = torch.log_softmax(student_logits.float() / temperature, dim=-1).gather(-1, topk_ids.long())
+    log_p = torch.log_softmax(topk_values.float() / temperature, dim=-1)
+    kl = torch.sum(log_p.exp() * (log_p - log_q), dim=-1) * temperature ** 2
+    if mask is not None:
+        kl = kl * mask.to(kl.dtype)
+    if reduction == 'sum':
+        return kl.sum()
+    if reduction == 'mean':
+        return kl.sum() / (mask.sum() if mask is not None else kl.numel())
+    return kl
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/16 10:05
+# @Author  : tk
+# @FileName: evaluate.py
+import typing
+
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, IterableDataset
+
+__all__ = [
+    'EvalBatchCache',
+    'gather_eval_outputs',
+    'broadcast_eval_metric',
+]
+
+
+def _to_device(x, device, non_blocking=True):
+    # 张量, 以及张量组成的 list / dict (例如 spn4re 的 labels)
+    if isinstance(x, torch.Tensor):
+        return x.to(device, non_blocking=non_blocking)
+    if isinstance(x, (list, tuple)):
+        return type(x)(_to_device(v, device, non_blocking) for v in x)
+    if isinstance(x, dict):
+        return {k: _to_device(v, device, non_blocking) for k, v in x.items()}
+    return x
+
+
+def _pin_memory(x):
+    if isinstance(x, torch.Tensor):
+        return x.pin_memory()
+    if isinstance(x, (list, tuple)):
+        return type(x)(_pin_memory(v) for v in x)
+    if isinstance(x, dict):
+        return {k: _pin_memory(v) for k, v in x.items()}
+    return x
+
+
+def _is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def gather_eval_outputs(*outputs: list):
+    '''
+        各进程的评估结果 (list) 汇总到 rank 0, rank 0 返回拼接后的 list, 其余进程原样返回
+        单进程时不做任何通信
+        集合通信, 所有进程都必须调用: 多卡时 SimpleModelCheckpoint 需 rank=-1, 让所有进程都进入
+        on_save_model 评估各自的分片, 否则 rank 0 在汇总时死锁; trainer.save_checkpoint 同样需要
+        所有进程调用, 只在 rank 0 写文件
+    '''
+    if not _is_distributed():
+        return outputs if len(outputs) > 1 else outputs[0]
+    gathered = [None] * dist.get_world_size() if dist.get_rank() == 0 else None
+    dist.gather_object(list(outputs), gathered, dst=0)
+    if dist.get_rank() == 0:
+        outputs = tuple([x for rank_outputs in gathered for x in rank_outputs[j]] for j in range(len(outputs)))
+    return outputs if len(outputs) > 1 else outputs[0]
+
+
+def broadcast_eval_metric(value, src: int = 0):
+    # rank 0 计算的指标广播到所有进程, 保证各进程的保存决策一致, 同 gather_eval_outputs 需所有进程调用
+    if not _is_distributed():
+        return value
+    obj = [value]
+    dist.broadcast_object_list(obj, src=src)
+    return obj[0]
+
+
+class _EvalBatches:
+    '''
+        迭代返回 (i, batch), i 为全局批次序号 (用于切分 eval_labels), batch 拷贝到目标设备,
+        每次返回新的 dict, 不修改缓存
+    '''
+    def __init__(self, batches: typing.List[typing.Tuple[int, typing.Dict]], device):
+        self.batches = batches
+        self.device = device
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        for i, batch in self.batches:
+            yield i, {k: _to_device(v, self.device) for k, v in batch.items()}
+
+
+class EvalBatchCache:
+    '''
+        on_save_model 评估集缓存: 评估集只 load_dataset + collate 一次, 之后每次保存模型直接复用,
+        不再重复构建 DataLoader 和逐个键拷贝.
+        to_device: 批次直接常驻目标设备 (评估集较小时), 否则保存在锁页内存中, 迭代时异步拷贝
+        多卡时按批次序号 i % world_size == rank 切分, 每个进程只缓存并评估自己的分片,
+        结果用 gather_eval_outputs 汇总到 rank 0, 指标用 broadcast_eval_metric 广播
+        评估文件在训练过程中不变, 缓存按 (batch_size, device, rank, world_size) 区分
+    '''
+    def __init__(self, to_device: bool = False, pin_memory: bool = True):
+        self.to_device = to_device
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._key = None
+        self._batches = None
+
+    def clear(self):
+        self._key = None
+        self._batches = None
+
+    def _iter_shard(self, data_helper, dataset, batch_size: int, rank: int, world_size: int):
+        if isinstance(dataset, IterableDataset):
+            for i, batch in enumerate(DataLoader(dataset, batch_size=batch_size, collate_fn=data_helper.collate_fn)):
+                if i % world_size == rank:
+                    yield i, batch
+            return
+        # 随机访问数据集只读取并 collate 本进程的批次
+        n = len(dataset)
+        batch_ids = list(range(rank, (n + batch_size - 1) // batch_size, world_size))
+        batch_sampler = [list(range(i * batch_size, min(n, (i + 1) * batch_size))) for i in batch_ids]
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=data_helper.collate_fn)
+        yield from zip(batch_ids, dataloader)
+
+    def _load(self, data_helper, batch_size: int, device, rank: int, world_size: int):
+        dataset = data_helper.load_dataset(data_helper.eval_files)
+        if dataset is None:
+            return []
+        batches = []
+        for i, batch in self._iter_shard(data_helper, dataset, batch_size, rank, world_size):
+            if self.to_device:
+                batch = {k: _to_device(v, device, non_blocking=False) for k, v in batch.items()}
+            elif self.pin_memory:
+                batch = {k: _pin_memory(v) for k, v in batch.items()}
+            batches.append((i, batch))
+        return batches
+
+    def get(self, data_helper, batch_size: int, device, rank: int = 0, world_size: int = 1) -> _EvalBatches:
+        key = (batch_size, str(device) if self.to_device else None, rank, world_size)
+        if self._key != key:
+            self._batches = self._load(data_helper, batch_size, device, rank, world_size)
+            self._key = key
+        return _EvalBatches(self._batches, device)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/19 10:30
+# @Author  : tk
+# @FileName: grad_cache.py
+import typing
+
+import torch
+from torch.utils.checkpoint import checkpoint
+
+__all__ = [
+    'chunked_encode',
+]
+
+
+def chunked_encode(encode_fn: typing.Callable[..., torch.Tensor],
+                   inputs: typing.Dict[str, torch.Tensor],
+                   chunk_size: typing.Optional[int] = None) -> torch.Tensor:
+    '''
+        梯度缓存 (GradCache) 方式的分块编码, 对比学习的 batch 大小与显存解耦:
+        每块在 checkpoint 中前向, 不保存激活, 只返回整批的 [N, D] 向量, loss 在整批向量上计算 (负样本为整批);
+        反向时先得到 loss 对向量的梯度, 再逐块重算前向并反向 (恢复随机数状态, dropout 与首次前向一致),
+        与 GradCache 的 无梯度前向 -> 向量梯度 -> 分块重算反向 相同, 且仍在 lightning 自动优化流程内.
+        encode_fn(**inputs) -> [n, D], inputs 的值按第 0 维切块; chunk_size 为 None 或不需要梯度时整批编码
+    '''
+    keys = list(inputs.keys())
+    n = inputs[keys[0]].size(0)
+    if not chunk_size or n <= chunk_size:
+        return encode_fn(**inputs)
+
+    def fn(*tensors):
+        return encode_fn(**dict(zip(keys, tensors)))
+
+    outputs = []
+    for i in range(0, n, chunk_size):
+        tensors = [inputs[k][i: i + chunk_size] for k in keys]
+        if torch.is_grad_enabled():
+            outputs.append(checkpoint(fn, *tensors, use_reentrant=False))
+        else:
+            outputs.append(fn(*tensors))
+    return torch.cat(outputs, dim=0)
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/21 16:40
+# @Author  : tk
+# @FileName: mlm_mask.py
+import typing
+
+import numpy as np
+import torch
+
+from .collate import collate_with_seqlen
+
+__all__ = [
+    'make_wwm_document',
+    'DynamicWwmCollator',
+]
+
+
+def make_wwm_document(text: str, tokenizer, max_seq_length: int, do_whole_word_mask: bool = True):
+    '''
+        动态掩码的存储格式: 只分词一次, 不做掩码, 按真实长度存储
+        input_ids [n], word_ids [n] (整词序号, [CLS] / [SEP] 为 -1, 与 make_mlm_wwm_sample 相同以 ## 续接整词), seqlen
+    '''
+    o = tokenizer(text, add_special_tokens=True, truncation=True, max_length=max_seq_length,
+                  return_token_type_ids=False, return_attention_mask=False)
+    input_ids = o['input_ids']
+    tokens = tokenizer.convert_ids_to_tokens(input_ids)
+    word_ids = np.full(len(input_ids), -1, dtype=np.int32)
+    word = -1
+    for i, token in enumerate(tokens):
+        if token == '[CLS]' or token == '[SEP]':
+            continue
+        if not (do_whole_word_mask and word >= 0 and token.startswith('##')):
+            word += 1
+        word_ids[i] = word
+    return {
+        'input_ids': np.asarray(input_ids, dtype=np.int32),
+        'word_ids': word_ids,
+        'seqlen': np.asarray(len(input_ids), dtype=np.int32),
+    }
+
+
+class DynamicWwmCollator:
+    '''
+        collate 时按 batch 向量化做整词掩码, 每个 epoch 的掩码都不同, 不需要 dupe_factor 份静态数据:
+        每条样本预测 min(max_predictions_per_seq, max(1, round(seqlen * masked_lm_prob))) 个 token,
+        整词按随机顺序依次加入, 超出预算的整词跳过; 被选中的 token 80% [MASK], 10% 随机词, 10% 不变.
+        输出 input_ids / attention_mask / labels / weight, 与 make_mlm_wwm_sample 训练格式一致 (labels 未掩码处为 pad_token_id).
+        随机数由 seed, dataloader worker 种子 (worker_info.seed, 每次创建迭代器由主进程 torch 随机数重新生成, 已含 worker 序号)
+        与进程 rank 派生: 可复现 (torch.manual_seed / seed_everything), 各 worker / 进程互不相同,
+        非 persistent_workers 时每个 epoch 重新创建 worker 也不会重复上一个 epoch 的掩码
+    '''
+    def __init__(self, mask_token_id: int, vocab_size: int,
+                 max_predictions_per_seq: int = 20, masked_lm_prob: float = 0.15,
+                 pad_token_id: int = 0, seed: typing.Optional[int] = None):
+        self.mask_token_id = mask_token_id
+        self.vocab_size = vocab_size
+        self.max_predictions_per_seq = max_predictions_per_seq
+        self.masked_lm_prob = masked_lm_prob
+        self.pad_token_id = pad_token_id
+        self.seed = seed
+        self._rng = None
+        self._rng_key = None
+
+    def _get_rng(self) -> np.random.Generator:
+        worker_info = torch.utils.data.get_worker_info()
+        # 主进程 (num_workers=0) 中随机数生成器跨 epoch 持续使用
+        worker_seed = worker_info.seed if worker_info is not None else 0
+        rank = torch.distributed.get_rank() if torch.distributed.is_available() and torch.distributed.is_initialized() else 0
+        key = (worker_seed, rank)
+        if self._rng is None or self._rng_key != key:
+            entropy = self.seed if self.seed is not None else np.random.SeedSequence().entropy
+            self._rng = np.random.default_rng([entropy, worker_seed, rank])
+            self._rng_key = key
+        return self._rng
+
+    def mask(self, input_ids: np.ndarray, word_ids: np.ndarray, seqlens: np.ndarray):
+        '''
+            input_ids / word_ids [bs, L] (填充位置 word_ids 为 -1), seqlens [bs]
+            返回 (masked_input_ids, labels, weight)
+        '''
+        rng = self._get_rng()
+        bs, seq_len = input_ids.shape
+        num_words = np.maximum(word_ids.max(axis=1, initial=-1) + 1, 0)
+        max_words = max(int(num_words.max(initial=0)), 1)
+        budget = np.minimum(self.max_predictions_per_seq,
+                            np.maximum(1, np.round(seqlens * self.masked_lm_prob).astype(np.int64)))
+
+        # 每个整词的 token 数 [bs, max_words]
+        is_cand = word_ids >= 0
+        rows = np.broadcast_to(np.arange(bs)[:, None], word_ids.shape)
+        word_len = np.bincount(rows[is_cand] * max_words + word_ids[is_cand],
+                               minlength=bs * max_words).reshape(bs, max_words)
+
+        # 整词随机排序后依次加入, 超出预算的整词跳过 (与 make_mlm_wwm_sample 一致);
+        # 按排序位置循环, 每步处理整个 batch, 所有样本预算用完即停止
+        keys = rng.random((bs, max_words))
+        keys[np.arange(max_words)[None, :] >= num_words[:, None]] = np.inf
+        order = np.argsort(keys, axis=1)
+        sorted_len = np.take_along_axis(word_len, order, axis=1)
+        sorted_len[np.take_along_axis(keys, order, axis=1) == np.inf] = self.max_predictions_per_seq + 1
+        chosen_sorted = np.zeros((bs, max_words), dtype=bool)
+        used = np.zeros(bs, dtype=np.int64)
+        for j in range(max_words):
+            take = used + sorted_len[:, j] <= budget
+            chosen_sorted[:, j] = take
+            used += np.where(take, sorted_len[:, j], 0)
+            if np.all(used >= budget):
+                break
+        chosen = np.zeros((bs, max_words), dtype=bool)
+        np.put_along_axis(chosen, order, chosen_sorted, axis=1)
+        masked = is_cand & chosen[rows, np.maximum(word_ids, 0)]
+
+        r = rng.random((bs, seq_len))
+        masked_input_ids = input_ids.copy()
+        masked_input_ids[masked & (r < 0.8)] = self.mask_token_id
+        random_pos = masked & (r >= 0.8) & (r < 0.9)
+        masked_input_ids[random_pos] = rng.integers(0, self.vocab_size, size=int(random_pos.sum()))
+        labels = np.where(masked, input_ids, self.pad_token_id)
+        return masked_input_ids, labels, masked.astype(np.float32)
+
+    def __call__(self, batch: typing.List[typing.Dict]):
+        o = collate_with_seqlen(batch, seq_keys=('word_ids',),
+                                pad_values={'input_ids': self.pad_token_id, 'word_ids': -1},
+                                pop_seqlen=False, with_attention_mask=True)
+        seqlens = o.pop('seqlen').numpy()
+        input_ids, labels, weight = self.mask(o['input_ids'].numpy().astype(np.int64),
+                                              o.pop('word_ids').numpy(), seqlens)
+        o['input_ids'] = torch.from_numpy(input_ids)
+        o['labels'] = torch.from_numpy(labels)
+        o['weight'] = torch.from_numpy(weight)
+        return o
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/18 9:40
+# @Author  : tk
+# @FileName: record_index.py
+import json
+import os
+import pickle
+import random
+import typing
+
+import numpy as np
+from fastdatasets.record import load_dataset as Loader, RECORD
+from tqdm import tqdm
+
+__all__ = [
+    'split_records_stream',
+    'write_subset_index',
+    'split_records_index',
+    'load_subset_dataset',
+    'write_ref_sources',
+    'load_ref_sources',
+]
+
+
+def _index_file(record_file: str, index_dir: str):
+    # 与 fastdatasets SingleRecordRandomDataset 的索引文件命名一致
+    return os.path.join(index_dir, '.' + os.path.basename(record_file) + '.INDEX')
+
+
+class _SplitWriter:
+    '''
+        拆分输出: buffer_size > 1 时经有界缓冲区随机打乱后写出, modify_fn(example, count) 的 count 为写出序号 (从 1 开始)
+    '''
+    def __init__(self, writer, buffer_size: int, rng: random.Random, modify_fn=None):
+        self.writer = writer
+        self.buffer_size = buffer_size
+        self.rng = rng
+        self.modify_fn = modify_fn
+        self.buffer = []
+        self.num = 0
+
+    def _emit(self, example):
+        self.num += 1
+        if self.modify_fn is not None:
+            example = self.modify_fn(example, self.num)
+        self.writer.write(example)
+
+    def write(self, example):
+        if self.buffer_size <= 1:
+            self._emit(example)
+            return
+        if len(self.buffer) < self.buffer_size:
+            self.buffer.append(example)
+            return
+        k = self.rng.randrange(self.buffer_size)
+        self._emit(self.buffer[k])
+        self.buffer[k] = example
+
+    def flush(self):
+        self.rng.shuffle(self.buffer)
+        for example in self.buffer:
+            self._emit(example)
+        self.buffer = []
+
+
+def split_records_stream(dataset_reader: typing.Iterable, writer_train, writer_eval, eval_every: int,
+                         shuffle_buffer_size: int = 0, modify_fn=None, seed=None, desc: str = 'split records'):
+    '''
+        顺序读取一遍 (压缩记录只能顺序解压, 随机读取每次都从文件头解压), 第 (i + 1) % eval_every == 0 条写入评估集;
+        shuffle_buffer_size > 1 时训练集与评估集各用有界缓冲区局部打乱, 完全打乱用 shuffle_records(external=True).
+        dataset_reader 为 IterableDataset, 原始记录配合 WriterObject, 解析后的记录配合 NumpyWriter;
+        返回 (num_train, num_eval)
+    '''
+    rng = random.Random(seed)
+    train_out = _SplitWriter(writer_train, shuffle_buffer_size, rng, modify_fn)
+    eval_out = _SplitWriter(writer_eval, shuffle_buffer_size, rng, modify_fn)
+    for i, example in enumerate(tqdm(dataset_reader, desc=desc)):
+        (eval_out if (i + 1) % eval_every == 0 else train_out).write(example)
+    train_out.flush()
+    eval_out.flush()
+    return train_out.num, eval_out.num
+
+
+def write_subset_index(record_file: str, offsets: list, index_dir: str):
+    '''
+        写入只包含部分记录 offsets 的索引文件, RandomDataset(record_file, index_path=index_dir) 即为子集视图.
+        索引记录了源文件的大小与 ctime, 源文件变化后 fastdatasets 会重建完整索引 (子集失效)
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    filestat = os.stat(record_file)
+    with open(_index_file(record_file, index_dir), mode='wb') as f:
+        pickle.dump((list(offsets), filestat.st_size, filestat.st_ctime), f)
+
+
+def split_records_index(input_record_filenames: typing.Union[typing.List[str], str],
+                        output_dir: str,
+                        eval_every: int = 15,
+                        compression_type: str = 'GZIP'):
+    '''
+        只生成索引文件的拆分, 不拷贝数据: 读取 (或复用) 源记录的偏移索引, 按全局序号拆分后
+        分别写入 output_dir/train 与 output_dir/eval, 返回 (train_index_dir, eval_index_dir, num_train, num_eval)
+    '''
+    if isinstance(input_record_filenames, str):
+        input_record_filenames = [input_record_filenames]
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    train_dir = os.path.join(output_dir, 'train')
+    eval_dir = os.path.join(output_dir, 'eval')
+    num_train, num_eval = 0, 0
+    start = 0
+    for record_file in input_record_filenames:
+        dataset_reader = Loader.RandomDataset(record_file, options=options)
+        offsets = dataset_reader.indexes
+        dataset_reader.close()
+        # 全局序号, 与多文件 RandomDataset 的拼接顺序一致
+        ids = np.arange(start, start + len(offsets))
+        is_eval = (ids + 1) % eval_every == 0
+        write_subset_index(record_file, [offsets[i] for i in np.flatnonzero(~is_eval)], train_dir)
+        write_subset_index(record_file, [offsets[i] for i in np.flatnonzero(is_eval)], eval_dir)
+        num_eval += int(is_eval.sum())
+        num_train += len(offsets) - int(is_eval.sum())
+        start += len(offsets)
+    return train_dir, eval_dir, num_train, num_eval
+
+
+def load_subset_dataset(input_record_filenames: typing.Union[typing.List[str], str],
+                        index_dir: str,
+                        compression_type: str = 'GZIP',
+                        with_share_memory: bool = False):
+    '''
+        按 split_records_index 的索引打开子集 RandomDataset;
+        源文件在拆分后被修改时报错, 避免 fastdatasets 静默重建为完整数据集
+    '''
+    if isinstance(input_record_filenames, str):
+        input_record_filenames = [input_record_filenames]
+    for record_file in input_record_filenames:
+        with open(_index_file(record_file, index_dir), mode='rb') as f:
+            _, file_size, st_ctime = pickle.load(f)
+        filestat = os.stat(record_file)
+        if filestat.st_size != file_size or filestat.st_ctime != st_ctime:
+            raise ValueError('{} changed after split, rerun split_records_index'.format(record_file))
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    return Loader.RandomDataset(input_record_filenames, index_path=index_dir, options=options,
+                                with_share_memory=with_share_memory)
+
+
+def _sources_file(ref_file: str):
+    return ref_file + '.sources.json'
+
+
+def _is_uncompressed(compression_type):
+    return compression_type in (None, '', RECORD.TFRecordCompressionType.NONE)
+
+
+def write_ref_sources(ref_file: str, record_filenames: typing.Union[typing.List[str], str],
+                      compression_type=RECORD.TFRecordCompressionType.NONE):
+    '''
+        引用记录 (只存储源记录序号) 的来源说明, 写入 {ref_file}.sources.json;
+        序号为源文件按顺序拼接后 RandomDataset 的全局序号.
+        源记录必须不压缩: GZIP 为单个压缩流, 每次随机读取都从文件头解压
+    '''
+    if not _is_uncompressed(compression_type):
+        raise ValueError('reference sources must be uncompressed for random access, got {}'.format(compression_type))
+    if isinstance(record_filenames, str):
+        record_filenames = [record_filenames]
+    meta = {
+        'sources': [os.path.abspath(f) for f in record_filenames],
+        'compression_type': '',
+    }
+    with open(_sources_file(ref_file), mode='w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+
+
+def load_ref_sources(ref_files: typing.Union[typing.List[str], str], with_share_memory: bool = True):
+    '''
+        打开引用记录对应的源数据集 (已解析的 RandomDataset), 多个引用记录须引用同一组源记录;
+        都没有来源说明时返回 None
+    '''
+    if isinstance(ref_files, str):
+        ref_files = [ref_files]
+    metas = []
+    for ref_file in ref_files:
+        if os.path.exists(_sources_file(ref_file)):
+            with open(_sources_file(ref_file), mode='r', encoding='utf-8') as f:
+                metas.append(json.load(f))
+    if not metas:
+        return None
+    if any(meta != metas[0] for meta in metas[1:]):
+        raise ValueError('{} reference different source records'.format(ref_files))
+    meta = metas[0]
+    if not _is_uncompressed(meta['compression_type']):
+        raise ValueError('{} sources are {} compressed, rerun convert_train_pos_neg_for_infonce.py to write '
+                         'uncompressed sources'.format(ref_files, meta['compression_type']))
+    options = RECORD.TFRecordOptions(compression_type=meta['compression_type'])
+    return Loader.RandomDataset(meta['sources'], options=options,
+                                with_share_memory=with_share_memory).parse_from_numpy_writer()
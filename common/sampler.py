@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/12 14:35
+# @Author  : tk
+# @FileName: sampler.py
+import logging
+import typing
+
+import numpy as np
+from torch.utils.data import DataLoader, IterableDataset, Sampler
+
+__all__ = [
+    'PaddingStats',
+    'get_seqlens',
+    'LengthBucketBatchSampler',
+    'LengthBucketIterableDataset',
+    'make_bucket_dataloader',
+]
+
+
+class PaddingStats:
+    '''
+        统计有效 token 与补齐后 token 数, efficiency = 有效 / 补齐后
+    '''
+    def __init__(self, log_every_n_batches: int = 0, desc: str = 'bucket'):
+        self.log_every_n_batches = log_every_n_batches
+        self.desc = desc
+        self.reset()
+
+    def reset(self):
+        self.num_batches = 0
+        self.num_samples = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def update(self, lengths: typing.Sequence[int]):
+        self.num_batches += 1
+        self.num_samples += len(lengths)
+        self.real_tokens += int(sum(lengths))
+        self.padded_tokens += int(max(lengths)) * len(lengths)
+        if self.log_every_n_batches > 0 and self.num_batches % self.log_every_n_batches == 0:
+            logging.info(str(self))
+
+    @property
+    def efficiency(self):
+        return self.real_tokens / max(self.padded_tokens, 1)
+
+    def __str__(self):
+        return '{} batches {} samples {} avg_batch_size {:.1f} padding_efficiency {:.4f}'.format(
+            self.desc, self.num_batches, self.num_samples,
+            self.num_samples / max(self.num_batches, 1), self.efficiency)
+
+
+def get_seqlens(dataset, seqlen_key: str = 'seqlen') -> np.ndarray:
+    # 随机访问数据集读取一遍 seqlen
+    return np.asarray([int(np.asarray(dataset[i][seqlen_key]).reshape(-1)[0]) for i in range(len(dataset))],
+                      dtype=np.int64)
+
+
+def _split_batches(order: np.ndarray, lengths: np.ndarray, batch_size: typing.Optional[int],
+                   max_tokens: typing.Optional[int], drop_last: bool):
+    '''
+        order 已按长度排序, 按 batch_size 或 max_tokens (max_len * 样本数) 切分 batch
+    '''
+    batches = []
+    current, current_max = [], 0
+    for idx in order:
+        length = int(lengths[idx])
+        new_max = max(current_max, length)
+        full = (batch_size is not None and len(current) >= batch_size) or \
+               (max_tokens is not None and current and new_max * (len(current) + 1) > max_tokens)
+        if full:
+            batches.append(current)
+            current, new_max = [], length
+        current.append(idx)
+        current_max = new_max
+    if current and not (drop_last and batch_size is not None and len(current) < batch_size):
+        batches.append(current)
+    return batches
+
+
+class LengthBucketBatchSampler(Sampler):
+    '''
+        随机访问数据集的长度分桶 batch_sampler:
+        每 window_size 个随机样本内按 seqlen 排序后切分 batch, 再打乱 batch 顺序,
+        相近长度的样本进入同一个 batch, 减少补齐.
+        batch_size: 固定 batch 大小
+        max_tokens: token 预算, max_len * batch 样本数 不超过 max_tokens (可与 batch_size 同时使用作为上限)
+        num_replicas / rank: 多卡时各进程用相同的 seed 与 epoch 生成全部 batch, 再按 batch 序号 i % num_replicas == rank 切分,
+        batch 数不能整除时 drop_last 丢弃多余的 batch, 否则从头补齐, 保证各进程步数相同;
+        构建 DataLoader 时进程组可能尚未初始化, 多卡需显式传入 trainer.world_size / trainer.global_rank.
+        DDP 训练时 Trainer 需设置 replace_sampler_ddp=False, 否则 lightning 会用 DistributedSampler 重建本 sampler;
+        流式数据集 (LengthBucketIterableDataset) 由 load_dataset(num_processes, process_index) 切分, 不需要设置
+    '''
+    def __init__(self, lengths: typing.Sequence[int],
+                 batch_size: int = None,
+                 max_tokens: int = None,
+                 window_size: int = 10000,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seed: int = 0,
+                 log_every_n_batches: int = 0,
+                 num_replicas: int = 1,
+                 rank: int = 0):
+        assert batch_size is not None or max_tokens is not None
+        assert 0 <= rank < num_replicas
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.window_size = window_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.stats = PaddingStats(log_every_n_batches, desc='LengthBucketBatchSampler')
+        self._cache = None
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _batches(self):
+        if self._cache is not None and self._cache[0] == self.epoch:
+            return self._cache[1]
+        rng = np.random.RandomState(self.seed + self.epoch)
+        n = len(self.lengths)
+        order = rng.permutation(n) if self.shuffle else np.arange(n)
+        batches = []
+        for start in range(0, n, self.window_size):
+            window = order[start: start + self.window_size]
+            window = window[np.argsort(self.lengths[window], kind='stable')]
+            window_batches = _split_batches(window, self.lengths, self.batch_size, self.max_tokens, self.drop_last)
+            if self.shuffle:
+                rng.shuffle(window_batches)
+            batches.extend(window_batches)
+        if self.num_replicas > 1:
+            if self.drop_last:
+                batches = batches[:len(batches) // self.num_replicas * self.num_replicas]
+            else:
+                total = (len(batches) + self.num_replicas - 1) // self.num_replicas * self.num_replicas
+                while len(batches) < total:
+                    batches = batches + batches[:total - len(batches)]
+            batches = batches[self.rank::self.num_replicas]
+        self._cache = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        batches = self._batches()
+        for batch in batches:
+            self.stats.update(self.lengths[batch])
+            yield [int(i) for i in batch]
+        self.epoch += 1
+
+    def __len__(self):
+        return len(self._batches())
+
+
+class LengthBucketIterableDataset(IterableDataset):
+    '''
+        流式 (with_record_iterable_dataset=True) 数据集的长度分桶:
+        缓存 buffer_size 个样本, 按 seqlen 排序后切分 batch, 打乱后逐个输出 batch (list).
+        配合 DataLoader(batch_size=None, collate_fn=collate_fn) 使用, 见 make_bucket_dataloader
+    '''
+    def __init__(self, dataset: typing.Iterable,
+                 batch_size: int = None,
+                 max_tokens: int = None,
+                 buffer_size: int = 10000,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seqlen_key: str = 'seqlen',
+                 log_every_n_batches: int = 0):
+        assert batch_size is not None or max_tokens is not None
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.buffer_size = buffer_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seqlen_key = seqlen_key
+        self.stats = PaddingStats(log_every_n_batches, desc='LengthBucketIterableDataset')
+
+    def _flush(self, buffer: list):
+        lengths = np.asarray([int(np.asarray(x[self.seqlen_key]).reshape(-1)[0]) for x in buffer], dtype=np.int64)
+        order = np.argsort(lengths, kind='stable')
+        batches = _split_batches(order, lengths, self.batch_size, self.max_tokens, self.drop_last)
+        if self.shuffle:
+            np.random.shuffle(batches)
+        for batch in batches:
+            self.stats.update(lengths[batch])
+            yield [buffer[i] for i in batch]
+
+    def __iter__(self):
+        buffer = []
+        for x in self.dataset:
+            buffer.append(x)
+            if len(buffer) >= self.buffer_size:
+                yield from self._flush(buffer)
+                buffer = []
+        if buffer:
+            yield from self._flush(buffer)
+
+
+def make_bucket_dataloader(dataset, collate_fn: typing.Callable,
+                           batch_size: int = None,
+                           max_tokens: int = None,
+                           window_size: int = 10000,
+                           shuffle: bool = True,
+                           log_every_n_batches: int = 1000,
+                           num_replicas: int = 1,
+                           rank: int = 0,
+                           **kwargs) -> DataLoader:
+    '''
+        按数据集类型构建长度分桶 DataLoader, 分桶统计见 dataloader.bucket_stats
+        num_replicas / rank 只用于随机访问数据集, 见 LengthBucketBatchSampler
+    '''
+    if isinstance(dataset, IterableDataset):
+        bucket_dataset = LengthBucketIterableDataset(dataset, batch_size=batch_size, max_tokens=max_tokens,
+                                                     buffer_size=window_size, shuffle=shuffle,
+                                                     log_every_n_batches=log_every_n_batches)
+        dataloader = DataLoader(bucket_dataset, batch_size=None, collate_fn=collate_fn, **kwargs)
+        dataloader.bucket_stats = bucket_dataset.stats
+    else:
+        batch_sampler = LengthBucketBatchSampler(get_seqlens(dataset), batch_size=batch_size, max_tokens=max_tokens,
+                                                 window_size=window_size, shuffle=shuffle,
+                                                 log_every_n_batches=log_every_n_batches,
+                                                 num_replicas=num_replicas, rank=rank)
+        dataloader = DataLoader(dataset, batch_sampler=batch_sampler, collate_fn=collate_fn, **kwargs)
+        dataloader.bucket_stats = batch_sampler.stats
+    return dataloader
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/17 11:20
+# @Author  : tk
+# @FileName: seq_metric.py
+import typing
+
+import numpy as np
+
+__all__ = [
+    'build_tag_lookup',
+    'flatten_tags',
+    'get_chunks',
+    'seq_f1_report',
+]
+
+# 标签前缀编码
+TAG_O, TAG_B, TAG_I, TAG_E, TAG_S = 0, 1, 2, 3, 4
+_PREFIX = {'O': TAG_O, 'B': TAG_B, 'I': TAG_I, 'E': TAG_E, 'S': TAG_S}
+
+
+def build_tag_lookup(id2label: typing.Dict[int, str]):
+    '''
+        id2label -> (prefix [num_labels], type [num_labels], type_names), O 的类型为 -1
+    '''
+    num_labels = max(int(k) for k in id2label) + 1
+    prefix = np.zeros(num_labels, dtype=np.int64)
+    types = np.full(num_labels, -1, dtype=np.int64)
+    type_names = sorted({label.split('-', 1)[1] for label in id2label.values() if label != 'O'})
+    type2id = {name: i for i, name in enumerate(type_names)}
+    for i, label in id2label.items():
+        if label == 'O':
+            continue
+        tag, name = label.split('-', 1)
+        prefix[int(i)] = _PREFIX[tag]
+        types[int(i)] = type2id[name]
+    return prefix, types, type_names
+
+
+def flatten_tags(batches: typing.Sequence[np.ndarray], masks: typing.Sequence[np.ndarray], o_id: int = 0):
+    '''
+        [N, L] 标签批次按 mask 取出有效位置后拼接为一维, 每个序列之后补一个 O 作为分隔 (与 seqeval 嵌套 list 处理一致)
+    '''
+    flat = []
+    for tags, mask in zip(batches, masks):
+        tags = np.asarray(tags).reshape(-1, np.shape(tags)[-1])
+        mask = np.asarray(mask, dtype=bool).reshape(tags.shape)
+        n = len(tags)
+        tags = np.concatenate([tags, np.full((n, 1), o_id, dtype=tags.dtype)], axis=1)
+        mask = np.concatenate([mask, np.ones((n, 1), dtype=bool)], axis=1)
+        flat.append(tags[mask])
+    return np.concatenate(flat) if flat else np.zeros((0,), dtype=np.int64)
+
+
+def get_chunks(flat_tags: np.ndarray, prefix: np.ndarray, types: np.ndarray) -> np.ndarray:
+    '''
+        conlleval 规则的分块 (与 seqeval get_entities 一致), 向量化实现
+        返回 [n, 3] (type, start, end)
+    '''
+    tag = np.concatenate([prefix[flat_tags], [TAG_O]])
+    typ = np.concatenate([types[flat_tags], [-1]])
+    prev_tag = np.concatenate([[TAG_O], tag[:-1]])
+    prev_typ = np.concatenate([[-1], typ[:-1]])
+
+    prev_bi = (prev_tag == TAG_B) | (prev_tag == TAG_I)
+    prev_es = (prev_tag == TAG_E) | (prev_tag == TAG_S)
+    cur_ei = (tag == TAG_E) | (tag == TAG_I)
+    chunk_end = prev_es | (prev_bi & ((tag == TAG_B) | (tag == TAG_S) | (tag == TAG_O))) | \
+                ((prev_tag != TAG_O) & (prev_typ != typ))
+    chunk_start = (tag == TAG_B) | (tag == TAG_S) | ((prev_es | (prev_tag == TAG_O)) & cur_ei) | \
+                  ((tag != TAG_O) & (prev_typ != typ))
+
+    ends = np.flatnonzero(chunk_end)
+    starts = np.flatnonzero(chunk_start)
+    # 块的起点为结束位置之前最近的 start, 没有时为 0
+    pos = np.searchsorted(starts, ends, side='left') - 1
+    begin = np.where(pos >= 0, starts[np.maximum(pos, 0)], 0)
+    return np.stack([prev_typ[ends], begin, ends - 1], axis=1)
+
+
+def _prf(tp, pred, true):
+    precision = np.divide(tp, pred, out=np.zeros(len(tp)), where=pred > 0)
+    recall = np.divide(tp, true, out=np.zeros(len(tp)), where=true > 0)
+    denom = precision + recall
+    f1 = np.divide(2 * precision * recall, denom, out=np.zeros(len(tp)), where=denom > 0)
+    return precision, recall, f1
+
+
+def seq_f1_report(y_trues: typing.Sequence[np.ndarray],
+                  y_preds: typing.Sequence[np.ndarray],
+                  id2label: typing.Dict[int, str],
+                  ignore_id: typing.Optional[int] = None,
+                  seqlens: typing.Optional[typing.Sequence[np.ndarray]] = None,
+                  average: str = 'macro',
+                  digits: int = 4):
+    '''
+        标签 id 批次 (list of [N, L]) 直接计算实体级 f1 与报告, 不转换为字符串标签
+        有效位置: ignore_id 以外的真实标签位置, 或 seqlens 以内的位置
+        结果与 seqmetric f1_score / classification_report (默认 conlleval 模式) 一致
+    '''
+    prefix, types, type_names = build_tag_lookup(id2label)
+    o_id = int(np.flatnonzero(prefix == TAG_O)[0])
+    y_trues = [np.asarray(t) for t in y_trues]
+    y_preds = [np.asarray(p) for p in y_preds]
+    if seqlens is not None:
+        masks = [np.arange(np.shape(t)[-1]) < np.asarray(l).reshape(-1, 1) for t, l in zip(y_trues, seqlens)]
+    elif ignore_id is not None:
+        masks = [t != ignore_id for t in y_trues]
+    else:
+        masks = [np.ones(np.shape(t), dtype=bool) for t in y_trues]
+
+    true_chunks = get_chunks(flatten_tags(y_trues, masks, o_id), prefix, types)
+    pred_chunks = get_chunks(flatten_tags(y_preds, masks, o_id), prefix, types)
+
+    num_types = len(type_names)
+    span = max(int(true_chunks[:, 2].max(initial=0)), int(pred_chunks[:, 2].max(initial=0))) + 2
+    key = lambda c: (c[:, 1] * span + c[:, 2]) * num_types + c[:, 0]
+    true_keys, pred_keys = np.unique(key(true_chunks)), np.unique(key(pred_chunks))
+    tp_keys = np.intersect1d(true_keys, pred_keys, assume_unique=True)
+    true_sum = np.bincount(true_keys % num_types, minlength=num_types)
+    pred_sum = np.bincount(pred_keys % num_types, minlength=num_types)
+    tp_sum = np.bincount(tp_keys % num_types, minlength=num_types)
+
+    # 与 seqeval 一致, 只统计真实或预测中出现过的类型
+    present = (true_sum + pred_sum) > 0
+    names = [name for name, p in zip(type_names, present) if p]
+    tp_sum, pred_sum, true_sum = tp_sum[present], pred_sum[present], true_sum[present]
+    precision, recall, f1 = _prf(tp_sum, pred_sum, true_sum)
+
+    micro = _prf(tp_sum.sum(keepdims=True), pred_sum.sum(keepdims=True), true_sum.sum(keepdims=True))
+    micro = [float(x[0]) for x in micro]
+    macro = [float(np.mean(x)) if len(x) else 0.0 for x in (precision, recall, f1)]
+    weights = true_sum / max(true_sum.sum(), 1)
+    weighted = [float(np.sum(x * weights)) for x in (precision, recall, f1)]
+
+    width = max([len(name) for name in names] + [len('weighted avg')])
+    head = '{:>{width}s} ' + ' {:>9}' * 4
+    row = '{:>{width}s} ' + ' {:>9.{digits}f}' * 3 + ' {:>9}'
+    lines = [head.format('', 'precision', 'recall', 'f1-score', 'support', width=width), '']
+    for i, name in enumerate(names):
+        lines.append(row.format(name, precision[i], recall[i], f1[i], int(true_sum[i]), width=width, digits=digits))
+    lines.append('')
+    support = int(true_sum.sum())
+    for avg_name, avg in (('micro avg', micro), ('macro avg', macro), ('weighted avg', weighted)):
+        lines.append(row.format(avg_name, *avg, support, width=width, digits=digits))
+    report = '\n'.join(lines) + '\n'
+
+    score = {'micro': micro, 'macro': macro, 'weighted': weighted}[average][2]
+    return score, report
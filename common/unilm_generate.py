@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/20 10:10
+# @Author  : tk
+# @FileName: unilm_generate.py
+import math
+import typing
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+__all__ = [
+    'KVCache',
+    'UnilmDecoder',
+    'top_k_top_p_filtering',
+    'sample_search',
+    'beam_search',
+    'unilm_generate',
+]
+
+
+class KVCache:
+    '''
+        UniLM 增量解码的键值缓存, 每层 [num_slots, H, max_source_length + max_target_length, d]:
+        源文本写入 [0, max_source_length), 生成的第 t 个 token 写入 max_source_length + t.
+        unilm mask 下源文本只看源文本, 目标只看源文本与之前的目标, 因此缓存的键值与整句重算完全一致
+    '''
+    def __init__(self, num_layers: int, num_slots: int, num_heads: int, head_size: int,
+                 max_source_length: int, max_target_length: int,
+                 dtype=torch.float32, device=None):
+        shape = (num_slots, num_heads, max_source_length + max_target_length, head_size)
+        self.keys = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.values = [torch.zeros(shape, dtype=dtype, device=device) for _ in range(num_layers)]
+        self.src_len = torch.zeros(num_slots, dtype=torch.long, device=device)
+        self.tgt_len = torch.zeros(num_slots, dtype=torch.long, device=device)
+        self.max_source_length = max_source_length
+        self.max_target_length = max_target_length
+
+    @property
+    def num_slots(self):
+        return self.src_len.size(0)
+
+    def copy_(self, src_slots: torch.Tensor, dst_slots: torch.Tensor):
+        '''
+            整个槽位复制 (源文本与已生成部分), 用于束搜索初始化各束
+        '''
+        for cache in self.keys + self.values:
+            cache[dst_slots] = cache[src_slots]
+        self.src_len[dst_slots] = self.src_len[src_slots]
+        self.tgt_len[dst_slots] = self.tgt_len[src_slots]
+
+    def select_(self, index: torch.Tensor):
+        '''
+            只保留 index 对应的槽位 (按 index 顺序), 用于剔除已结束的序列
+        '''
+        self.keys = [k[index] for k in self.keys]
+        self.values = [v[index] for v in self.values]
+        self.src_len = self.src_len[index]
+        self.tgt_len = self.tgt_len[index]
+
+    def reorder_target_(self, index: torch.Tensor):
+        '''
+            束搜索重排: 只复制已生成部分, index 须在同一条源文本的各束之间 (源文本部分相同)
+        '''
+        start = self.max_source_length
+        end = start + int(self.tgt_len.max())
+        for cache in self.keys + self.values:
+            cache[:, :, start:end] = cache[index, :, start:end]
+        self.tgt_len = self.tgt_len[index]
+
+
+class UnilmDecoder:
+    '''
+        基于 bert 编码层与 lm_head 的增量解码, 与 TransformerModelForUnilm 训练时的 unilm mask 一致:
+        prefill 双向编码源文本 ([CLS] text [SEP]), 末位 logits 预测第一个目标 token;
+        step 每次只计算新 token, 注意力读取缓存. num_layers 只使用前若干层 (学生模型), 模型须处于 eval 模式
+    '''
+    def __init__(self, bert: nn.Module, lm_head: nn.Module, num_layers: typing.Optional[int] = None):
+        config = bert.config
+        if getattr(config, 'position_embedding_type', 'absolute') != 'absolute':
+            raise ValueError('only absolute position embedding is supported')
+        self.bert = bert
+        self.lm_head = lm_head
+        self.layers = list(bert.encoder.layer)[:num_layers]
+        attention = self.layers[0].attention.self
+        self.num_heads = attention.num_attention_heads
+        self.head_size = attention.attention_head_size
+        # 与训练一致, type_vocab_size != 2 时不使用 token_type_ids
+        self.target_type_id = 1 if getattr(config, 'type_vocab_size', 0) == 2 else 0
+
+    def new_cache(self, num_slots: int, max_source_length: int, max_target_length: int) -> KVCache:
+        weight = self.bert.embeddings.word_embeddings.weight
+        return KVCache(len(self.layers), num_slots, self.num_heads, self.head_size,
+                       max_source_length, max_target_length, dtype=weight.dtype, device=weight.device)
+
+    def _split_heads(self, x: torch.Tensor):
+        n, length, _ = x.size()
+        return x.view(n, length, self.num_heads, self.head_size).transpose(1, 2)
+
+    def _layer_forward(self, layer, hidden, keys, values, masks):
+        # keys/values/masks 按段给出 (源文本段, 目标段), 分段计算避免拼接缓存
+        attention = layer.attention.self
+        q = self._split_heads(attention.query(hidden))
+        scores = torch.cat([torch.matmul(q, k.transpose(-1, -2)) for k in keys], dim=-1)
+        scores = scores / math.sqrt(self.head_size)
+        mask = torch.cat(masks, dim=-1)[:, None, None, :]
+        scores = scores.masked_fill(~mask, torch.finfo(scores.dtype).min)
+        probs = torch.softmax(scores, dim=-1)
+        probs = torch.split(probs, [k.size(2) for k in keys], dim=-1)
+        context = sum(torch.matmul(p, v) for p, v in zip(probs, values))
+        context = context.transpose(1, 2).reshape(hidden.size(0), hidden.size(1), -1)
+        x = layer.attention.output(context, hidden)
+        return layer.output(layer.intermediate(x), x)
+
+    @staticmethod
+    def _slot_index(cache: KVCache, slots, n):
+        if slots is None:
+            assert n == cache.num_slots
+            return torch.arange(n, device=cache.src_len.device), slice(None)
+        return slots, slots
+
+    @torch.no_grad()
+    def prefill(self, cache: KVCache, input_ids: torch.Tensor, seqlen: torch.Tensor,
+                slots: typing.Optional[torch.Tensor] = None):
+        '''
+            编码源文本 input_ids [n, L] (右侧填充, 有效长度 seqlen) 写入缓存槽位 slots (默认全部),
+            返回预测第一个目标 token 的 logits [n, V]
+        '''
+        n, length = input_ids.size()
+        if length > cache.max_source_length:
+            raise ValueError('source length {} > cache max_source_length {}'.format(length, cache.max_source_length))
+        index, _ = self._slot_index(cache, slots, n)
+        seqlen = seqlen.reshape(-1).long().to(input_ids.device)
+        position_ids = torch.arange(length, device=input_ids.device).unsqueeze(0).expand(n, length)
+        hidden = self.bert.embeddings(input_ids=input_ids,
+                                      token_type_ids=torch.zeros_like(input_ids),
+                                      position_ids=position_ids)
+        mask = position_ids < seqlen.unsqueeze(1)
+        for i, layer in enumerate(self.layers):
+            attention = layer.attention.self
+            k = self._split_heads(attention.key(hidden))
+            v = self._split_heads(attention.value(hidden))
+            cache.keys[i][index, :, :length] = k
+            cache.values[i][index, :, :length] = v
+            hidden = self._layer_forward(layer, hidden, [k], [v], [mask])
+        cache.src_len[index] = seqlen
+        cache.tgt_len[index] = 0
+        last = hidden[torch.arange(n, device=hidden.device), seqlen - 1]
+        return self.lm_head(last)
+
+    @torch.no_grad()
+    def step(self, cache: KVCache, input_ids: torch.Tensor, slots: typing.Optional[torch.Tensor] = None):
+        '''
+            输入上一步生成的 token [n], 写入缓存并返回下一个 token 的 logits [n, V]
+        '''
+        n = input_ids.size(0)
+        index, rows = self._slot_index(cache, slots, n)
+        src_len, tgt_len = cache.src_len[index], cache.tgt_len[index]
+        if int(tgt_len.max()) >= cache.max_target_length:
+            raise ValueError('target length exceeds cache max_target_length {}'.format(cache.max_target_length))
+        hidden = self.bert.embeddings(input_ids=input_ids.unsqueeze(1),
+                                      token_type_ids=torch.full_like(input_ids, self.target_type_id).unsqueeze(1),
+                                      position_ids=(src_len + tgt_len).unsqueeze(1))
+        src_max, tgt_max = int(src_len.max()), int(tgt_len.max()) + 1
+        start = cache.max_source_length
+        src_mask = torch.arange(src_max, device=src_len.device).unsqueeze(0) < src_len.unsqueeze(1)
+        tgt_mask = torch.arange(tgt_max, device=tgt_len.device).unsqueeze(0) <= tgt_len.unsqueeze(1)
+        write = start + tgt_len
+        for i, layer in enumerate(self.layers):
+            attention = layer.attention.self
+            keys, values = cache.keys[i], cache.values[i]
+            keys[index, :, write] = self._split_heads(attention.key(hidden))[:, :, 0]
+            values[index, :, write] = self._split_heads(attention.value(hidden))[:, :, 0]
+            hidden = self._layer_forward(layer, hidden,
+                                         [keys[rows, :, :src_max], keys[rows, :, start: start + tgt_max]],
+                                         [values[rows, :, :src_max], values[rows, :, start: start + tgt_max]],
+                                         [src_mask, tgt_mask])
+        cache.tgt_len[index] = tgt_len + 1
+        return self.lm_head(hidden[:, 0])
+
+
+def top_k_top_p_filtering(logits: torch.Tensor, top_k: int = 0, top_p: float = 1.0):
+    '''
+        logits [n, V], top_k 之外及累计概率超过 top_p 之外的置为 -inf (至少保留一个)
+    '''
+    if top_k > 0:
+        top_k = min(top_k, logits.size(-1))
+        kth = torch.topk(logits, top_k, dim=-1)[0][:, -1:]
+        logits = logits.masked_fill(logits < kth, float('-inf'))
+    if top_p < 1.0:
+        sorted_logits, sorted_ids = torch.sort(logits, descending=True, dim=-1)
+        cum_probs = torch.cumsum(torch.softmax(sorted_logits, dim=-1), dim=-1)
+        remove = cum_probs > top_p
+        remove[:, 1:] = remove[:, :-1].clone()
+        remove[:, 0] = False
+        logits = logits.masked_fill(remove.scatter(1, sorted_ids, remove), float('-inf'))
+    return logits
+
+
+@torch.no_grad()
+def sample_search(decoder: UnilmDecoder, input_ids: torch.Tensor, seqlen: torch.Tensor,
+                  max_target_length: int = 50, eos_token_id: int = 102,
+                  do_sample: bool = False, top_k: int = 0, top_p: float = 1.0, temperature: float = 1.0,
+                  generator: typing.Optional[torch.Generator] = None) -> typing.List[typing.List[int]]:
+    '''
+        贪心 (do_sample=False) 或 top_k / top_p 采样; 序列生成 eos 后立即从缓存中剔除, 不再参与计算.
+        返回每条源文本生成的 token id (不含 eos)
+    '''
+    n, length = input_ids.size()
+    cache = decoder.new_cache(n, length, max_target_length)
+    logits = decoder.prefill(cache, input_ids, seqlen)
+    outputs = [[] for _ in range(n)]
+    active = torch.arange(n)
+    for t in range(max_target_length):
+        if do_sample:
+            logits = top_k_top_p_filtering(logits.float() / temperature, top_k=top_k, top_p=top_p)
+            tokens = torch.multinomial(torch.softmax(logits, dim=-1), 1, generator=generator).squeeze(1)
+        else:
+            tokens = torch.argmax(logits, dim=-1)
+        finished = tokens == eos_token_id
+        for row, token, stop in zip(active.tolist(), tokens.tolist(), finished.tolist()):
+            if not stop:
+                outputs[row].append(token)
+        if t == max_target_length - 1 or bool(finished.all()):
+            break
+        if bool(finished.any()):
+            keep = torch.nonzero(~finished).squeeze(1)
+            cache.select_(keep)
+            active, tokens = active[keep.cpu()], tokens[keep]
+        logits = decoder.step(cache, tokens)
+    return outputs
+
+
+@torch.no_grad()
+def beam_search(decoder: UnilmDecoder, input_ids: torch.Tensor, seqlen: torch.Tensor,
+                max_target_length: int = 50, eos_token_id: int = 102,
+                num_beams: int = 4, length_penalty: float = 1.0) -> typing.List[typing.List[int]]:
+    '''
+        批量束搜索: 源文本只编码一次再复制到各束, 重排只复制已生成部分的缓存;
+        某条源文本的 num_beams 个完成假设不可能再被超过时, 其所有束从缓存中剔除.
+        假设得分为 对数概率和 / 长度 ** length_penalty, 返回每条源文本得分最高的 token id (不含 eos)
+    '''
+    n, length = input_ids.size()
+    device = input_ids.device
+    cache = decoder.new_cache(n * num_beams, length, max_target_length)
+    first = torch.arange(n, device=device) * num_beams
+    logits = decoder.prefill(cache, input_ids, seqlen, slots=first)
+    cache.copy_(first.repeat_interleave(num_beams), torch.arange(n * num_beams, device=device))
+    log_probs = torch.log_softmax(logits.float(), dim=-1).repeat_interleave(num_beams, dim=0)
+
+    # 初始时各束相同, 只从第一束展开
+    beam_scores = torch.zeros(n, num_beams, device=device)
+    beam_scores[:, 1:] = float('-inf')
+    sequences = torch.zeros((n * num_beams, 0), dtype=torch.long, device=device)
+    hyps = [[] for _ in range(n)]
+    active = list(range(n))
+
+    def add_hyp(row, tokens, score):
+        hyps[row].append((score / max(len(tokens), 1) ** length_penalty, tokens))
+        hyps[row].sort(key=lambda x: x[0], reverse=True)
+        del hyps[row][num_beams:]
+
+    for t in range(max_target_length):
+        vocab_size = log_probs.size(-1)
+        num = len(active)
+        scores = (log_probs.view(num, num_beams, vocab_size) + beam_scores.unsqueeze(-1)).view(num, -1)
+        top_scores, top_ids = torch.topk(scores, 2 * num_beams, dim=1)
+        top_scores, top_ids = top_scores.tolist(), top_ids.tolist()
+        last_step = t == max_target_length - 1
+
+        next_scores, next_tokens, parents, keep = [], [], [], []
+        for i, row in enumerate(active):
+            chosen = []
+            for rank, (score, idx) in enumerate(zip(top_scores[i], top_ids[i])):
+                beam, token = i * num_beams + idx // vocab_size, idx % vocab_size
+                if token == eos_token_id:
+                    if rank < num_beams:
+                        add_hyp(row, sequences[beam].tolist(), score)
+                elif score != float('-inf'):
+                    chosen.append((score, beam, token))
+                if len(chosen) == num_beams:
+                    break
+            if last_step:
+                for score, beam, token in chosen:
+                    add_hyp(row, sequences[beam].tolist() + [token], score)
+                continue
+            done = len(chosen) < num_beams or (len(hyps[row]) == num_beams and
+                                               chosen[0][0] / (t + 1) ** length_penalty <= hyps[row][-1][0])
+            if done:
+                continue
+            keep.append(i)
+            for score, beam, token in chosen:
+                next_scores.append(score)
+                next_tokens.append(token)
+                parents.append(beam)
+        if not keep:
+            break
+
+        parents = torch.tensor(parents, dtype=torch.long, device=device)
+        next_tokens = torch.tensor(next_tokens, dtype=torch.long, device=device)
+        if len(keep) == num:
+            cache.reorder_target_(parents)
+        else:
+            cache.select_(parents)
+            active = [active[i] for i in keep]
+        sequences = torch.cat([sequences[parents], next_tokens.unsqueeze(1)], dim=1)
+        beam_scores = torch.tensor(next_scores, device=device).view(len(active), num_beams)
+        log_probs = torch.log_softmax(decoder.step(cache, next_tokens).float(), dim=-1)
+    return [h[0][1] if h else [] for h in hyps]
+
+
+def unilm_generate(decoder: UnilmDecoder, input_ids: torch.Tensor, seqlen: torch.Tensor,
+                   max_target_length: int = 50, eos_token_id: int = 102,
+                   num_beams: int = 1, do_sample: bool = False, **kwargs) -> typing.List[typing.List[int]]:
+    '''
+        num_beams > 1 时束搜索, 否则贪心或采样 (do_sample)
+    '''
+    if num_beams > 1:
+        return beam_search(decoder, input_ids, seqlen, max_target_length=max_target_length,
+                           eos_token_id=eos_token_id, num_beams=num_beams, **kwargs)
+    return sample_search(decoder, input_ids, seqlen, max_target_length=max_target_length,
+                         eos_token_id=eos_token_id, do_sample=do_sample, **kwargs)
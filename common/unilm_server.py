@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+# @Time    : 2023/1/20 15:30
+# @Author  : tk
+# @FileName: unilm_server.py
+import asyncio
+import json
+import typing
+
+import torch
+
+from .unilm_generate import UnilmDecoder, top_k_top_p_filtering
+
+__all__ = [
+    'UnilmServer',
+    'serve_http',
+]
+
+
+class _Request:
+    def __init__(self, input_ids: typing.List[int], max_new_tokens: int,
+                 do_sample: bool, top_k: int, top_p: float, temperature: float):
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.do_sample = do_sample
+        self.top_k = top_k
+        self.top_p = top_p
+        self.temperature = temperature
+        self.tokens = asyncio.Queue()
+        self.slot = -1
+        self.last_token = -1
+        self.num_generated = 0
+        self.cancelled = False
+        self.error = None
+
+
+class UnilmServer:
+    '''
+        连续批处理的 UniLM 生成服务: 请求进入 asyncio 队列, 调度循环每个解码步之前把等待的请求编码 (prefill) 进空闲槽位,
+        所有运行中的序列一起执行一步增量解码, 序列结束后立即释放槽位给新的请求.
+        键值缓存为固定 num_slots 个槽位的缓存池 (显存有界), 没有空闲槽位时请求在队列中等待.
+        stream 按 token 逐个返回, 模型计算在线程中执行, 不阻塞事件循环
+    '''
+    def __init__(self, decoder: UnilmDecoder, num_slots: int = 16,
+                 max_source_length: int = 462, max_target_length: int = 50,
+                 eos_token_id: int = 102, max_queue_size: int = 0):
+        self.decoder = decoder
+        self.cache = decoder.new_cache(num_slots, max_source_length, max_target_length)
+        self.device = self.cache.src_len.device
+        self.eos_token_id = eos_token_id
+        self.max_queue_size = max_queue_size
+        self.free_slots = list(range(num_slots - 1, -1, -1))
+        self.running = []
+        self.queue = None
+        self._task = None
+
+    @property
+    def max_source_length(self):
+        return self.cache.max_source_length
+
+    @property
+    def max_target_length(self):
+        return self.cache.max_target_length
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue_size)
+        self._task = asyncio.create_task(self._schedule())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def stream(self, input_ids: typing.List[int], max_new_tokens: typing.Optional[int] = None,
+                     do_sample: bool = False, top_k: int = 0, top_p: float = 1.0, temperature: float = 1.0):
+        '''
+            input_ids 为 [CLS] text [SEP], 逐个产出生成的 token id (不含 eos)
+        '''
+        if not 0 < len(input_ids) <= self.max_source_length:
+            raise ValueError('source length must be in (0, {}]'.format(self.max_source_length))
+        max_new_tokens = min(max_new_tokens or self.max_target_length, self.max_target_length)
+        request = _Request(list(input_ids), max_new_tokens, do_sample, top_k, top_p, temperature)
+        await self.queue.put(request)
+        try:
+            while True:
+                token = await request.tokens.get()
+                if token is None:
+                    break
+                yield token
+            if request.error is not None:
+                raise request.error
+        finally:
+            # 客户端提前结束时, 调度循环在下一步释放槽位
+            request.cancelled = True
+
+    async def generate(self, input_ids: typing.List[int], **kwargs) -> typing.List[int]:
+        return [token async for token in self.stream(input_ids, **kwargs)]
+
+    def _admit(self, first: typing.Optional[_Request] = None) -> typing.List[_Request]:
+        admitted = []
+        while self.free_slots and (first is not None or not self.queue.empty()):
+            request = first if first is not None else self.queue.get_nowait()
+            first = None
+            if request.cancelled:
+                continue
+            request.slot = self.free_slots.pop()
+            admitted.append(request)
+        return admitted
+
+    def _prefill(self, requests: typing.List[_Request]):
+        length = max(len(r.input_ids) for r in requests)
+        input_ids = torch.zeros((len(requests), length), dtype=torch.long)
+        for i, r in enumerate(requests):
+            input_ids[i, :len(r.input_ids)] = torch.tensor(r.input_ids, dtype=torch.long)
+        seqlen = torch.tensor([len(r.input_ids) for r in requests], dtype=torch.long)
+        slots = torch.tensor([r.slot for r in requests], dtype=torch.long, device=self.device)
+        logits = self.decoder.prefill(self.cache, input_ids.to(self.device), seqlen.to(self.device), slots=slots)
+        return self._pick(requests, logits)
+
+    def _step(self, requests: typing.List[_Request]):
+        input_ids = torch.tensor([r.last_token for r in requests], dtype=torch.long, device=self.device)
+        slots = torch.tensor([r.slot for r in requests], dtype=torch.long, device=self.device)
+        logits = self.decoder.step(self.cache, input_ids, slots=slots)
+        return self._pick(requests, logits)
+
+    @staticmethod
+    def _pick(requests: typing.List[_Request], logits: torch.Tensor) -> typing.List[int]:
+        tokens = torch.argmax(logits, dim=-1).tolist()
+        for i, r in enumerate(requests):
+            if r.do_sample:
+                row = top_k_top_p_filtering(logits[i: i + 1].float() / r.temperature, top_k=r.top_k, top_p=r.top_p)
+                tokens[i] = int(torch.multinomial(torch.softmax(row, dim=-1), 1))
+        return tokens
+
+    def _finish(self, request: _Request, error: typing.Optional[BaseException] = None):
+        if request.slot < 0:
+            return
+        request.error = error
+        request.tokens.put_nowait(None)
+        self.free_slots.append(request.slot)
+        request.slot = -1
+
+    def _emit(self, requests: typing.List[_Request], tokens: typing.List[int]):
+        for r, token in zip(requests, tokens):
+            if r.cancelled or token == self.eos_token_id:
+                self._finish(r)
+                continue
+            r.tokens.put_nowait(token)
+            r.last_token = token
+            r.num_generated += 1
+            if r.num_generated >= r.max_new_tokens:
+                self._finish(r)
+            else:
+                self.running.append(r)
+
+    async def _schedule(self):
+        while True:
+            first = None
+            if not self.running and self.queue.empty():
+                # 空闲时等待新请求
+                first = await self.queue.get()
+            requests = []
+            try:
+                requests = self._admit(first)
+                if requests:
+                    tokens = await asyncio.to_thread(self._prefill, requests)
+                    self._emit(requests, tokens)
+                requests, self.running = self.running, []
+                if requests:
+                    tokens = await asyncio.to_thread(self._step, requests)
+                    self._emit(requests, tokens)
+            except Exception as e:
+                for r in requests + self.running:
+                    self._finish(r, e)
+                self.running = []
+            await asyncio.sleep(0)
+
+
+# HTTP 接口允许的生成参数及类型
+_HTTP_PARAMS = {
+    'max_new_tokens': int,
+    'do_sample': bool,
+    'top_k': int,
+    'top_p': float,
+    'temperature': float,
+}
+
+
+def _parse_http_request(body: bytes):
+    '''
+        解析并校验 /generate 请求体, 返回 (text, params), 参数错误时抛出 ValueError
+    '''
+    try:
+        params = json.loads(body.decode('utf-8'))
+    except (UnicodeDecodeError, ValueError):
+        raise ValueError('request body must be a json object')
+    if not isinstance(params, dict):
+        raise ValueError('request body must be a json object')
+    text = params.pop('text', None)
+    if not isinstance(text, str) or not text.strip():
+        raise ValueError('text must be a non-empty string')
+    for k, v in params.items():
+        if k not in _HTTP_PARAMS:
+            raise ValueError('unknown parameter {}, expected one of {}'.format(k, list(_HTTP_PARAMS)))
+        t = _HTTP_PARAMS[k]
+        # bool 是 int 的子类, 需要单独排除; float 参数接受整数
+        if isinstance(v, bool) != (t is bool) or not isinstance(v, (int, float) if t is float else t):
+            raise ValueError('{} must be {}'.format(k, t.__name__))
+    if params.get('max_new_tokens', 1) <= 0 or params.get('top_k', 0) < 0:
+        raise ValueError('max_new_tokens must be > 0 and top_k >= 0')
+    if not 0 < params.get('top_p', 1.0) <= 1 or params.get('temperature', 1.0) <= 0:
+        raise ValueError('top_p must be in (0, 1] and temperature > 0')
+    return text, params
+
+
+async def serve_http(server: UnilmServer, tokenizer, host: str = '0.0.0.0', port: int = 8080):
+    '''
+        最简 HTTP 接口: POST /generate {"text": ..., "max_new_tokens": ..., "do_sample": ..., "top_k": ..., "top_p": ..., "temperature": ...}
+        以 chunked 方式逐行返回 {"token": id, "text": piece}, 最后一行为 {"title": ...};
+        请求错误在写出响应头之前返回 400 {"error": ...}, 开始返回后出错时最后一行为 {"error": ...}
+    '''
+    def write_response(writer: asyncio.StreamWriter, status: str, obj=None):
+        data = json.dumps(obj, ensure_ascii=False).encode('utf-8') if obj is not None else b''
+        writer.write(('HTTP/1.1 {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                      'Connection: close\r\n\r\n'.format(status, len(data))).encode('latin-1') + data)
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        stream = None
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                k, _, v = line.partition(':')
+                headers[k.strip().lower()] = v.strip()
+            if len(request_line) < 2 or request_line[0] != 'POST' or request_line[1] != '/generate':
+                write_response(writer, '404 Not Found')
+                return
+            try:
+                content_length = int(headers.get('content-length', 0))
+                if content_length < 0:
+                    raise ValueError
+            except ValueError:
+                write_response(writer, '400 Bad Request', {'error': 'invalid content-length'})
+                return
+            body = await reader.readexactly(content_length)
+            try:
+                text, params = _parse_http_request(body)
+            except ValueError as e:
+                write_response(writer, '400 Bad Request', {'error': str(e)})
+                return
+            input_ids = tokenizer.encode(text, max_length=server.max_source_length, truncation=True)
+
+            # 取到第一个 token 之后再写响应头, 参数与长度错误返回 400, 生成出错返回 500
+            stream = server.stream(input_ids, **params)
+            try:
+                first = [await stream.__anext__()]
+            except StopAsyncIteration:
+                first = []
+            except ValueError as e:
+                write_response(writer, '400 Bad Request', {'error': str(e)})
+                return
+            except Exception as e:
+                write_response(writer, '500 Internal Server Error', {'error': str(e)})
+                return
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson\r\n'
+                         b'Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n')
+
+            def write_chunk(obj):
+                data = (json.dumps(obj, ensure_ascii=False) + '\n').encode('utf-8')
+                writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+
+            async def tokens_iter():
+                for token in first:
+                    yield token
+                async for token in stream:
+                    yield token
+
+            tokens = []
+            try:
+                async for token in tokens_iter():
+                    tokens.append(token)
+                    write_chunk({'token': token, 'text': tokenizer.decode([token])})
+                    await writer.drain()
+                write_chunk({'title': tokenizer.decode(tokens, skip_special_tokens=True).replace(' ', '')})
+            except (ConnectionError, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                write_chunk({'error': str(e)})
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if stream is not None:
+                # 释放槽位
+                await stream.aclose()
+            writer.close()
+
+    await server.start()
+    http_server = await asyncio.start_server(handle, host, port)
+    async with http_server:
+        await http_server.serve_forever()
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -17,6 +19,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -55,18 +61,12 @@ class NN_DataHelper(DataHelper):
 
         o = tokenizer(sentence, max_length=max_seq_length, truncation=True, add_special_tokens=True, )
         input_ids = np.asarray(o['input_ids'], dtype=np.int64)
-        attention_mask = np.asarray(o['attention_mask'], dtype=np.int64)
 
         labels = np.asarray(label2id[label_str] if label_str is not None else 0, dtype=np.int64)
         seqlen = np.asarray(len(input_ids), dtype=np.int64)
-        pad_len = max_seq_length - len(input_ids)
-        if pad_len > 0:
-            pad_val = tokenizer.pad_token_id
-            input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_val, pad_val))
-            attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
+        # 按真实长度存储, attention_mask 与补齐在 collate_fn 中按 batch 生成
         d = {
             'input_ids': input_ids,
-            'attention_mask': attention_mask,
             'labels': labels,
             'seqlen': seqlen
         }
@@ -107,24 +107,7 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        return o
+        return collate_with_seqlen(batch, with_attention_mask=True)
 
 
 class MyTransformer(TransformerForSequenceClassification, with_pl=True):
@@ -172,6 +155,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self, *args, **kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args, **kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
             self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -179,17 +163,14 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         # 当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,
-                                   collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         config = pl_module.config
 
         y_preds, y_trues = [], []
-        for i, batch in tqdm(enumerate(eval_datasets), total=len(eval_datasets), desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i, batch in tqdm(eval_datasets, total=len(eval_datasets), desc='evalute'):
             o = pl_module.validation_step(batch, i)
 
             preds, labels = o['outputs']
@@ -198,14 +179,19 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
                 y_preds.append(p)
                 y_trues.append(int(l))
 
-        y_preds = np.asarray(y_preds, dtype=np.int32)
-        y_trues = np.asarray(y_trues, dtype=np.int32)
-        f1 = f1_score(y_trues, y_preds, average='micro')
-        report = classification_report(y_trues, y_preds, digits=4,
-                                       labels=list(config.label2id.values()),
-                                       target_names=list(config.label2id.keys()))
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            y_preds = np.asarray(y_preds, dtype=np.int32)
+            y_trues = np.asarray(y_trues, dtype=np.int32)
+            f1 = f1_score(y_trues, y_preds, average='micro')
+            report = classification_report(y_trues, y_preds, digits=4,
+                                           labels=list(config.label2id.values()),
+                                           target_names=list(config.label2id.keys()))
 
-        print(f1, report)
+            print(f1, report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -219,7 +205,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor="val_f1", every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor="val_f1", every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -2,6 +2,8 @@
 # @Time    : 2022/12/23 15:45
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -18,6 +20,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.corpus import iter_jsonl, make_dataset_with_stream
+from common.collate import collate_with_seqlen, encode_points, points_target_len, pad_points
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -71,12 +78,6 @@ class NN_DataHelper(DataHelper):
         input_ids = np.asarray(input_ids, dtype=np.int32)
         attention_mask = np.asarray(attention_mask, dtype=np.int32)
 
-        max_target_len1 = 64
-        max_target_len2 = 512
-        entity_labels = np.zeros(shape=(len(label2id), max_target_len1, 2), dtype=np.int32)
-        head_labels = np.zeros(shape=(1, max_target_len2, 2), dtype=np.int32)
-        tail_labels = np.zeros(shape=(1, max_target_len2, 2), dtype=np.int32)
-
         entity_labels_tmp = [set() for _ in range(len(label2id))]
         head_labels_tmp = [set() for _ in range(1)]
         tail_labels_tmp = [set() for _ in range(1)]
@@ -110,35 +111,19 @@ class NN_DataHelper(DataHelper):
                         tail_labels_tmp[0].add((min(t1, t2), max(t1, t2)))
             real_label.append(true_event)
 
-        def feed_label(x, pts_list):
-            tlens = [1]
-            for p, pts in enumerate(pts_list):
-                tlens.append(len(pts))
-                for seq, pos in enumerate(pts):
-                    x[p][seq][0] = pos[0]
-                    x[p][seq][1] = pos[1]
-            return np.max(tlens)
-
-        targetlen1 = feed_label(entity_labels, list(map(lambda x: list(x), entity_labels_tmp)))
-        targetlen2 = feed_label(head_labels, list(map(lambda x: list(x), head_labels_tmp)))
-        targetlen3 = feed_label(tail_labels, list(map(lambda x: list(x), tail_labels_tmp)))
-
-        targetlen1 = np.asarray(targetlen1, dtype=np.int32)
-        targetlen2 = np.asarray(np.max([targetlen2, targetlen3]), dtype=np.int32)
         pad_len = max_seq_length - len(input_ids)
         if pad_len > 0:
             pad_val = tokenizer.pad_token_id
             input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_val, pad_val))
             attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
+        # 只存储真实的 (class, x, y) 点, collate_fn 中按 batch 还原
         d = {
             'input_ids': input_ids,
             'attention_mask': attention_mask,
-            'entity_labels': entity_labels,
-            'head_labels': head_labels,
-            'tail_labels': tail_labels,
+            'entity_labels': encode_points(entity_labels_tmp),
+            'head_labels': encode_points(head_labels_tmp),
+            'tail_labels': encode_points(tail_labels_tmp),
             'seqlen': seqlen,
-            'targetlen1': targetlen1,
-            'targetlen2': targetlen2,
         }
 
         if self.index < 5:
@@ -165,69 +150,49 @@ class NN_DataHelper(DataHelper):
         labels = sorted(labels)
         label2id = {label: i for i, label in enumerate(labels)}
         id2label = {i: label for i, label in enumerate(labels)}
+        NN_DataHelper.label2id = label2id
+        NN_DataHelper.id2label = id2label
         return label2id, id2label
 
     # 读取文件
     def on_get_corpus(self, files: typing.List, mode: str):
-        D = []
-        for filename in files:
-            with open(filename, mode='r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    jd = json.loads(line)
-                    if not jd:
-                        continue
-
-                    text: str = jd['text']
-                    events_label = []
-                    event_list = jd.get('event_list', None)
-                    try:
-                        if event_list is not None:
-                            for e in event_list:
-                                event = []
-                                etype = e['event_type']
-                                role = '触发词'
-                                argument = e['trigger']
-                                index = e['trigger_start_index']
-                                event.append((etype + '+' + role, index, index + len(argument) - 1))
-                                for a in e['arguments']:
-                                    role = a['role']
-                                    argument = a['argument']
-                                    index = a['argument_start_index']
-                                    event.append((etype + '+' + role,index,index + len(argument) - 1))
-                                events_label.append(event)
-
-                        else:
-                            events_label = None
-                        D.append((text, events_label))
-                    except Exception as e:
-                        print(e)
-        return D
+        for jd in iter_jsonl(files):
+            text: str = jd['text']
+            events_label = []
+            event_list = jd.get('event_list', None)
+            try:
+                if event_list is not None:
+                    for e in event_list:
+                        event = []
+                        etype = e['event_type']
+                        role = '触发词'
+                        argument = e['trigger']
+                        index = e['trigger_start_index']
+                        event.append((etype + '+' + role, index, index + len(argument) - 1))
+                        for a in e['arguments']:
+                            role = a['role']
+                            argument = a['argument']
+                            index = a['argument_start_index']
+                            event.append((etype + '+' + role,index,index + len(argument) - 1))
+                        events_label.append(event)
+
+                else:
+                    events_label = None
+                yield text, events_label
+            except Exception as e:
+                print(e)
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        max_tarlen1 = torch.max(o.pop('targetlen1'))
-        max_tarlen2 = torch.max(o.pop('targetlen2'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['entity_labels'] = o['entity_labels'][:, :, :max_tarlen1]
-        o['head_labels'] = o['head_labels'][:, :, :max_tarlen2]
-        o['tail_labels'] = o['tail_labels'][:, :, :max_tarlen2]
+        label_keys = ('entity_labels', 'head_labels', 'tail_labels')
+        o = collate_with_seqlen([{k: v for k, v in b.items() if k not in label_keys} for b in batch])
+        points = {k: [b[k] for b in batch] for k in label_keys}
+        num_classes = len(NN_DataHelper.label2id)
+        o['entity_labels'] = pad_points(points['entity_labels'], num_classes)
+        # head / tail 共用长度
+        max_tarlen2 = max(points_target_len(points['head_labels'], 1), points_target_len(points['tail_labels'], 1))
+        o['head_labels'] = pad_points(points['head_labels'], 1, max_tarlen2)
+        o['tail_labels'] = pad_points(points['tail_labels'], 1, max_tarlen2)
         return o
 
 
@@ -242,6 +207,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -249,18 +215,16 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         eval_labels = pl_module.eval_labels
         config = pl_module.config
 
         threshold = 0
         y_preds, y_trues = [], []
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
 
             logits1, logits2, logits3, _, _, _ = o['outputs']
@@ -274,13 +238,18 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
             y_preds.extend(p_spoes)
             y_trues.extend(t_spoes)
 
-        print(y_preds[:3])
-        print(y_trues[:3])
-        e_f1, e_pr, e_rc, a_f1, a_pr, a_rc = evaluate_events(y_trues, y_preds, config.id2label)
-        print('[event level]', '精确率 召回率 f1', e_pr, e_rc,e_f1)
-        print('[argument level]','精确率 召回率 f1', a_pr, a_rc,a_f1 )
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            print(y_preds[:3])
+            print(y_trues[:3])
+            e_f1, e_pr, e_rc, a_f1, a_pr, a_rc = evaluate_events(y_trues, y_preds, config.id2label)
+            print('[event level]', '精确率 召回率 f1', e_pr, e_rc,e_f1)
+            print('[argument level]','精确率 召回率 f1', a_pr, a_rc,a_f1 )
 
-        f1 = e_f1
+            f1 = e_f1
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -294,7 +263,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -322,22 +291,22 @@ if __name__ == '__main__':
     intermediate_name = data_args.intermediate_name + '_{}'.format(0)
     if data_args.do_train:
         dataHelper.train_files.append(
-            dataHelper.make_dataset_with_args(data_args.train_file, token_fn_args_dict['train'],
-                                              data_args,
-                                              intermediate_name=intermediate_name, shuffle=True,
-                                              mode='train'))
+            make_dataset_with_stream(dataHelper, data_args.train_file, token_fn_args_dict['train'],
+                                     data_args,
+                                     intermediate_name=intermediate_name, shuffle=True,
+                                     mode='train'))
     if data_args.do_eval:
-        dataHelper.eval_files.append(dataHelper.make_dataset_with_args(data_args.eval_file, token_fn_args_dict['eval'],
-                                                                       data_args,
-                                                                       intermediate_name=intermediate_name,
-                                                                       shuffle=False,
-                                                                       mode='eval'))
+        dataHelper.eval_files.append(make_dataset_with_stream(dataHelper, data_args.eval_file, token_fn_args_dict['eval'],
+                                                              data_args,
+                                                              intermediate_name=intermediate_name,
+                                                              shuffle=False,
+                                                              mode='eval'))
     if data_args.do_test:
-        dataHelper.test_files.append(dataHelper.make_dataset_with_args(data_args.test_file, token_fn_args_dict['test'],
-                                                                       data_args,
-                                                                       intermediate_name=intermediate_name,
-                                                                       shuffle=False,
-                                                                       mode='test'))
+        dataHelper.test_files.append(make_dataset_with_stream(dataHelper, data_args.test_file, token_fn_args_dict['test'],
+                                                              data_args,
+                                                              intermediate_name=intermediate_name,
+                                                              shuffle=False,
+                                                              mode='test'))
 
     train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
                                              process_index=trainer.global_rank, infinite=True,
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -13,12 +14,17 @@ from deep_training.nlp.models.crf_model import TransformerForCRF
 from deep_training.utils.trainer import SimpleModelCheckpoint
 from pytorch_lightning import Trainer
 from pytorch_lightning.utilities.types import EPOCH_OUTPUT
-from seqmetric.metrics import f1_score, classification_report
-from seqmetric.scheme import IOBES
-from torch.utils.data import DataLoader, IterableDataset
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.corpus import iter_jsonl, make_dataset_with_stream, make_dataset_with_shards
+from common.collate import collate_with_seqlen
+from common.sampler import make_bucket_dataloader
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+from common.seq_metric import seq_f1_report
+
 train_info_args = {
     'devices': 1,
     'data_backend':'memory_raw',
@@ -67,10 +73,7 @@ class NN_DataHelper(DataHelper):
         if len(input_ids) > max_seq_length - 2:
             input_ids = input_ids[:max_seq_length - 2]
         input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
-        attention_mask = [1] * len(input_ids)
-
         input_ids = np.asarray(input_ids, dtype=np.int64)
-        attention_mask = np.asarray(attention_mask, dtype=np.int64)
         seqlen = np.asarray(len(input_ids), dtype=np.int64)
 
         labels = np.zeros(shape=(seqlen,), dtype=np.int64)
@@ -90,24 +93,16 @@ class NN_DataHelper(DataHelper):
                     for i in range(span_len - 2):
                         labels[pt[0] + 1 + i] = label2id['I-' + label_str]
 
-        pad_len = max_seq_length - len(input_ids)
-        if pad_len > 0:
-            pad_val = tokenizer.pad_token_id
-            input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_val, pad_val))
-            attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
-            labels = np.pad(labels, (0, pad_len), 'constant', constant_values=(0, 0))
-
+        # 按真实长度存储, attention_mask 与补齐在 collate_fn 中按 batch 生成
         d = {
             'input_ids': input_ids,
-            'attention_mask': attention_mask,
             'labels': labels,
             'seqlen': seqlen,
         }
         if self.index < 5:
             print(tokens)
-            print(input_ids[:seqlen])
-            print(attention_mask[:seqlen])
-            print(labels[:seqlen])
+            print(input_ids)
+            print(labels)
             print(seqlen)
         return d
 
@@ -125,37 +120,13 @@ class NN_DataHelper(DataHelper):
 
     # 读取文件
     def on_get_corpus(self, files: typing.List, mode:str):
-        D = []
-        for filename in files:
-            with open(filename, mode='r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    jd = json.loads(line)
-                    if not jd:
-                        continue
-                    D.append((jd['text'], jd.get('label',None)))
-        return D
+        for jd in iter_jsonl(files):
+            yield jd['text'], jd.get('label',None)
 
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:,:max_len]
-        return o
+        return collate_with_seqlen(batch, seq_keys=('labels',), with_attention_mask=True)
 
 class MyTransformer(TransformerForCRF, with_pl=True):
     def __init__(self, *args,**kwargs):
@@ -165,24 +136,11 @@ class MyTransformer(TransformerForCRF, with_pl=True):
         y_preds,y_trues = [],[]
         for o in outputs:
             preds,labels = o['outputs']
-            for p,l in zip(preds,labels):
-                y_preds.append(p)
-                y_trues.append(l)
-
-        label_map = self.config.id2label
-        trues_list = [[] for _ in range(len(y_trues))]
-        preds_list = [[] for _ in range(len(y_preds))]
-
-        for i in range(len(y_trues)):
-            for j in range(len(y_trues[i])):
-                if y_trues[i][j] != self.config.pad_token_id:
-                    trues_list[i].append(label_map[y_trues[i][j]])
-                    preds_list[i].append(label_map[y_preds[i][j]])
-
+            y_preds.append(preds)
+            y_trues.append(labels)
 
-        scheme = IOBES
-        f1 = f1_score(trues_list, preds_list, average='macro', scheme=scheme)
-        report = classification_report(trues_list, preds_list, scheme=scheme, digits=4)
+        # 按批次向量化解码实体并统计, 与 seqmetric IOBES 结果一致
+        f1, report = seq_f1_report(y_trues, y_preds, self.config.id2label, ignore_id=self.config.pad_token_id)
 
         print(f1,report)
         self.log('val_f1',f1)
@@ -191,6 +149,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -198,40 +157,30 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         # eval_labels = pl_module.eval_labels
         config = pl_module.config
 
 
         y_preds, y_trues = [], []
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
 
             preds, labels = o['outputs']
-            for p, l in zip(preds, labels):
-                y_preds.append(p)
-                y_trues.append(l)
-
-        label_map = config.id2label
-        trues_list = [[] for _ in range(len(y_trues))]
-        preds_list = [[] for _ in range(len(y_preds))]
-
-        for i in range(len(y_trues)):
-            for j in range(len(y_trues[i])):
-                if y_trues[i][j] != config.pad_token_id:
-                    trues_list[i].append(label_map[y_trues[i][j]])
-                    preds_list[i].append(label_map[y_preds[i][j]])
-
-        scheme = IOBES
-        f1 = f1_score(trues_list, preds_list, average='macro', scheme=scheme)
-        report = classification_report(trues_list, preds_list, scheme=scheme, digits=4)
-        print(f1, report)
-
+            y_preds.append(preds)
+            y_trues.append(labels)
+
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            # 按批次向量化解码实体并统计, 与 seqmetric IOBES 结果一致
+            f1, report = seq_f1_report(y_trues, y_preds, config.id2label, ignore_id=config.pad_token_id)
+            print(f1, report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -247,7 +196,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor='val_f1', every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor='val_f1', every_n_epochs=1)
     trainer = Trainer(
         log_every_n_steps=10,
         callbacks=[checkpoint_callback],
@@ -275,28 +224,29 @@ if __name__ == '__main__':
     # 缓存数据集
     intermediate_name = data_args.intermediate_name + '_{}'.format(0)
     if data_args.do_train:
-        dataHelper.train_files.append(dataHelper.make_dataset_with_args(data_args.train_file, token_fn_args_dict['train'],
-                                                                   data_args,
-                                                                   intermediate_name=intermediate_name, shuffle=True,
-                                                                   mode='train'))
+        dataHelper.train_files.extend(make_dataset_with_shards(dataHelper, data_args.train_file, token_fn_args_dict['train'],
+                                                                data_args,
+                                                                intermediate_name=intermediate_name, shuffle=True,
+                                                                mode='train', num_process_worker=os.cpu_count()))
     if data_args.do_eval:
-        dataHelper.eval_files.append(dataHelper.make_dataset_with_args(data_args.eval_file, token_fn_args_dict['eval'],
-                                                                  data_args,
-                                                                  intermediate_name=intermediate_name, shuffle=False,
-                                                                  mode='eval'))
+        dataHelper.eval_files.append(make_dataset_with_stream(dataHelper, data_args.eval_file, token_fn_args_dict['eval'],
+                                                              data_args,
+                                                              intermediate_name=intermediate_name, shuffle=False,
+                                                              mode='eval'))
     if data_args.do_test:
-        dataHelper.test_files.append(dataHelper.make_dataset_with_args(data_args.test_file, token_fn_args_dict['test'],
-                                                                  data_args,
-                                                                  intermediate_name=intermediate_name, shuffle=False,
-                                                                  mode='test'))
+        dataHelper.test_files.append(make_dataset_with_stream(dataHelper, data_args.test_file, token_fn_args_dict['test'],
+                                                              data_args,
+                                                              intermediate_name=intermediate_name, shuffle=False,
+                                                              mode='test'))
 
     train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
                                              process_index=trainer.global_rank, infinite=True,
                                              with_record_iterable_dataset=True)
     if train_datasets is not None:
-        train_datasets = DataLoader(train_datasets, batch_size=training_args.train_batch_size,
-                                        collate_fn=dataHelper.collate_fn,
-                                        shuffle=False if isinstance(train_datasets, IterableDataset) else True)
+        # 长度分桶, 相近长度的样本组成 batch; 也可用 max_tokens 指定每个 batch 的 token 预算
+        train_datasets = make_bucket_dataloader(train_datasets, collate_fn=dataHelper.collate_fn,
+                                                batch_size=training_args.train_batch_size,
+                                                num_replicas=trainer.world_size, rank=trainer.global_rank)
 
 
 
@@ -306,6 +256,7 @@ if __name__ == '__main__':
 
     if train_datasets is not None:
         trainer.fit(model, train_dataloaders=train_datasets)
+        logging.info(str(train_datasets.bucket_stats))
     else:
         eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
         test_datasets = dataHelper.load_dataset(dataHelper.test_files)
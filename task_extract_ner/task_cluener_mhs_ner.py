@@ -2,6 +2,8 @@
 import copy
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -20,6 +22,9 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend':'memory_raw',
@@ -214,6 +219,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -221,9 +227,9 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         top_n = 1
         threshold = 1e-8
@@ -232,9 +238,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
 
 
         y_preds, y_trues = [], []
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
 
             logits, _ = o['outputs']
@@ -242,13 +246,17 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
             bs = len(logits)
             y_trues.extend(eval_labels[i * bs: (i + 1) * bs])
 
-        print(y_preds[:3])
-        print(y_trues[:3])
-
-        f1, str_report = metric_for_pointer(y_trues, y_preds, config.label2id)
-        print(f1)
-        print(str_report)
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            print(y_preds[:3])
+            print(y_trues[:3])
 
+            f1, str_report = metric_for_pointer(y_trues, y_preds, config.label2id)
+            print(f1)
+            print(str_report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -263,7 +271,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor='val_f1', every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor='val_f1', every_n_epochs=1)
     trainer = Trainer(
         log_every_n_steps=10,
         callbacks=[checkpoint_callback],
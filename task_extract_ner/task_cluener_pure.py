@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 #参考 https://github.com/princeton-nlp/PURE
-import copy
 import json
 import logging
+import os
+import sys
 import typing
+from functools import lru_cache
 
 import numpy as np
 import torch
@@ -18,6 +20,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -52,6 +58,20 @@ train_info_args = {
 }
 
 
+@lru_cache(maxsize=64)
+def get_span_table(max_len, max_span_length):
+    '''
+        按 (max_len, max_span_length) 缓存 span 枚举表, 顺序与逐个 (i, j) 枚举一致
+        返回 spans [n, 3] (i, j, j-i+1) 与 offsets [max_len], (i, j) 在表中的位置为 offsets[i] + j - i
+    '''
+    widths = np.minimum(max_span_length, max_len - np.arange(max_len))
+    offsets = np.concatenate([[0], np.cumsum(widths)[:-1]])
+    starts = np.repeat(np.arange(max_len), widths)
+    ends = starts + np.arange(widths.sum()) - np.repeat(offsets, widths)
+    spans = np.stack([starts, ends, ends - starts + 1], axis=1).astype(np.int32)
+    return torch.from_numpy(spans), offsets
+
+
 class NN_DataHelper(DataHelper):
     index = -1
     eval_labels = []
@@ -153,62 +173,27 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-
-        labels_fakes = []
-        for i, b in enumerate(batch):
-            b = copy.copy(b)
-            labels = b.pop('labels',None)
-            labels_fakes.append(labels)
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-
+        labels_fakes = [b.get('labels', None) for b in batch]
+        o = collate_with_seqlen([{k: v for k, v in b.items() if k != 'labels'} for b in batch], pop_seqlen=False)
         seqlens = o.pop('seqlen')
-        max_len = torch.max(seqlens)
-        tokens_len = max_len
-        max_span_length = NN_DataHelper.max_span_length if NN_DataHelper.max_span_length > 0 else tokens_len
-        max_span_length = min(max_span_length,tokens_len)
-
-        labels = []
-        spans = []
-        spans_mask = []
-        has_label = labels_fakes[0] is not None
-        #
-        for labels_fake,seqlen in zip(labels_fakes,seqlens):
-            if has_label:
-                labels_map = {tuple(ldata[1:]): ldata[0] for ldata in labels_fake}
-            label,span,span_mask = [],[],[]
-            for i in range(tokens_len):
-                for j in range(i,min(i+max_span_length,tokens_len)):
-                    span.append((i,j,j-i + 1))
-                    span_mask.append(1 if i < seqlen and j < seqlen else 0)
-                    if has_label:
-                        label.append(labels_map.get((i,j),0))
-            if has_label:
-                labels.append(label)
-            spans.append(span)
-            spans_mask.append(span_mask)
-
-        spans = torch.tensor(spans,dtype=torch.int32)
-        spans_mask = torch.tensor(spans_mask,dtype=torch.int32)
-        labels = torch.tensor(labels,dtype=torch.int32)
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-
-        o['spans'] = spans
-        o['spans_mask'] = spans_mask
-        if has_label:
-            o['labels'] = labels
+        bs, max_len = o['input_ids'].size()
+        max_span_length = NN_DataHelper.max_span_length if NN_DataHelper.max_span_length > 0 else max_len
+        max_span_length = min(max_span_length, max_len)
+
+        span_table, offsets = get_span_table(max_len, max_span_length)
+        o['spans'] = span_table.unsqueeze(0).repeat(bs, 1, 1)
+        o['spans_mask'] = (span_table[:, 1].unsqueeze(0) < seqlens.unsqueeze(1)).int()
+
+        if labels_fakes[0] is not None:
+            # gold span 一次 scatter 到 span 表中的位置
+            gold = [np.asarray(l, dtype=np.int64).reshape(-1, 3) for l in labels_fakes]
+            bids = np.concatenate([np.full(len(g), i, dtype=np.int64) for i, g in enumerate(gold)])
+            gold = np.concatenate(gold)
+            keep = (gold[:, 2] - gold[:, 1] < max_span_length) & (gold[:, 2] < max_len)
+            bids, gold = bids[keep], gold[keep]
+            labels = np.zeros((bs, len(span_table)), dtype=np.int32)
+            labels[bids, offsets[gold[:, 1]] + gold[:, 2] - gold[:, 1]] = gold[:, 0]
+            o['labels'] = torch.from_numpy(labels)
         return o
 
 
@@ -223,6 +208,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self, *args, **kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args, **kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
             self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -230,28 +216,30 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         # 当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,
-                                   collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
 
         eval_labels = pl_module.eval_labels
         config = pl_module.config
 
         y_preds, y_trues = [], []
-        for i, batch in tqdm(enumerate(eval_datasets), total=len(eval_datasets), desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i, batch in tqdm(eval_datasets, total=len(eval_datasets), desc='evalute'):
             o = pl_module.validation_step(batch, i)
             logits,spans,spans_mask, _ = o['outputs']
             y_preds.extend(extract_lse([logits,spans,spans_mask]))
             bs = len(logits)
             y_trues.extend(eval_labels[i * bs: (i + 1) * bs])
 
-        f1, str_report = metric_for_pointer(y_trues, y_preds, config.label2id)
-        print(f1)
-        print(str_report)
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            f1, str_report = metric_for_pointer(y_trues, y_preds, config.label2id)
+            print(f1)
+            print(str_report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1', -np.inf)
         print('current', f1, 'best', best_f1)
@@ -265,7 +253,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments,PureModelArguments))
     model_args, training_args, data_args,puremodel_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor='val_f1', every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor='val_f1', every_n_epochs=1)
     trainer = Trainer(
         log_every_n_steps=10,
         callbacks=[checkpoint_callback],
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -18,6 +20,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices':  1,
     'data_backend': 'memory_raw',
@@ -62,25 +68,70 @@ train_info_args = {
 }
 
 
+# 相对距离 -> 距离桶
+dis2idx = np.zeros((1000), dtype='int64')
+dis2idx[1] = 1
+dis2idx[2:] = 2
+dis2idx[4:] = 3
+dis2idx[8:] = 4
+dis2idx[16:] = 5
+dis2idx[32:] = 6
+dis2idx[64:] = 7
+dis2idx[128:] = 8
+dis2idx[256:] = 9
+
+
+def make_dist_table(size):
+    '''
+        [size, size] 距离桶表, 样本的 dist_inputs 为左上角 [seqlen, seqlen] 切片
+        i > j: dis2idx[i - j], i < j: dis2idx[j - i] + 9, i == j: 19
+    '''
+    dist = np.arange(size)[:, None] - np.arange(size)[None, :]
+    table = np.where(dist < 0, dis2idx[np.abs(dist)] + 9, dis2idx[np.abs(dist)]).astype(np.int32)
+    table[dist == 0] = 19
+    return table
+
+
+# 按最大的 max_seq_length 构建一次, 各 batch 取 [:max_len, :max_len]
+dist_table = make_dist_table(max(train_info_args['train_max_seq_length'],
+                                 train_info_args['eval_max_seq_length'],
+                                 train_info_args['test_max_seq_length']))
+
+
+def build_w2ner_grids(entity_labels, seqlens, max_len):
+    '''
+        由实体三元组 (l, s, e) 与 seqlen 生成 labels / pieces2word / dist_inputs / grid_mask2d 四个 [bs, L, L] 网格
+    '''
+    bs = len(seqlens)
+    seqlens = np.asarray(seqlens, dtype=np.int64).reshape(-1)
+    idx = np.arange(max_len)
+    valid = idx[None, :] < seqlens[:, None]
+    grid_mask2d = valid[:, :, None] & valid[:, None, :]
+    dist_inputs = np.where(grid_mask2d, dist_table[None, :max_len, :max_len], 0).astype(np.int32)
+    pieces2word = np.zeros((bs, max_len, max_len), dtype=bool)
+    pieces2word[:, idx[:-1], idx[1:]] = idx[None, :-1] < seqlens[:, None] - 1
+
+    grid_labels = np.zeros((bs, max_len, max_len), dtype=np.int32)
+    for i, entities in enumerate(entity_labels):
+        entities = np.asarray(entities, dtype=np.int64).reshape(-1, 3)
+        if len(entities) == 0:
+            continue
+        l, s, e = entities.T
+        width = int((e - s).max())
+        grid_labels[i, idx[:width], idx[1:width + 1]] = 1
+        grid_labels[i, e, s] = l + 2
+    return {
+        'labels': torch.from_numpy(grid_labels),
+        'pieces2word': torch.from_numpy(pieces2word),
+        'dist_inputs': torch.from_numpy(dist_inputs),
+        'grid_mask2d': torch.from_numpy(grid_mask2d),
+    }
+
+
 class NN_DataHelper(DataHelper):
     index = -1
     eval_labels = []
 
-    def __init__(self, *args, **kwargs):
-        super(NN_DataHelper, self).__init__(*args, **kwargs)
-        dis2idx = np.zeros((1000), dtype='int64')
-        dis2idx[1] = 1
-        dis2idx[2:] = 2
-        dis2idx[4:] = 3
-        dis2idx[8:] = 4
-        dis2idx[16:] = 5
-        dis2idx[32:] = 6
-        dis2idx[64:] = 7
-        dis2idx[128:] = 8
-        dis2idx[256:] = 9
-
-        self.dis2idx = dis2idx
-
     # 切分成开始
     def on_data_ready(self):
         self.index = -1
@@ -98,34 +149,13 @@ class NN_DataHelper(DataHelper):
         if len(input_ids) > max_seq_length - 2:
             input_ids = input_ids[:max_seq_length - 2]
         input_ids = [tokenizer.cls_token_id] + input_ids + [tokenizer.sep_token_id]
-        attention_mask = [1] * len(input_ids)
 
         input_ids = np.asarray(input_ids, dtype=np.int32)
-        attention_mask = np.asarray(attention_mask, dtype=np.int32)
         seqlen = np.asarray(len(input_ids), dtype=np.int32)
 
+        # 只存储实体三元组, 网格在 collate_fn 中生成
+        labels = []
         real_label = []
-        length = len(input_ids)
-        grid_labels = np.zeros((length, length), dtype=np.int32)
-        pieces2word = np.zeros((length, length), dtype=bool)
-        dist_inputs = np.zeros((length, length), dtype=np.int32)
-        grid_mask2d = np.ones((length, length), dtype=bool)
-
-        for i in range(seqlen - 1):
-            for j in range(i + 1, i + 2):
-                pieces2word[i][j] = 1
-        for k in range(seqlen):
-            dist_inputs[k, :] += k
-            dist_inputs[:, k] -= k
-
-        for i in range(length):
-            for j in range(length):
-                if dist_inputs[i, j] < 0:
-                    dist_inputs[i, j] = self.dis2idx[-dist_inputs[i, j]] + 9
-                else:
-                    dist_inputs[i, j] = self.dis2idx[dist_inputs[i, j]]
-        dist_inputs[dist_inputs == 0] = 19
-
         if entities is not None:
             for l, s, e in entities:
                 l = label2id[l]
@@ -133,35 +163,17 @@ class NN_DataHelper(DataHelper):
                 s += 1
                 e += 1
                 if s < max_seq_length - 1 and e < max_seq_length - 1:
-                    for i in range(e - s):
-                        grid_labels[i, i + 1] = 1
-                    grid_labels[e, s] = l + 2
-
-        pad_len = max_seq_length - len(input_ids)
-        if pad_len > 0:
-            input_ids = np.pad(input_ids, (0, pad_len), 'constant',
-                               constant_values=(tokenizer.pad_token_id, tokenizer.pad_token_id))
-            attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
-
-            grid_labels = np.pad(grid_labels, pad_width=((0, pad_len), (0, pad_len)))
-            pieces2word = np.pad(pieces2word, pad_width=((0, pad_len), (0, pad_len)))
-            dist_inputs = np.pad(dist_inputs, pad_width=((0, pad_len), (0, pad_len)))
-            grid_mask2d = np.pad(grid_mask2d, pad_width=((0, pad_len), (0, pad_len)))
+                    labels.append((l, s, e))
 
         d = {
             'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'labels': grid_labels,
-            'pieces2word': pieces2word,
-            'dist_inputs': dist_inputs,
-            'grid_mask2d': grid_mask2d,
+            'labels': np.asarray(labels, dtype=np.int32),
             'seqlen': seqlen,
         }
 
         # if self.index < 5:
         #     print(tokens)
         #     print(input_ids[:seqlen])
-        #     print(attention_mask[:seqlen])
         #     print(seqlen)
 
         if mode == 'eval':
@@ -207,27 +219,11 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len, :max_len]
-        o['pieces2word'] = o['pieces2word'][:, :max_len, :max_len]
-        o['dist_inputs'] = o['dist_inputs'][:, :max_len, :max_len]
-        o['grid_mask2d'] = o['grid_mask2d'][:, :max_len, :max_len]
-
+        entity_labels = [b['labels'] for b in batch]
+        o = collate_with_seqlen([{k: v for k, v in b.items() if k != 'labels'} for b in batch],
+                                pop_seqlen=False, with_attention_mask=True)
+        seqlens = o.pop('seqlen')
+        o.update(build_w2ner_grids(entity_labels, seqlens.numpy(), o['input_ids'].size(1)))
         return o
 
 
@@ -260,6 +256,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self, *args, **kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args, **kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
             self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -267,18 +264,15 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         # 当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,
-                                   collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         eval_labels = pl_module.eval_labels
         config = pl_module.config
 
         y_preds, y_trues = [], []
-        for i, batch in tqdm(enumerate(eval_datasets), total=len(eval_datasets), desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i, batch in tqdm(eval_datasets, total=len(eval_datasets), desc='evalute'):
             o = pl_module.validation_step(batch, i)
 
             logits, seqlens, _ = o['outputs']
@@ -286,12 +280,17 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
             bs = len(logits)
             y_trues.extend(eval_labels[i * bs: (i + 1) * bs])
 
-        print(y_preds[:3])
-        print(y_trues[:3])
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            print(y_preds[:3])
+            print(y_trues[:3])
 
-        f1, str_report = metric_for_pointer(y_trues, y_preds, config.label2id)
-        print(f1)
-        print(str_report)
+            f1, str_report = metric_for_pointer(y_trues, y_preds, config.label2id)
+            print(f1)
+            print(str_report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -305,7 +304,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments, W2nerArguments))
     model_args, training_args, data_args, w2nerArguments = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor='val_f1',  every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor='val_f1',  every_n_epochs=1)
     trainer = Trainer(
         log_every_n_steps=10,
         callbacks=[checkpoint_callback],
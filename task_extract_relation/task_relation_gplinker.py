@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -18,6 +20,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen, encode_points, points_target_len, pad_points
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -77,11 +83,6 @@ class NN_DataHelper(DataHelper):
         input_ids = np.asarray(input_ids, dtype=np.int32)
         attention_mask = np.asarray(attention_mask, dtype=np.int32)
 
-        max_target_len = 60
-        entity_labels = np.zeros(shape=(2, max_target_len, 2), dtype=np.int32)
-        head_labels = np.zeros(shape=(len(predicate2id), max_target_len, 2), dtype=np.int32)
-        tail_labels = np.zeros(shape=(len(predicate2id), max_target_len, 2), dtype=np.int32)
-
         entity_labels_tmp = [set() for _ in range(2)]
         head_labels_tmp = [set() for _ in range(len(predicate2id))]
         tail_labels_tmp = [set() for _ in range(len(predicate2id))]
@@ -98,33 +99,19 @@ class NN_DataHelper(DataHelper):
                 head_labels_tmp[p].add((s[0], o[0]))
                 tail_labels_tmp[p].add((s[1], o[1]))
 
-        def feed_label(x, pts_list):
-            tlens = [1]
-            for p, pts in enumerate(pts_list):
-                tlens.append(len(pts))
-                for seq, pos in enumerate(pts):
-                    x[p][seq][0] = pos[0]
-                    x[p][seq][1] = pos[1]
-            return np.max(tlens)
-
-        targetlen1 = feed_label(entity_labels, list(map(lambda x: list(x), entity_labels_tmp)))
-        targetlen2 = feed_label(head_labels, list(map(lambda x: list(x), head_labels_tmp)))
-        targetlen3 = feed_label(tail_labels, list(map(lambda x: list(x), tail_labels_tmp)))
-
-        targetlen = np.asarray(np.max([targetlen1, targetlen2, targetlen3]), dtype=np.int32)
         pad_len = max_seq_length - len(input_ids)
         if pad_len > 0:
             pad_val = tokenizer.pad_token_id
             input_ids = np.pad(input_ids, (0, pad_len), 'constant', constant_values=(pad_val, pad_val))
             attention_mask = np.pad(attention_mask, (0, pad_len), 'constant', constant_values=(0, 0))
+        # 只存储真实的 (class, x, y) 点, collate_fn 中按 batch 还原
         d = {
             'input_ids': input_ids,
             'attention_mask': attention_mask,
-            'entity_labels': entity_labels,
-            'head_labels': head_labels,
-            'tail_labels': tail_labels,
+            'entity_labels': encode_points(entity_labels_tmp),
+            'head_labels': encode_points(head_labels_tmp),
+            'tail_labels': encode_points(tail_labels_tmp),
             'seqlen': seqlen,
-            'targetlen': targetlen,
         }
 
         if self.index < 5:
@@ -149,6 +136,8 @@ class NN_DataHelper(DataHelper):
                 labels.append('+'.join(larr))
         label2id = {label: i for i, label in enumerate(labels)}
         id2label = {i: label for i, label in enumerate(labels)}
+        NN_DataHelper.label2id = label2id
+        NN_DataHelper.id2label = id2label
         return label2id, id2label
 
     # 读取文件
@@ -196,27 +185,13 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        max_tarlen = torch.max(o.pop('targetlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['entity_labels'] = o['entity_labels'][:, :, :max_tarlen]
-        o['head_labels'] = o['head_labels'][:, :, :max_tarlen]
-        o['tail_labels'] = o['tail_labels'][:, :, :max_tarlen]
+        label_keys = ('entity_labels', 'head_labels', 'tail_labels')
+        o = collate_with_seqlen([{k: v for k, v in b.items() if k not in label_keys} for b in batch])
+        num_classes = (2, len(NN_DataHelper.label2id), len(NN_DataHelper.label2id))
+        points = {k: [b[k] for b in batch] for k in label_keys}
+        max_tarlen = max(points_target_len(points[k], c) for k, c in zip(label_keys, num_classes))
+        for k, c in zip(label_keys, num_classes):
+            o[k] = pad_points(points[k], c, max_tarlen)
         return o
 
 
@@ -254,6 +229,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -261,18 +237,16 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         eval_labels = pl_module.eval_labels
         config = pl_module.config
 
         threshold = 1e-7
         y_preds, y_trues = [], []
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
 
             logits1, logits2, logits3, _, _, _ = o['outputs']
@@ -282,13 +256,16 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
             y_preds.extend(p_spoes)
             y_trues.extend(t_spoes)
 
-        print(y_preds[:3])
-        print(y_trues[:3])
-        f1, str_report = metric_for_spo(y_trues, y_preds, config.label2id)
-        print(f1)
-        print(str_report)
-
-
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            print(y_preds[:3])
+            print(y_trues[:3])
+            f1, str_report = metric_for_spo(y_trues, y_preds, config.label2id)
+            print(f1)
+            print(str_report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -302,7 +279,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
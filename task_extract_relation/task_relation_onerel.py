@@ -1,9 +1,10 @@
 # -*- coding: utf-8 -*-
 #参考实现: https://github.com/ssnvxia/OneRel
 
-import copy
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -21,6 +22,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -58,7 +63,56 @@ train_info_args = {
 
 
 
+def build_onerel_labels(spo_labels, seqlens, max_len, num_rel, sparse=False):
+    '''
+        spo_labels: 每个样本 [(sh, st, p, oh, ot), ...]
+        一次性生成所有 (b, p, h, t, tag) 坐标, tag: 1 = (sh, oh), 2 = (sh, ot), 3 = (st, ot)
+        sparse: 只返回坐标 labels_index 与 seqlen, 由 MyTransformer.compute_loss 在设备上还原
+    '''
+    bs = len(spo_labels)
+    spos = [np.asarray(spo, dtype=np.int64).reshape(-1, 5) for spo in spo_labels]
+    bids = np.concatenate([np.full(len(spo), i, dtype=np.int64) for i, spo in enumerate(spos)])
+    sh, st, p, oh, ot = np.concatenate(spos).T
+    n = len(bids)
+    index = np.stack([np.tile(bids, 3), np.tile(p, 3),
+                      np.concatenate([sh, sh, st]), np.concatenate([oh, ot, ot]),
+                      np.repeat(np.asarray([1, 2, 3], dtype=np.int64), n)], axis=1)
+    # 按原循环顺序 (逐个 spo 依次写 1/2/3) 排列, 同一位置保留最后写入的 tag
+    index = index.reshape(3, n, 5).transpose(1, 0, 2).reshape(-1, 5)
+    flat = ((index[:, 0] * num_rel + index[:, 1]) * max_len + index[:, 2]) * max_len + index[:, 3]
+    _, last = np.unique(flat[::-1], return_index=True)
+    index = index[len(flat) - 1 - np.sort(last)[::-1]]
+    if sparse:
+        return {
+            'labels_index': torch.from_numpy(index),
+            'labels_seqlen': torch.as_tensor(seqlens, dtype=torch.long),
+        }
+
+    labels = np.zeros((bs, num_rel, max_len, max_len), dtype=np.int64)
+    labels[index[:, 0], index[:, 1], index[:, 2], index[:, 3]] = index[:, 4]
+    pad = np.arange(max_len)[None, :] >= np.asarray(seqlens).reshape(-1, 1)
+    labels[np.broadcast_to((pad[:, :, None] & pad[:, None, :])[:, None], labels.shape)] = -100
+    return {'labels': torch.from_numpy(labels)}
+
+
+def densify_onerel_labels(batch, num_rel):
+    # 稀疏坐标 -> 稠密标签 [bs, num_rel, L, L], 直接在 input_ids 所在设备上构造
+    input_ids = batch['input_ids']
+    bs, max_len = input_ids.size()
+    index = batch.pop('labels_index')
+    seqlens = batch.pop('labels_seqlen')
+    labels = torch.zeros((bs, num_rel, max_len, max_len), dtype=torch.long, device=input_ids.device)
+    labels[index[:, 0], index[:, 1], index[:, 2], index[:, 3]] = index[:, 4]
+    pad = torch.arange(max_len, device=input_ids.device).unsqueeze(0) >= seqlens.unsqueeze(1)
+    labels.masked_fill_((pad.unsqueeze(2) & pad.unsqueeze(1)).unsqueeze(1), -100)
+    batch['labels'] = labels
+    return batch
+
+
 class NN_DataHelper(DataHelper):
+    # 标签以稀疏坐标形式输出, 在模型所在设备上还原, 不在内存中构造 [bs, num_rel, L, L] 稠密张量
+    sparse_labels = False
+
     index = -1
     eval_labels = []
     def on_data_ready(self):
@@ -171,41 +225,12 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        fake_labels = []
-        for i, b in enumerate(batch):
-            b = copy.copy(b)
-            fake_labels.append(b.pop('labels',None))
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        bs = len(o['input_ids'])
+        spo_labels = [b.get('labels', None) for b in batch]
+        o = collate_with_seqlen([{k: v for k, v in b.items() if k != 'labels'} for b in batch], pop_seqlen=False)
         seqlens = o.pop('seqlen')
-        max_len = torch.max(seqlens)
-        has_label = fake_labels[0] is not None
-
-        labels = np.zeros(shape=(bs,len(NN_DataHelper.label2id),max_len,max_len),dtype=np.int32)
-        if has_label:
-            for spo,label,seqlen in zip(fake_labels,labels,seqlens):
-                for sh,st,p,oh,ot in spo:
-                    label[p, sh, oh] = 1
-                    label[p, sh, ot] = 2
-                    label[p, st, ot] = 3
-                label[:,seqlen:,seqlen:] = -100
-
-        labels = torch.tensor(labels,dtype=torch.long)
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        if has_label:
-            o['labels'] = labels
+        if spo_labels[0] is not None:
+            o.update(build_onerel_labels(spo_labels, seqlens.numpy(), o['input_ids'].size(1),
+                                         len(NN_DataHelper.label2id), sparse=NN_DataHelper.sparse_labels))
         return o
 
 
@@ -215,11 +240,17 @@ class MyTransformer(TransformerForOneRel, with_pl=True):
         self.index = 0
         self.eval_labels = eval_labels
 
+    def compute_loss(self, *args, **batch) -> tuple:
+        if 'labels_index' in batch:
+            batch = densify_onerel_labels(batch, self.config.num_labels)
+        return super(MyTransformer, self).compute_loss(*args, **batch)
+
 
 class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -227,18 +258,16 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         eval_labels = pl_module.eval_labels
         config = pl_module.config
 
 
         y_preds, y_trues = [], []
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
 
             logits, _ = o['outputs']
@@ -248,13 +277,16 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
             y_preds.extend(p_spoes)
             y_trues.extend(t_spoes)
 
-        print(y_preds[:3])
-        print(y_trues[:3])
-        f1, str_report = metric_for_spo(y_trues, y_preds, config.label2id)
-        print(f1)
-        print(str_report)
-
-
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            print(y_preds[:3])
+            print(y_trues[:3])
+            f1, str_report = metric_for_spo(y_trues, y_preds, config.label2id)
+            print(f1)
+            print(str_report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -268,7 +300,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
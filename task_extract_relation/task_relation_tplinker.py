@@ -2,6 +2,8 @@
 import copy
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -19,6 +21,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.corpus import iter_jsonl, make_dataset_with_stream
+from common.collate import collate_with_seqlen
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices': 1,
     'data_backend': 'memory_raw',
@@ -65,16 +72,93 @@ train_info_args = {
 }
 
 
+def shaking_pos(x0, x1, max_len):
+    return x0 * max_len + x1 - x0 * (x0 + 1) // 2
+
+
+def _keep_last_write(index, shape):
+    # 同一位置保留最后写入的 tag (与 numpy 赋值一致); 设备上 index_put 重复坐标的写入顺序不确定
+    flat = np.ravel_multi_index(index[:, :len(shape)].T, shape)
+    _, last = np.unique(flat[::-1], return_index=True)
+    return index[len(flat) - 1 - np.sort(last)[::-1]]
+
+
+def build_shaking_labels(spo_labels, bs, max_len, num_rel, sparse=False):
+    '''
+        spo_labels: 每个样本 [(sh, st, p, oh, ot), ...]
+        一次性计算所有 shaking 位置后 scatter, 代替逐个 spo 的 python 循环
+        sparse: 返回 *_index 坐标, 由 MyTransformer.compute_loss 在设备上还原
+    '''
+    shaking_len = max_len * (max_len + 1) // 2
+    spos = [np.asarray(spo, dtype=np.int64).reshape(-1, 5) for spo in spo_labels]
+    bids = np.concatenate([np.full(len(spo), i, dtype=np.int64) for i, spo in enumerate(spos)]) \
+        if spos else np.zeros((0,), dtype=np.int64)
+    spos = np.concatenate(spos) if spos else np.zeros((0, 5), dtype=np.int64)
+    keep = np.all(spos[:, [0, 1, 3, 4]] < max_len - 1, axis=1)
+    bids, spos = bids[keep], spos[keep]
+    sh, st, p, oh, ot = spos.T
+
+    ent_index = np.stack([np.concatenate([bids, bids]),
+                          np.concatenate([shaking_pos(sh, st, max_len), shaking_pos(oh, ot, max_len)])], axis=1)
+    head_index = np.stack([bids, p, shaking_pos(np.minimum(sh, oh), np.maximum(sh, oh), max_len),
+                           np.where(sh <= oh, 1, 2)], axis=1)
+    tail_index = np.stack([bids, p, shaking_pos(np.minimum(st, ot), np.maximum(st, ot), max_len),
+                           np.where(st <= ot, 1, 2)], axis=1)
+    if sparse:
+        head_index = _keep_last_write(head_index, (bs, num_rel, shaking_len))
+        tail_index = _keep_last_write(tail_index, (bs, num_rel, shaking_len))
+        return {
+            'entity_labels_index': torch.from_numpy(ent_index),
+            'head_labels_index': torch.from_numpy(head_index),
+            'tail_labels_index': torch.from_numpy(tail_index),
+        }
+
+    entity_labels = np.zeros((bs, shaking_len), dtype=np.int64)
+    head_labels = np.zeros((bs, num_rel, shaking_len), dtype=np.int64)
+    tail_labels = np.zeros((bs, num_rel, shaking_len), dtype=np.int64)
+    entity_labels[ent_index[:, 0], ent_index[:, 1]] = 1
+    head_labels[head_index[:, 0], head_index[:, 1], head_index[:, 2]] = head_index[:, 3]
+    tail_labels[tail_index[:, 0], tail_index[:, 1], tail_index[:, 2]] = tail_index[:, 3]
+    return {
+        'entity_labels': torch.from_numpy(entity_labels),
+        'head_labels': torch.from_numpy(head_labels),
+        'tail_labels': torch.from_numpy(tail_labels),
+    }
+
+
+def densify_shaking_labels(batch, num_rel):
+    # 稀疏坐标 -> 稠密标签, 直接在 input_ids 所在设备上构造
+    input_ids = batch['input_ids']
+    bs, max_len = input_ids.size()
+    shaking_len = max_len * (max_len + 1) // 2
+    device = input_ids.device
+    ent_index = batch.pop('entity_labels_index')
+    head_index = batch.pop('head_labels_index')
+    tail_index = batch.pop('tail_labels_index')
+    entity_labels = torch.zeros((bs, shaking_len), dtype=torch.long, device=device)
+    entity_labels[ent_index[:, 0], ent_index[:, 1]] = 1
+    head_labels = torch.zeros((bs, num_rel, shaking_len), dtype=torch.long, device=device)
+    head_labels[head_index[:, 0], head_index[:, 1], head_index[:, 2]] = head_index[:, 3]
+    tail_labels = torch.zeros((bs, num_rel, shaking_len), dtype=torch.long, device=device)
+    tail_labels[tail_index[:, 0], tail_index[:, 1], tail_index[:, 2]] = tail_index[:, 3]
+    batch['entity_labels'] = entity_labels
+    batch['head_labels'] = head_labels
+    batch['tail_labels'] = tail_labels
+    return batch
+
+
 class NN_DataHelper(DataHelper):
     # 是否固定输入最大长度 ， 如果固定训练会慢 ，指标高许多 ，如不固定训练快，指标收敛慢些
     is_fixed_input_length = True
 
+    # 标签以稀疏索引形式输出, 在模型所在设备上还原, 不在内存中构造 [bs, num_rel, L*(L+1)/2] 稠密张量
+    sparse_labels = False
+
     index = -1
     eval_labels = []
 
     id2label, label2id = None, None
-
-    # 获取训练集的最大长度
+    # 训练集最大文本长度, 在 on_get_corpus 中预先扫描
     max_text_length = 0
 
     def on_data_ready(self):
@@ -88,7 +172,7 @@ class NN_DataHelper(DataHelper):
         sentence, entities, re_list = data
         spo_list = re_list
         if mode == 'train':
-            max_seq_length = min(max_seq_length,self.max_text_length + 2)
+            max_seq_length = min(max_seq_length, self.max_text_length + 2)
 
         tokens = list(sentence) if not do_lower_case else list(sentence.lower())
         if len(tokens) > max_seq_length - 2:
@@ -155,49 +239,44 @@ class NN_DataHelper(DataHelper):
 
     # 读取文件
     def on_get_corpus(self, files: typing.List, mode: str):
-        D = []
-        for filename in files:
-            with open(filename, mode='r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    jd = json.loads(line)
-                    if not jd:
-                        continue
-
-                    entities = jd.get('entities', None)
-                    re_list = jd.get('re_list', None)
-
-                    if entities:
-                        entities_label = []
-                        for k, v in entities.items():
-                            pts = [_ for a_ in list(v.values()) for _ in a_]
-                            for pt in pts:
-                                entities_label.append((k, pt[0], pt[1]))
-                    else:
-                        entities_label = None
-
-                    if re_list is not None:
-                        re_list_label = []
-                        for re_node in re_list:
-                            for l, relation in re_node.items():
-                                s = relation[0]
-                                o = relation[1]
-                                assert s['pos'][0] <= s['pos'][1],ValueError(text,s['pos'])
-                                assert o['pos'][0] <= o['pos'][1],ValueError(text,o['pos'])
-                                re_list_label.append((
-                                    # (s['pos'][0], s['pos'][1],s['label']),
-                                    # l,
-                                    # (o['pos'][0], o['pos'][1],o['label'])
-                                    (s['pos'][0], s['pos'][1]),
-                                    '+'.join([s['label'], l, o['label']]),
-                                    (o['pos'][0], o['pos'][1])
-                                ))
-                    else:
-                        re_list_label = None
-                    text = jd['text']
-                    self.max_text_length = max(self.max_text_length,len(text))
-                    D.append((text, entities_label, re_list_label))
-        return D if mode == 'train' else D[:300]
+        if mode == 'train':
+            # 流式转换前先只解析一遍文本长度, 训练集固定长度取 min(max_seq_length, 最长文本 + 2)
+            self.max_text_length = max((len(jd['text']) for jd in iter_jsonl(files)), default=0)
+        for i, jd in enumerate(iter_jsonl(files)):
+            if mode != 'train' and i >= 300:
+                break
+            entities = jd.get('entities', None)
+            re_list = jd.get('re_list', None)
+
+            if entities:
+                entities_label = []
+                for k, v in entities.items():
+                    pts = [_ for a_ in list(v.values()) for _ in a_]
+                    for pt in pts:
+                        entities_label.append((k, pt[0], pt[1]))
+            else:
+                entities_label = None
+
+            if re_list is not None:
+                re_list_label = []
+                for re_node in re_list:
+                    for l, relation in re_node.items():
+                        s = relation[0]
+                        o = relation[1]
+                        assert s['pos'][0] <= s['pos'][1],ValueError(text,s['pos'])
+                        assert o['pos'][0] <= o['pos'][1],ValueError(text,o['pos'])
+                        re_list_label.append((
+                            # (s['pos'][0], s['pos'][1],s['label']),
+                            # l,
+                            # (o['pos'][0], o['pos'][1],o['label'])
+                            (s['pos'][0], s['pos'][1]),
+                            '+'.join([s['label'], l, o['label']]),
+                            (o['pos'][0], o['pos'][1])
+                        ))
+            else:
+                re_list_label = None
+            text = jd['text']
+            yield text, entities_label, re_list_label
 
     # batch for torch dataloader
 
@@ -206,47 +285,11 @@ class NN_DataHelper(DataHelper):
     @staticmethod
     def collate_fn(batch):
         bs = len(batch)
-        o = {}
-        spo_labels = []
-        for i, b in enumerate(batch):
-            b = copy.copy(b)
-            spo_labels.append(b.pop('labels', []))
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-        max_len = torch.max(o.pop('seqlen'))
-        shaking_len = int(max_len * (max_len + 1) / 2)
-        entity_labels = torch.zeros(size=(bs, shaking_len), dtype=torch.long)
-        head_labels = torch.zeros(size=(bs, len(NN_DataHelper.label2id), shaking_len), dtype=torch.long)
-        tail_labels = torch.zeros(size=(bs, len(NN_DataHelper.label2id), shaking_len), dtype=torch.long)
-        get_pos = lambda x0, x1: x0 * max_len + x1 - int(x0 * (x0 + 1) / 2)
-        for spos, e, h, t in zip(spo_labels, entity_labels, head_labels, tail_labels):
-            for spo in spos:
-                if spo[0] >= max_len - 1 or spo[1] >= max_len - 1 or spo[3] >= max_len - 1 or spo[4] >= max_len - 1:
-                    continue
-                e[get_pos(spo[0], spo[1])] = 1
-                e[get_pos(spo[3], spo[4])] = 1
-                if spo[0] <= spo[3]:
-                    h[spo[2]][get_pos(spo[0], spo[3])] = 1
-                else:
-                    h[spo[2]][get_pos(spo[3], spo[0])] = 2
-                if spo[1] <= spo[4]:
-                    t[spo[2]][get_pos(spo[1], spo[4])] = 1
-                else:
-                    t[spo[2]][get_pos(spo[4], spo[1])] = 2
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['entity_labels'] = entity_labels
-        o['head_labels'] = head_labels
-        o['tail_labels'] = tail_labels
+        spo_labels = [b.get('labels', []) for b in batch]
+        o = collate_with_seqlen([{k: v for k, v in b.items() if k != 'labels'} for b in batch])
+        max_len = o['input_ids'].size(1)
+        o.update(build_shaking_labels(spo_labels, bs, max_len, len(NN_DataHelper.label2id),
+                                      sparse=NN_DataHelper.sparse_labels))
         return o
 
 
@@ -256,6 +299,11 @@ class MyTransformer(TransformerForTplinker, with_pl=True):
         self.index = 0
         self.eval_labels = eval_labels
 
+    def compute_loss(self, *args, **batch) -> tuple:
+        if 'head_labels_index' in batch:
+            batch = densify_shaking_labels(batch, self.config.num_labels)
+        return super(MyTransformer, self).compute_loss(*args, **batch)
+
     def validation_epoch_end(self, outputs: typing.Union[EPOCH_OUTPUT, typing.List[EPOCH_OUTPUT]]) -> None:
         self.index += 1
         if self.index < 2:
@@ -285,6 +333,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -292,17 +341,15 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         eval_labels = pl_module.eval_labels
         config = pl_module.config
 
         y_preds, y_trues = [], []
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
 
             logits1, logits2, logits3, _, _, _ = o['outputs']
@@ -313,12 +360,16 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
             y_preds.extend(p_spoes)
             y_trues.extend(t_spoes)
 
-        print(y_preds[:3])
-        print(y_trues[:3])
-        f1, str_report = metric_for_spo(y_trues, y_preds, config.label2id)
-        print(f1)
-        print(str_report)
-
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        y_preds, y_trues = gather_eval_outputs(y_preds, y_trues)
+        f1 = None
+        if trainer.is_global_zero:
+            print(y_preds[:3])
+            print(y_trues[:3])
+            f1, str_report = metric_for_spo(y_trues, y_preds, config.label2id)
+            print(f1)
+            print(str_report)
+        f1 = broadcast_eval_metric(f1)
 
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
@@ -333,7 +384,7 @@ if __name__ == '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments, TplinkerArguments))
     model_args, training_args, data_args, tplinker_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor="val_f1", every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor="val_f1", every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -361,22 +412,22 @@ if __name__ == '__main__':
     intermediate_name = data_args.intermediate_name + '_{}'.format(0)
     if data_args.do_train:
         dataHelper.train_files.append(
-            dataHelper.make_dataset_with_args(data_args.train_file, token_fn_args_dict['train'],
-                                              data_args,
-                                              intermediate_name=intermediate_name, shuffle=True,
-                                              mode='train'))
+            make_dataset_with_stream(dataHelper, data_args.train_file, token_fn_args_dict['train'],
+                                     data_args,
+                                     intermediate_name=intermediate_name, shuffle=True,
+                                     mode='train'))
     if data_args.do_eval:
-        dataHelper.eval_files.append(dataHelper.make_dataset_with_args(data_args.eval_file, token_fn_args_dict['eval'],
-                                                                       data_args,
-                                                                       intermediate_name=intermediate_name,
-                                                                       shuffle=False,
-                                                                       mode='eval'))
+        dataHelper.eval_files.append(make_dataset_with_stream(dataHelper, data_args.eval_file, token_fn_args_dict['eval'],
+                                                              data_args,
+                                                              intermediate_name=intermediate_name,
+                                                              shuffle=False,
+                                                              mode='eval'))
     if data_args.do_test:
-        dataHelper.test_files.append(dataHelper.make_dataset_with_args(data_args.test_file, token_fn_args_dict['test'],
-                                                                       data_args,
-                                                                       intermediate_name=intermediate_name,
-                                                                       shuffle=False,
-                                                                       mode='test'))
+        dataHelper.test_files.append(make_dataset_with_stream(dataHelper, data_args.test_file, token_fn_args_dict['test'],
+                                                              data_args,
+                                                              intermediate_name=intermediate_name,
+                                                              shuffle=False,
+                                                              mode='test'))
 
     train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
                                              process_index=trainer.global_rank, infinite=True,
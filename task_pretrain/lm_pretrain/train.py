@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
+import os
+import sys
 import typing
 
 import numpy as np
@@ -13,6 +15,9 @@ from pytorch_lightning.callbacks import ModelCheckpoint
 from torch.utils.data import DataLoader, IterableDataset
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.collate import collate_with_seqlen
+
 train_info_args = {
     'devices':  1,
     'data_backend': 'memory_raw',
@@ -86,25 +91,7 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len]
-        return o
+        return collate_with_seqlen(batch, seq_keys=('labels',))
 
 
 class MyTransformer(TransformerForCausalLM, with_pl=True):
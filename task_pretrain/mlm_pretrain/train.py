@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-import json
+import os
 import random
+import sys
 import typing
 
 import torch
@@ -15,6 +16,11 @@ from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader, IterableDataset
 from transformers import BertTokenizerFast, HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.corpus import iter_jsonl, make_dataset_with_stream, make_dataset_with_shards
+from common.collate import collate_with_seqlen
+from common.mlm_mask import make_wwm_document, DynamicWwmCollator
+
 train_info_args = {
     'devices':  1,
     'data_backend': 'memory_raw',
@@ -48,11 +54,14 @@ train_info_args = {
 
 
 class NN_DataHelper(DataHelper):
+    # 动态掩码时由 main 设置
+    wwm_collator = None
+
     # 切分词
     def on_data_process(self, data: typing.Any, user_data: typing.Any):
         tokenizer: BertTokenizerFast
         tokenizer,max_seq_length,do_lower_case, label2id,\
-        rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob,mode = user_data
+        rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob,dynamic_masking,mode = user_data
 
         documents = data
         document_text_string = ''.join(documents)
@@ -65,57 +74,37 @@ class NN_DataHelper(DataHelper):
         #返回多个文档
         document_nodes = []
         for text in document_texts:
-            node = make_mlm_wwm_sample(text, tokenizer,max_seq_length, rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob)
+            if dynamic_masking:
+                # 只存储分词结果与整词序号, 掩码在 collate 中完成
+                node = make_wwm_document(text, tokenizer, max_seq_length, do_whole_word_mask)
+            else:
+                node = make_mlm_wwm_sample(text, tokenizer,max_seq_length, rng, do_whole_word_mask, max_predictions_per_seq, masked_lm_prob)
             document_nodes.append(node)
         return document_nodes
 
 
     # 读取文件
     def on_get_corpus(self, files: typing.List, mode:str):
-        D = []
         line_no = 0
-        for input_file in files:
-            with open(input_file, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                for line in lines:
-                    jd = json.loads(line)
-                    if not jd:
-                        continue
-                    text = jd['content']
-                    docs = text.split('\n\n')
-                    D.append([doc for doc in docs if doc])
-                    line_no += 1
-
-                    if line_no > 1000:
-                        break
-
-                    if line_no % 10000 == 0:
-                        print('read_line', line_no)
-                        print(D[-1])
-        return D
+        for jd in iter_jsonl(files):
+            text = jd['content']
+            docs = text.split('\n\n')
+            docs = [doc for doc in docs if doc]
+            yield docs
+            line_no += 1
 
-    @staticmethod
-    def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
+            if line_no > 1000:
+                break
 
-        max_len = torch.max(o.pop('seqlen'))
+            if line_no % 10000 == 0:
+                print('read_line', line_no)
+                print(docs)
 
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len]
-        o['weight'] = o['weight'][:, :max_len]
-        return o
+    @staticmethod
+    def collate_fn(batch):
+        if 'word_ids' in batch[0]:
+            return NN_DataHelper.wwm_collator(batch)
+        return collate_with_seqlen(batch, seq_keys=('labels', 'weight'))
 
 class MyTransformer(TransformerForMaskLM,with_pl=True):
     def __init__(self,*args,**kwargs):
@@ -169,48 +158,58 @@ if __name__== '__main__':
     tokenizer, config, label2id, id2label = load_tokenizer_and_config_with_args(dataHelper, model_args, training_args,
                                                                                 data_args)
 
+    # 动态整词掩码: 数据只转换一份, 每个 batch 在 collate 中重新掩码; False 时按 dupe_factor 生成多份静态掩码数据
+    dynamic_masking = True
+    if dynamic_masking:
+        NN_DataHelper.wwm_collator = DynamicWwmCollator(tokenizer.mask_token_id, len(tokenizer.get_vocab()),
+                                                        max_predictions_per_seq=mlm_data_args.max_predictions_per_seq,
+                                                        masked_lm_prob=mlm_data_args.masked_lm_prob,
+                                                        pad_token_id=tokenizer.pad_token_id,
+                                                        seed=training_args.seed)
+
     rng = random.Random(training_args.seed)
     token_fn_args_dict = {
         'train': (tokenizer, data_args.train_max_seq_length, model_args.do_lower_case, label2id,
                   rng, mlm_data_args.do_whole_word_mask, mlm_data_args.max_predictions_per_seq,
-                  mlm_data_args.masked_lm_prob,
+                  mlm_data_args.masked_lm_prob, dynamic_masking,
                   'train'),
         'eval': (tokenizer, data_args.eval_max_seq_length, model_args.do_lower_case, label2id,
                  rng, mlm_data_args.do_whole_word_mask, mlm_data_args.max_predictions_per_seq,
-                 mlm_data_args.masked_lm_prob,
+                 mlm_data_args.masked_lm_prob, dynamic_masking,
                  'eval'),
         'test': (tokenizer, data_args.test_max_seq_length, model_args.do_lower_case, label2id,
                  rng, mlm_data_args.do_whole_word_mask, mlm_data_args.max_predictions_per_seq,
-                 mlm_data_args.masked_lm_prob,
+                 mlm_data_args.masked_lm_prob, dynamic_masking,
                  'test')
     }
 
     dataHelper.train_files = []
     dataHelper.eval_files = []
     dataHelper.test_files = []
-    for i in range(mlm_data_args.dupe_factor):
+    for i in range(1 if dynamic_masking else mlm_data_args.dupe_factor):
         # 缓存数据集
         intermediate_name = data_args.intermediate_name + '_{}'.format(i)
         if data_args.do_train:
-            dataHelper.train_files.append(
-                dataHelper.make_dataset_with_args(data_args.train_file, token_fn_args_dict['train'],
-                                                  data_args,
-                                                  intermediate_name=intermediate_name, shuffle=True,
-                                                  mode='train'))
+            # 多进程分片转换, 每个进程写一个分片
+            dataHelper.train_files.extend(
+                make_dataset_with_shards(dataHelper, data_args.train_file, token_fn_args_dict['train'],
+                                         data_args,
+                                         intermediate_name=intermediate_name, shuffle=True,
+                                         mode='train', num_process_worker=os.cpu_count()))
         if data_args.do_eval:
             dataHelper.eval_files.append(
-                dataHelper.make_dataset_with_args(data_args.eval_file, token_fn_args_dict['eval'],
-                                                  data_args,
-                                                  intermediate_name=intermediate_name,
-                                                  shuffle=False,
-                                                  mode='eval'))
+                make_dataset_with_stream(dataHelper, data_args.eval_file, token_fn_args_dict['eval'],
+                                         data_args,
+                                         intermediate_name=intermediate_name,
+                                         shuffle=False,
+                                         mode='eval'))
         if data_args.do_test:
             dataHelper.test_files.append(
-                dataHelper.make_dataset_with_args(data_args.test_file, token_fn_args_dict['test'],
-                                                  data_args,
-                                                  intermediate_name=intermediate_name,
-                                                  shuffle=False,
-                                                  mode='test'))
+                make_dataset_with_stream(dataHelper, data_args.test_file, token_fn_args_dict['test'],
+                                         data_args,
+                                         intermediate_name=intermediate_name,
+                                         shuffle=False,
+                                         mode='test'))
 
     train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
                                              process_index=trainer.global_rank, infinite=True,
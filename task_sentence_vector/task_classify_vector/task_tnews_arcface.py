@@ -3,6 +3,7 @@ import copy
 import json
 import logging
 import os
+import sys
 import typing
 
 import numpy as np
@@ -25,6 +26,9 @@ from transformers import HfArgumentParser, BertTokenizer
 
 from sklearn.metrics.pairwise import paired_distances
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.collate import collate_with_seqlen
+
 train_info_args = {
     'devices':  1,
     'data_backend': 'memory_raw',
@@ -114,22 +118,7 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        return o
+        return collate_with_seqlen(batch)
 
 
 
@@ -1,100 +1,128 @@
 # @Time    : 2022/12/16 11:03
 # @Author  : tk
 # @FileName: split_record.py
-import copy
 import os
 import random
+import sys
 
 import numpy as np
 from fastdatasets.record import load_dataset as Loader, gfile, RECORD, NumpyWriter
 from tqdm import tqdm
 
-#从分类数据构造正负样本池
-def gen_pos_neg_records(all_example):
-    all_example_new = []
-    all_keys = list(all_example.keys())
-    all_example_num = {lable: list(range(len(all_example[lable]))) for lable in all_example}
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.record_index import write_ref_sources
+
+
+class _LabelPool:
+    '''
+        单个标签的样本池: 随机排列 + 游标, 游标之前为已取走的样本, 取样 O(size)
+    '''
+    def __init__(self, ids: np.ndarray, rng: np.random.RandomState):
+        self.rng = rng
+        self.perm = rng.permutation(ids)
+        self.cursor = 0
+
+    def __len__(self):
+        return len(self.perm) - self.cursor
+
+    def take(self, size: int, keep_prob: float = 0.):
+        size = min(size, len(self))
+        c = self.cursor
+        seg = self.perm[c:c + size].copy()
+        keep = self.rng.random_sample(size) < keep_prob if keep_prob > 0 else np.zeros(size, dtype=bool)
+        # 取走的样本移到游标处, 保留在池中的样本与剩余区间的随机位置交换, 保持剩余部分随机
+        self.perm[c:c + size] = np.concatenate([seg[~keep], seg[keep]])
+        self.cursor += int((~keep).sum())
+        for p in range(self.cursor, c + size):
+            q = self.rng.randint(self.cursor, len(self.perm))
+            self.perm[p], self.perm[q] = self.perm[q], self.perm[p]
+        return seg
+
+
+def read_records_once(input_record_filenames, options, ref_file=None, keep_examples=False):
+    '''
+        顺序读取一遍源记录 (GZIP 只能顺序解压, 随机读取每次都从文件头解压), 返回 (labels, examples):
+        labels [n] 每条记录的标签, 记录序号即为引用;
+        ref_file: 同时把源记录不压缩写入 ref_file, 供训练时按序号随机读取;
+        keep_examples: 保留每条记录的 (input_ids, seqlen), 用于拷贝打包
+    '''
+    dataset_reader = Loader.IterableDataset(input_record_filenames, options=options).parse_from_numpy_writer()
+    writer = NumpyWriter(ref_file, options=RECORD.TFRecordOptions(compression_type=RECORD.TFRecordCompressionType.NONE)) \
+        if ref_file is not None else None
+    labels, examples = [], []
+    for d in tqdm(dataset_reader, desc='load records'):
+        labels.append(int(np.squeeze(d['labels'])))
+        if writer is not None:
+            writer.write(d)
+        if keep_examples:
+            seqlen = int(np.squeeze(d['seqlen']))
+            examples.append((np.asarray(d['input_ids'][:seqlen]), seqlen))
+    if writer is not None:
+        writer.close()
+    return np.asarray(labels, dtype=np.int64), examples
 
-    np.random.shuffle(all_keys)
-    while len(all_keys):
-        current_labels = np.random.choice(all_keys, replace=False, size=min(40,len(all_keys)))
-        pos_label, neg_labels = current_labels[0],current_labels[1:]
 
-        examples = all_example[pos_label]
-        idx_list: list
-        idx_list_negs: list
-        idx_list = all_example_num[pos_label]
-
-        if len(idx_list) == 0:
-            continue
+#从分类数据构造正负样本池
+def gen_pos_neg_records(labels: np.ndarray, num_labels=40, num_per_label=10, min_pos=2, min_neg=5,
+                        neg_keep_prob=0.3, seed=None):
+    '''
+        labels: [n] 每条记录的标签, 返回 [(pos_ids, neg_ids)], 元素为记录序号
+        每次随机取 num_labels 个标签, 第一个为正样本标签, 其余为负样本标签, 每个标签取 num_per_label 条;
+        正样本取走后不再使用, 负样本以 neg_keep_prob 的概率留在池中
+    '''
+    rng = np.random.RandomState(seed)
+    order = np.argsort(labels, kind='stable')
+    uniq, starts = np.unique(labels[order], return_index=True)
+    pools = {int(l): _LabelPool(ids, rng) for l, ids in zip(uniq, np.split(order, starts[1:]))}
 
-        one_sample_pos, one_sample_neg = [], []
-        idx = np.random.choice(idx_list, replace=False,size=min(10, len(idx_list)))
-        for value in idx:
-            idx_list.remove(value)
-            one_sample_pos.append(examples[value])
+    all_example_new = []
+    all_keys = list(pools.keys())
+    while len(all_keys):
+        current_labels = rng.choice(all_keys, replace=False, size=min(num_labels, len(all_keys)))
+        pos_label, neg_labels = int(current_labels[0]), current_labels[1:]
 
+        pos_ids = pools[pos_label].take(num_per_label)
         #去除空标签数据
-        if len(idx_list) == 0:
+        if len(pools[pos_label]) == 0:
             all_keys.remove(pos_label)
 
-
-        if len(one_sample_pos) < 2:
+        if len(pos_ids) < min_pos:
             continue
 
-
-        neg_labels = list(set(copy.deepcopy(neg_labels)))
+        neg_ids = []
         for key in neg_labels:
-            examples_negs = all_example[key]
-            idx_list_negs = all_example_num[key]
-            if len(idx_list_negs) == 0:
-                # 去除空标签数据
-                all_keys.remove(key)
-                continue
-            ids = np.random.choice(idx_list_negs,replace=False, size=min(10,len(idx_list_negs)))
-            for value in ids:
-                if random.random() < 0.7:
-                    idx_list_negs.remove(value)
-                one_sample_neg.append(examples_negs[value])
-
-            if len(idx_list_negs) == 0:
+            key = int(key)
+            if len(pools[key]):
+                neg_ids.append(pools[key].take(num_per_label, keep_prob=neg_keep_prob))
+            if len(pools[key]) == 0:
                 # 去除空标签数据
                 all_keys.remove(key)
 
-        if len(one_sample_neg) < 5:
+        neg_ids = np.concatenate(neg_ids) if neg_ids else np.zeros((0,), dtype=np.int64)
+        if len(neg_ids) < min_neg:
             continue
 
-        all_example_new.append((one_sample_pos, one_sample_neg))
+        all_example_new.append((pos_ids, neg_ids))
 
         if len(all_example_new) % 10000 == 0:
             print('current num',len(all_example_new))
 
-
     return all_example_new
 
-def make_pos_neg_records(input_record_filenames, output_file, compression_type='GZIP'):
+def make_pos_neg_records(input_record_filenames, output_file, compression_type='GZIP', with_reference=True):
+    '''
+        with_reference: 输出只存储正负样本在源记录中的序号 (pos_ids, neg_ids), 源记录不压缩拷贝到 {output_file}.sources.record
+                        (训练时按序号随机读取, 压缩文件随机读取代价与文件大小成正比), 来源写入 {output_file}.sources.json;
+                        False 时拷贝样本数据, 打包为 input_ids_pos / input_ids_neg, seqlen_pos / seqlen_neg 与 labels_pos / labels_neg
+        两种方式都只顺序读取一遍源记录
+    '''
     print('make_pos_neg_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
-    dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True).parse_from_numpy_writer()
-    data_size = len(dataset_reader)
-    all_example = {}
-
-    for i in tqdm(range(data_size), desc='load records'):
-        serialized = dataset_reader[i]
-        labels = serialized['labels']
-        labels = np.squeeze(labels).tolist()
-        if labels not in all_example:
-            all_example[labels] = []
-        all_example[labels].append(serialized)
-
-
-    if hasattr(dataset_reader,'close'):
-        dataset_reader.close()
-    else:
-        dataset_reader.reset()
-
-    print(all_example.keys())
-    all_example_new = gen_pos_neg_records(all_example)
+    ref_file = output_file + '.sources.record' if with_reference else None
+    labels, examples = read_records_once(input_record_filenames, options, ref_file=ref_file,
+                                         keep_examples=not with_reference)
+    print('labels', np.unique(labels).tolist())
+    all_example_new = gen_pos_neg_records(labels)
     print('all_example_new',len(all_example_new))
     writer = NumpyWriter(output_file, options=options)
     shuffle_idx = list(range(len(all_example_new)))
@@ -103,33 +131,39 @@ def make_pos_neg_records(input_record_filenames, output_file, compression_type='
     num_train = 0
     total_n = 0
     for i in tqdm(shuffle_idx, desc='shuffle record',total=len(shuffle_idx)):
-        example = all_example_new[i]
+        pos, neg = all_example_new[i]
         num_train += 1
-        example_new = {}
-        pos,neg = example
         total_n += len(pos) + len(neg)
+        example_new = {}
+        if with_reference:
+            example_new['pos_ids'] = np.asarray(pos, dtype=np.int64)
+            example_new['neg_ids'] = np.asarray(neg, dtype=np.int64)
+            writer.write(example_new)
+            continue
 
-        example_new['pos_len'] = np.asarray(len(pos),dtype=np.int32)
-        example_new['neg_len'] = np.asarray(len(neg), dtype=np.int32)
-        d: dict
-        for idx,d in enumerate(pos):
-            example_new['input_ids_pos{}'.format(idx)]= d['input_ids']
-            example_new['attention_mask_pos{}'.format(idx)] = d['attention_mask']
-            example_new['labels_pos{}'.format(idx)] = d['labels']
-            example_new['seqlen_pos{}'.format(idx)] = d['seqlen']
-
-        for idx, d in enumerate(neg):
-            example_new['input_ids_neg{}'.format(idx)] = d['input_ids']
-            example_new['attention_mask_neg{}'.format(idx)] = d['attention_mask']
-            example_new['labels_neg{}'.format(idx)] = d['labels']
-            example_new['seqlen_neg{}'.format(idx)] = d['seqlen']
+        # 打包存储: [n_pos, L] / [n_neg, L] 与长度, L 为组内最大长度, attention_mask 由长度生成
+        group = [examples[int(j)] for j in np.concatenate([pos, neg])]
+        seqlens = np.asarray([seqlen for _, seqlen in group], dtype=np.int32)
+        input_ids = np.zeros((len(group), int(seqlens.max())), dtype=np.int64)
+        for idx, (ids, seqlen) in enumerate(group):
+            input_ids[idx, :seqlen] = ids
+        example_new['input_ids_pos'] = input_ids[:len(pos)]
+        example_new['input_ids_neg'] = input_ids[len(pos):]
+        example_new['seqlen_pos'] = seqlens[:len(pos)]
+        example_new['seqlen_neg'] = seqlens[len(pos):]
+        # 类别, 跨进程共享负样本时屏蔽同类
+        example_new['labels_pos'] = labels[pos].astype(np.int32)
+        example_new['labels_neg'] = labels[neg].astype(np.int32)
 
         writer.write(example_new)
     writer.close()
+
+    if with_reference:
+        write_ref_sources(output_file, ref_file)
     print('num train record',num_train,'total record',total_n)
 
 
 if __name__ == '__main__':
     example_files = './output/dataset_0-train.record'
     output_train_file = os.path.join('./output/train_pos_neg.record')
-    make_pos_neg_records(input_record_filenames=example_files,output_file=output_train_file, )
\ No newline at end of file
+    make_pos_neg_records(input_record_filenames=example_files,output_file=output_train_file, )
@@ -5,12 +5,88 @@
 import json
 import os
 import random
+import shutil
+import tempfile
 
 from tqdm import tqdm
 from fastdatasets.record import load_dataset as Loader,gfile,RECORD,DataType,WriterObject,FeatureWriter
 
 
-def shuffle_records(record_filenames,out_dir,out_record_num,compression_type='GZIP'):
+def _scatter(record_filenames,tmp_dir,num_buckets,rng,read_options,tmp_options,desc='scatter records'):
+    '''
+        流式读取记录, 按随机键写入 num_buckets 个临时桶文件, 返回 [(桶文件, 记录数)]
+    '''
+    bucket_files = [os.path.join(tmp_dir, 'bucket_{}.record'.format(i)) for i in range(num_buckets)]
+    writers = [WriterObject(f, options=tmp_options) for f in bucket_files]
+    counts = [0] * num_buckets
+    dataset_reader = Loader.IterableDataset(record_filenames, options=read_options)
+    for serialized in tqdm(dataset_reader,desc=desc):
+        k = rng.randrange(num_buckets)
+        writers[k].write(serialized)
+        counts[k] += 1
+    dataset_reader.close()
+    for writer in writers:
+        writer.close()
+    return list(zip(bucket_files, counts))
+
+
+def _shuffle_bucket(bucket_file,count,tmp_options,buffer_size,num_buckets,rng,emit,depth=0,max_depth=8):
+    # 桶内记录数超过 buffer_size 时 (数据倾斜或桶数过少) 继续分桶, 保证峰值内存有界
+    if count > buffer_size:
+        if depth >= max_depth:
+            raise ValueError('bucket still has {} records after {} rescatters, increase buffer_size or num_buckets'.format(count, depth))
+        sub_dir = tempfile.mkdtemp(dir=os.path.dirname(bucket_file))
+        buckets = _scatter([bucket_file], sub_dir, num_buckets, rng, tmp_options, tmp_options, desc='rescatter bucket')
+        os.remove(bucket_file)
+        for sub_file, sub_count in buckets:
+            _shuffle_bucket(sub_file, sub_count, tmp_options, buffer_size, num_buckets, rng, emit, depth + 1, max_depth)
+        shutil.rmtree(sub_dir, ignore_errors=True)
+        return
+    dataset_reader = Loader.IterableDataset(bucket_file, options=tmp_options)
+    examples = [serialized for serialized in dataset_reader]
+    dataset_reader.close()
+    os.remove(bucket_file)
+    rng.shuffle(examples)
+    for example in examples:
+        emit(example)
+
+
+def shuffle_records_external(record_filenames,out_dir,out_record_num,compression_type='GZIP',
+                             buffer_size=1000000,num_buckets=64,tmp_dir=None,seed=None,max_depth=8):
+    '''
+        外部内存打乱, 不把全部记录读入内存:
+        1. 流式读取一遍, 每条记录按随机键写入 num_buckets 个临时桶
+        2. 逐个桶读入内存打乱后依次写出, 输出文件轮流写入
+        峰值内存约为 buffer_size 条记录, 桶大于 buffer_size 时再分桶;
+        num_buckets 建议取 记录数 / buffer_size 以上, 临时桶不压缩, 需要约等于数据集大小的磁盘空间;
+        再分桶最多 max_depth 层
+    '''
+    assert num_buckets >= 2, 'num_buckets must be >= 2'
+    print('shuffle_records external...')
+    options = RECORD.TFRecordOptions(compression_type=compression_type)
+    tmp_options = RECORD.TFRecordOptions(compression_type=RECORD.TFRecordCompressionType.NONE)
+    rng = random.Random(seed)
+    tmp_dir = tempfile.mkdtemp(prefix='shuffle_', dir=tmp_dir or out_dir)
+    try:
+        buckets = _scatter(record_filenames, tmp_dir, num_buckets, rng, options, tmp_options)
+        writers = [WriterObject(os.path.join(out_dir, 'record_gzip_shuffle_{}.record'.format(i)), options=options) for i in range(out_record_num)]
+        num = [0]
+        def emit(example):
+            writers[num[0] % out_record_num].write(example)
+            num[0] += 1
+
+        for bucket_file, count in tqdm(buckets,desc='shuffle buckets'):
+            _shuffle_bucket(bucket_file, count, tmp_options, buffer_size, num_buckets, rng, emit, max_depth=max_depth)
+        for writer in writers:
+            writer.close()
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def shuffle_records(record_filenames,out_dir,out_record_num,compression_type='GZIP',external=False,**kwargs):
+    # external=True 时使用外部内存打乱, 参数见 shuffle_records_external
+    if external:
+        return shuffle_records_external(record_filenames,out_dir,out_record_num,compression_type=compression_type,**kwargs)
     print('shuffle_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
     dataset_reader = Loader.RandomDataset(record_filenames, options=options, with_share_memory=True)
@@ -34,4 +110,6 @@ def shuffle_records(record_filenames,out_dir,out_record_num,compression_type='GZ
 if __name__ == '__main__':
     src_records = ['/tmp/train.record']
     dst_dir = '/tmp/'
-    shuffle_records(record_filenames=src_records, out_dir=dst_dir, out_record_num=1)
\ No newline at end of file
+    shuffle_records(record_filenames=src_records, out_dir=dst_dir, out_record_num=1)
+    # 大数据集: 外部内存打乱
+    # shuffle_records(record_filenames=src_records, out_dir=dst_dir, out_record_num=8, external=True, buffer_size=2000000, num_buckets=128)
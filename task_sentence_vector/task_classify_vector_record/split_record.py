@@ -3,50 +3,40 @@
 # @FileName: split_record.py
 
 import os
-import random
+import sys
 
-import numpy as np
 from fastdatasets.record import load_dataset as Loader, gfile, RECORD, WriterObject
 from tfrecords import TFRecordOptions
-from tqdm import tqdm
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.record_index import split_records_stream, split_records_index
 
 #拆分数据集
-def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP'):
+def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP',
+                  eval_every=15, shuffle_buffer_size=100000, index_dir=None):
+    '''
+        顺序读取一遍, 原始序列化记录直接拷贝到输出文件, 不再全部读入内存
+        shuffle_buffer_size: 有界缓冲区局部打乱, 0 时保持原顺序 (纯 IO); 完全打乱用 shuffle_record.shuffle_records(external=True)
+        index_dir: 不为 None 时只生成子集索引文件, 不拷贝数据, 见 common.record_index.load_subset_dataset
+    '''
+    if index_dir is not None:
+        print('split_records index...')
+        _, _, num_train, num_eval = split_records_index(input_record_filenames, index_dir, eval_every=eval_every,
+                                                        compression_type=compression_type)
+        print('num_train', num_train, 'num_eval', num_eval)
+        return
+
     print('split_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
-    dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True)
-
-    all_example = []
-    for i in tqdm(range(len(dataset_reader)), desc='load records'):
-        serialized = dataset_reader[i]
-        all_example.append(serialized)
-    dataset_reader.close()
-
-    # #小样本
-    # all_example = all_example[:10000]
-    data_size = len(all_example)
-    shuffle_idx = list(range(data_size))
-    random.shuffle(shuffle_idx)
+    dataset_reader = Loader.IterableDataset(input_record_filenames, options=options)
 
     writer_train = WriterObject(output_train_file, options=TFRecordOptions(compression_type='GZIP'))
     writer_eval = WriterObject(output_eval_file,options=TFRecordOptions(compression_type='GZIP'))
 
+    num_train, num_eval = split_records_stream(dataset_reader, writer_train, writer_eval, eval_every,
+                                               shuffle_buffer_size=shuffle_buffer_size)
 
-    num_train = 0
-    num_eval = 0
-    for i in tqdm(shuffle_idx, desc='shuffle record'):
-        example = all_example[i]
-
-        if (i + 1) % 15 == 0:
-            num_eval += 1
-            writer = writer_eval
-        else:
-            num_train += 1
-            writer = writer_train
-
-        writer.write(example)
-
-
+    dataset_reader.close()
     writer_train.close()
     writer_eval.close()
 
@@ -68,4 +58,7 @@ if __name__ == '__main__':
 
     split_records(input_record_filenames=src_files,
                   output_train_file=output_train_file,
-                  output_eval_file=output_eval_file)
\ No newline at end of file
+                  output_eval_file=output_eval_file)
+
+    # 只生成索引, 训练时 load_subset_dataset(src_files, os.path.join(dst_dir, 'train'))
+    # split_records(input_record_filenames=src_files, output_train_file=None, output_eval_file=None, index_dir=dst_dir)
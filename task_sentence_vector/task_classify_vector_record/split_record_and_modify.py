@@ -3,53 +3,42 @@
 # @FileName: split_record.py
 
 import os
-import random
+import sys
 
 import numpy as np
-from fastdatasets.record import load_dataset as Loader, gfile, RECORD, NumpyWriter
-from tqdm import tqdm
+from fastdatasets.record import load_dataset as Loader, gfile, RECORD, NumpyWriter, WriterObject
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.record_index import split_records_stream
 
 #拆分数据集
-def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP'):
+def split_records(input_record_filenames, output_train_file, output_eval_file, compression_type='GZIP',
+                  eval_every=8, modify_fn=None, shuffle_buffer_size=0):
+    '''
+        顺序读取一遍拆分, 第 (i + 1) % eval_every == 0 条进入评估集
+        modify_fn(example, count) -> example: 需要修改样本时解析后重新写入, count 为写入该输出的序号 (从 1 开始),
+        为 None 时原始序列化记录直接拷贝, 不解析
+        shuffle_buffer_size: 大于 1 时有界缓冲区局部打乱, 默认保持原顺序
+    '''
     print('split_records record...')
     options = RECORD.TFRecordOptions(compression_type=compression_type)
-    dataset_reader = Loader.RandomDataset(input_record_filenames, options=options, with_share_memory=True).parse_from_numpy_writer()
-    data_size = len(dataset_reader)
-    all_example = []
-    for i in tqdm(range(data_size), desc='load records'):
-        serialized = dataset_reader[i]
-        all_example.append(serialized)
+    dataset_reader = Loader.IterableDataset(input_record_filenames, options=options)
+    if modify_fn is None:
+        writer_train = WriterObject(output_train_file,options=options)
+        writer_eval = WriterObject(output_eval_file,options=options)
+    else:
+        dataset_reader = dataset_reader.parse_from_numpy_writer()
+        writer_train = NumpyWriter(output_train_file,options=options)
+        writer_eval = NumpyWriter(output_eval_file,options=options)
+
+    num_train, num_eval = split_records_stream(dataset_reader, writer_train, writer_eval, eval_every,
+                                               shuffle_buffer_size=shuffle_buffer_size, modify_fn=modify_fn)
 
     if hasattr(dataset_reader,'close'):
         dataset_reader.close()
     else:
         dataset_reader.reset()
 
-    shuffle_idx = list(range(data_size))
-    random.shuffle(shuffle_idx)
-
-    writer_train = NumpyWriter(output_train_file,options=options)
-    writer_eval = NumpyWriter(output_eval_file,options=options)
-
-
-    num_train = 0
-    num_eval = 0
-    for i in tqdm(shuffle_idx, desc='shuffle record'):
-        example = all_example[i]
-
-        if (i + 1) % 8 == 0:
-            num_eval += 1
-            count = num_eval
-            writer = writer_eval
-        else:
-            num_train += 1
-            count = num_train
-            writer = writer_train
-        # 添加键值，测试
-        # example['id'] = np.asarray(count - 1,dtype=np.int32)
-
-        writer.write(example)
-
     writer_train.close()
     writer_eval.close()
     print('num_train',num_train,'num_eval',num_eval)
@@ -65,6 +54,11 @@ if __name__ == '__main__':
 
     output_eval_file = os.path.join('/home/tk/train/make_big_data/output','eval.record')
 
+    # 添加键值，测试
+    # def modify_fn(example, count):
+    #     example['id'] = np.asarray(count - 1,dtype=np.int32)
+    #     return example
+
     split_records(input_record_filenames=example_files,
                   output_train_file=output_train_file,
-                  output_eval_file=output_eval_file)
\ No newline at end of file
+                  output_eval_file=output_eval_file)
@@ -2,6 +2,7 @@
 import copy
 import logging
 import os.path
+import sys
 import typing
 
 import numpy as np
@@ -25,6 +26,11 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.record_index import load_ref_sources
+from common.grad_cache import chunked_encode
+from common.contrastive import info_nce_with_gathered_negatives
+
 # model_base_dir = '/data/torch/bert-base-chinese'
 model_base_dir = '/data/nlp/pre_models/torch/bert/bert-base-chinese'
 
@@ -65,6 +71,9 @@ train_info_args = {
 
 
 class NN_DataHelper(DataHelper):
+    # 引用格式 (pos_ids / neg_ids) 训练记录对应的源数据集, 见 convert_train_pos_neg_for_infonce.py
+    ref_dataset = None
+
     # 切分词
     def on_data_process(self, data: typing.Any, user_data: tuple):
         tokenizer: BertTokenizer
@@ -132,64 +141,64 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def train_collate_fn(batch):
-        state = np.random.get_state()
-        np.random.set_state(state)
-
-
-        o = {}
-        neg_len_list = [4]
-        for i, b in enumerate(batch):
-            neg_len_list.append(b['neg_len'])
-
-        max_neg_len = np.min(neg_len_list)
+        '''
+            训练组为打包格式 input_ids_pos [n_pos, L] / input_ids_neg [n_neg, L] 与 seqlen_pos / seqlen_neg,
+            或引用格式 pos_ids / neg_ids (只读取选中的源记录); attention_mask 由长度生成,
+            labels_pos [bs] / labels_neg [bs, n_neg] 为候选的类别
+        '''
+        # 每组 2 个正样本, 负样本数取 batch 内最小值且不超过 4
+        n_neg = int(min([4] + [np.size(b['neg_ids'] if 'neg_ids' in b else b['seqlen_neg']) for b in batch]))
+        lengths = np.zeros((len(batch), 2 + n_neg), dtype=np.int64)
+        # 候选的类别, 跨进程共享负样本时屏蔽同类, 旧格式记录没有类别时为 None
+        classes = np.zeros((len(batch), 2 + n_neg), dtype=np.int64)
+        rows = []
         for i, b in enumerate(batch):
-            b = copy.copy(b)
-            b_new = {}
-            b.pop('id',None)
-            pos_len = np.squeeze(b.pop('pos_len'))
-            neg_len = np.squeeze(b.pop('neg_len'))
-
-            pos = np.random.choice(list(range(pos_len)), replace=False, size=2)
-            neg = np.random.choice(list(range(neg_len)), replace=False, size=max_neg_len)
-
-            seqlens = []
-            b_new['input_ids'] = []
-            b_new['attention_mask'] = []
-            for kid in pos:
-                b_new['input_ids'].append(b['input_ids_pos{}'.format(kid)])
-                b_new['attention_mask'].append(b['attention_mask_pos{}'.format(kid)])
-                seqlens.append(b['seqlen_pos{}'.format(kid)])
-
-            b_new['input_ids'] = np.stack(b_new['input_ids'], axis=0)
-            b_new['attention_mask'] = np.stack(b_new['attention_mask'], axis=0)
-
-
-            b_new['input_ids2'] = []
-            b_new['attention_mask2'] = []
-            for kid in neg:
-                b_new['input_ids2'].append(b['input_ids_neg{}'.format(kid)])
-                b_new['attention_mask2'].append(b['attention_mask_neg{}'.format(kid)])
-                seqlens.append(b['seqlen_neg{}'.format(kid)])
-
-            b_new['input_ids2'] = np.stack(b_new['input_ids2'],axis=0)
-            b_new['attention_mask2'] = np.stack(b_new['attention_mask2'], axis=0)
-            b_new['seqlen'] = np.asarray(np.max(seqlens),dtype=np.int32)
-            if i == 0:
-                for k in b_new:
-                    o[k] = [torch.tensor(b_new[k])]
+            if 'pos_ids' in b:
+                if NN_DataHelper.ref_dataset is None:
+                    raise ValueError('train records contain pos_ids / neg_ids but no <train_file>.sources.json was found, '
+                                     'see convert_train_pos_neg_for_infonce.py')
+                pos_ids, neg_ids = np.reshape(b['pos_ids'], -1), np.reshape(b['neg_ids'], -1)
+                pos = np.random.choice(len(pos_ids), replace=False, size=2)
+                neg = np.random.choice(len(neg_ids), replace=False, size=n_neg)
+                examples = [NN_DataHelper.ref_dataset[int(j)] for j in np.concatenate([pos_ids[pos], neg_ids[neg]])]
+                lengths[i] = [int(np.squeeze(d['seqlen'])) for d in examples]
+                if classes is not None:
+                    classes[i] = [int(np.squeeze(d['labels'])) for d in examples]
+                row = np.zeros((len(examples), lengths[i].max()), dtype=np.int64)
+                for j, d in enumerate(examples):
+                    row[j, :lengths[i, j]] = d['input_ids'][:lengths[i, j]]
             else:
-                for k in b_new:
-                    o[k].append(torch.tensor(b_new[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:,:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:,:, :max_len]
-
-        o['input_ids2'] = o['input_ids2'][:,:, :max_len]
-        o['attention_mask2'] = o['attention_mask2'][:,:, :max_len]
-        o['labels'] = torch.zeros(len(o['input_ids']),dtype=torch.bool)
+                seqlen_pos, seqlen_neg = np.reshape(b['seqlen_pos'], -1), np.reshape(b['seqlen_neg'], -1)
+                pos = np.random.choice(len(seqlen_pos), replace=False, size=2)
+                neg = np.random.choice(len(seqlen_neg), replace=False, size=n_neg)
+                lengths[i, :2] = seqlen_pos[pos]
+                lengths[i, 2:] = seqlen_neg[neg]
+                if classes is not None and 'labels_neg' in b:
+                    classes[i, :2] = np.reshape(b['labels_pos'], -1)[pos]
+                    classes[i, 2:] = np.reshape(b['labels_neg'], -1)[neg]
+                else:
+                    classes = None
+                row = np.concatenate([b['input_ids_pos'][pos], b['input_ids_neg'][neg]], axis=0)
+            rows.append(row)
+
+        max_len = int(lengths.max())
+        input_ids = np.zeros((len(batch), 2 + n_neg, max_len), dtype=np.int64)
+        for i, row in enumerate(rows):
+            w = min(max_len, row.shape[1])
+            input_ids[i, :, :w] = row[:, :w]
+
+        input_ids = torch.from_numpy(input_ids)
+        attention_mask = (torch.arange(max_len).view(1, 1, -1) < torch.from_numpy(lengths).unsqueeze(-1)).long()
+        o = {
+            'input_ids': input_ids[:, :2],
+            'attention_mask': attention_mask[:, :2],
+            'input_ids2': input_ids[:, 2:],
+            'attention_mask2': attention_mask[:, 2:],
+            'labels': torch.zeros(len(batch), dtype=torch.bool),
+        }
+        if classes is not None:
+            o['labels_pos'] = torch.from_numpy(classes[:, 0])
+            o['labels_neg'] = torch.from_numpy(classes[:, 2:])
         return o
     
 
@@ -269,7 +278,13 @@ def evaluate_sample(a_vecs,b_vecs,labels):
 
 class MyTransformer(TransformerModel, pytorch_lightning.LightningModule, with_pl=True):
     def __init__(self,*args, **kwargs):
+        encode_chunk_size = kwargs.pop('encode_chunk_size', None)
+        gather_negatives = kwargs.pop('gather_negatives', False)
         super(MyTransformer, self).__init__(*args, **kwargs)
+        # 训练时编码的分块大小, None 为整批一次编码; 分块时显存与 batch 大小解耦, 可增大 train_batch_size 扩大负样本池
+        self.encode_chunk_size = encode_chunk_size
+        # 多卡时汇总所有进程的向量, 负样本数随卡数增加, 见 common.contrastive
+        self.gather_negatives = gather_negatives
         self.feat_head = nn.Linear(config.hidden_size, 512, bias=False)
         self.loss_fn = InfoNCE(negative_mode='paired',reduction='sum')
 
@@ -283,31 +298,29 @@ class MyTransformer(TransformerModel, pytorch_lightning.LightningModule, with_pl
         logits = self.feat_head(outputs[0][:, 0, :])
         return logits
 
+    def encode(self, input_ids, attention_mask):
+        # encode_chunk_size 时梯度缓存方式分块编码, 见 common.grad_cache.chunked_encode
+        return chunked_encode(self.forward_hidden, {'input_ids': input_ids, 'attention_mask': attention_mask},
+                              self.encode_chunk_size)
+
     def compute_loss(self, *args,**batch) -> tuple:
         labels: torch.Tensor = batch.pop('labels',None)
         if labels is not None:
             if self.model.training:
-                input_ids = batch['input_ids']
-                attention_mask = batch['attention_mask']
-                n = input_ids.size(1)
-                pos,neg = [],[]
-                for i in range(n):
-                    inputs = {}
-                    inputs['input_ids'] = input_ids[:,i]
-                    inputs['attention_mask'] = attention_mask[:, i]
-                    pos.append(self.forward_hidden(**inputs))
-                input_ids = batch['input_ids2']
-                attention_mask = batch['attention_mask2']
-                n = input_ids.size(1)
-                for i in range(n):
-                    inputs = {}
-                    inputs['input_ids'] = input_ids[:, i]
-                    inputs['attention_mask'] = attention_mask[:, i]
-                    neg.append(self.forward_hidden(**inputs))
-
-                neg_key = torch.stack(neg,dim=1)
-                query,pos_key = pos
-                loss = self.loss_fn(query,pos_key,neg_key)
+                # query, 正样本, 负样本展平为 [bs * (2 + n_neg), L] 一次编码
+                input_ids = torch.cat([batch['input_ids'], batch['input_ids2']], dim=1)
+                attention_mask = torch.cat([batch['attention_mask'], batch['attention_mask2']], dim=1)
+                bs, n, seq_len = input_ids.size()
+                logits = self.encode(input_ids.view(bs * n, seq_len), attention_mask.view(bs * n, seq_len))
+                logits = logits.view(bs, n, -1)
+                query, pos_key, neg_key = logits[:, 0], logits[:, 1], logits[:, 2:]
+                labels_pos, labels_neg = batch.pop('labels_pos', None), batch.pop('labels_neg', None)
+                if self.gather_negatives:
+                    loss = info_nce_with_gathered_negatives(query, pos_key, neg_key, labels_pos, labels_neg,
+                                                            temperature=self.loss_fn.temperature,
+                                                            reduction=self.loss_fn.reduction)
+                else:
+                    loss = self.loss_fn(query,pos_key,neg_key)
                 outputs = (loss,)
             else:
                 logits = self.forward_hidden(*args, **batch)
@@ -446,6 +459,10 @@ if __name__ == '__main__':
                                                                        shuffle=False,
                                                                        mode='test'))
 
+    if data_args.do_train:
+        # train_file 可以是单个文件或列表, 按实际使用的训练文件查找来源说明
+        train_files = [f for files in dataHelper.train_files for f in ([files] if isinstance(files, str) else files)]
+        NN_DataHelper.ref_dataset = load_ref_sources(train_files)
     train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
                                              process_index=trainer.global_rank, infinite=True,
                                              with_record_iterable_dataset=True)
@@ -454,7 +471,8 @@ if __name__ == '__main__':
                                     collate_fn=dataHelper.train_collate_fn,
                                     shuffle=False if isinstance(train_datasets, IterableDataset) else True)
 
-    model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
+    model = MyTransformer(config=config, model_args=model_args, training_args=training_args, encode_chunk_size=None,
+                          gather_negatives=False)
 
     if train_datasets is not None:
         trainer.fit(model,train_dataloaders=train_datasets)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -22,6 +24,9 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+
 train_info_args = {
     'devices':  1,
     'data_backend':'record',
@@ -165,6 +170,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self,*args,**kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args,**kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
         self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -172,14 +178,12 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         #当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         a_vecs, b_vecs, labels = [],[],[]
-        for i,batch in tqdm(enumerate(eval_datasets),total=len(eval_datasets),desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i,batch in tqdm(eval_datasets,total=len(eval_datasets),desc='evalute'):
             o = pl_module.validation_step(batch,i)
             a_logits,b_logits, b_labels = o['outputs']
             for j in range(len(b_logits)):
@@ -191,12 +195,18 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
                 b_vecs.append(logit2)
                 labels.append(label)
 
-        a_vecs = np.stack(a_vecs,axis=0)
-        b_vecs = np.stack(b_vecs,axis=0)
-        labels =  np.stack(labels,axis=0)
-        corrcoef = evaluate_sample(a_vecs, b_vecs,labels)
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        a_vecs, b_vecs, labels = gather_eval_outputs(a_vecs, b_vecs, labels)
+        f1 = None
+        if trainer.is_global_zero:
+            a_vecs = np.stack(a_vecs,axis=0)
+            b_vecs = np.stack(b_vecs,axis=0)
+            labels =  np.stack(labels,axis=0)
+            corrcoef = evaluate_sample(a_vecs, b_vecs,labels)
+
+            f1 = corrcoef
+        f1 = broadcast_eval_metric(f1)
 
-        f1 = corrcoef
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
         if f1 >= best_f1:
@@ -209,7 +219,7 @@ if __name__== '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments,DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor="loss", every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor="loss", every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+import sys
 import typing
 
 import numpy as np
@@ -23,6 +25,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from tqdm import tqdm
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.evaluate import EvalBatchCache, gather_eval_outputs, broadcast_eval_metric
+from common.grad_cache import chunked_encode
+
 train_info_args = {
     'devices':  1,
     'data_backend':'record',
@@ -146,10 +152,13 @@ def evaluate_sample(a_vecs,b_vecs,labels):
 
 class MyTransformer(TransformerModel, with_pl=True):
     def __init__(self,*args,**kwargs):
+        encode_chunk_size = kwargs.pop('encode_chunk_size', None)
         super(MyTransformer, self).__init__(*args,**kwargs)
         config = self.config
         self.feat_head = nn.Linear(config.hidden_size, 512, bias=False)
         self.loss_fn = CoSentLoss()
+        # 训练时编码的分块大小, None 为整批一次编码; 分块时显存与 batch 大小解耦
+        self.encode_chunk_size = encode_chunk_size
 
     def get_model_lr(self):
         return super(MyTransformer, self).get_model_lr() + [
@@ -157,6 +166,9 @@ class MyTransformer(TransformerModel, with_pl=True):
             (self.loss_fn, self.config.task_specific_params['learning_rate_for_task'])
         ]
 
+    def forward_hidden(self, **inputs):
+        return self.feat_head(self.model(**inputs)[0][:, 0, :])
+
     def compute_loss(self, *args,**batch) -> tuple:
         labels: torch.Tensor = batch.pop('labels',None)
         if labels is not None:
@@ -164,11 +176,11 @@ class MyTransformer(TransformerModel, with_pl=True):
                 "input_ids": batch.pop('input_ids2'),
                 "attention_mask": batch.pop('attention_mask2'),
             }
-        logits1 = self.feat_head(self.model(*args,**batch)[0][:, 0, :])
+        logits1 = chunked_encode(self.forward_hidden, batch, self.encode_chunk_size)
         if labels is not None:
             labels = labels.float()
             labels = torch.unsqueeze(labels,1)
-            logits2 = self.feat_head(self.model(**batch2)[0][:, 0, :])
+            logits2 = chunked_encode(self.forward_hidden, batch2, self.encode_chunk_size)
             #重排序
             mid_logits_state = cat_even_odd_reorder(logits1,logits2)
             labels_state = cat_even_odd_reorder(labels, labels)
@@ -186,6 +198,7 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
     def __init__(self, *args, **kwargs):
         super(MySimpleModelCheckpoint, self).__init__(*args, **kwargs)
         self.weight_file = './best.pt'
+        self.eval_cache = EvalBatchCache()
 
     def on_save_model(
             self, trainer: "pl.Trainer", pl_module: "pl.LightningModule"
@@ -193,15 +206,12 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
         pl_module: MyTransformer
 
         # 当前设备
-        device = torch.device('cuda:{}'.format(trainer.global_rank))
-        eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
-        eval_datasets = DataLoader(eval_datasets, batch_size=training_args.eval_batch_size,
-                                   collate_fn=dataHelper.collate_fn)
+        device = torch.device('cuda:{}'.format(trainer.local_rank))
+        eval_datasets = self.eval_cache.get(dataHelper, training_args.eval_batch_size, device,
+                                             rank=trainer.global_rank, world_size=trainer.world_size)
 
         a_vecs, b_vecs, labels = [], [], []
-        for i, batch in tqdm(enumerate(eval_datasets), total=len(eval_datasets), desc='evalute'):
-            for k in batch:
-                batch[k] = batch[k].to(device)
+        for i, batch in tqdm(eval_datasets, total=len(eval_datasets), desc='evalute'):
             o = pl_module.validation_step(batch, i)
             a_logits, b_logits, b_labels = o['outputs']
             for j in range(len(b_logits)):
@@ -213,13 +223,19 @@ class MySimpleModelCheckpoint(SimpleModelCheckpoint):
                 b_vecs.append(logit2)
                 labels.append(label)
 
-        a_vecs = np.stack(a_vecs, axis=0)
-        b_vecs = np.stack(b_vecs, axis=0)
-        labels = np.stack(labels, axis=0)
+        # 汇总各进程的结果, 只在 rank 0 计算指标
+        a_vecs, b_vecs, labels = gather_eval_outputs(a_vecs, b_vecs, labels)
+        f1 = None
+        if trainer.is_global_zero:
+            a_vecs = np.stack(a_vecs, axis=0)
+            b_vecs = np.stack(b_vecs, axis=0)
+            labels = np.stack(labels, axis=0)
+
 
+            corrcoef = evaluate_sample(a_vecs, b_vecs,labels)
+            f1 = corrcoef
+        f1 = broadcast_eval_metric(f1)
 
-        corrcoef = evaluate_sample(a_vecs, b_vecs,labels)
-        f1 = corrcoef
         best_f1 = self.best.get('f1',-np.inf)
         print('current', f1, 'best', best_f1)
         if f1 >= best_f1:
@@ -231,7 +247,7 @@ if __name__== '__main__':
     parser = HfArgumentParser((ModelArguments, TrainingArguments,DataArguments))
     model_args, training_args, data_args = parser.parse_dict(train_info_args)
 
-    checkpoint_callback = MySimpleModelCheckpoint(monitor="f1", every_n_epochs=1)
+    checkpoint_callback = MySimpleModelCheckpoint(rank=-1, monitor="f1", every_n_epochs=1)
     trainer = Trainer(
         callbacks=[checkpoint_callback],
         max_epochs=training_args.max_epochs,
@@ -287,7 +303,7 @@ if __name__== '__main__':
                                     shuffle=False if isinstance(train_datasets, IterableDataset) else True)
 
 
-    model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
+    model = MyTransformer(config=config, model_args=model_args, training_args=training_args, encode_chunk_size=None)
 
     if train_datasets is not None:
         trainer.fit(model, train_dataloaders=train_datasets)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
+import os
 import random
+import sys
 import typing
 
 import numpy as np
@@ -16,6 +18,11 @@ from torch import nn
 from torch.utils.data import DataLoader, IterableDataset
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.collate import collate_with_seqlen
+from common.grad_cache import chunked_encode
+from common.contrastive import all_gather_with_grad, get_world_size
+
 train_info_args = {
     'devices':  1,
     'data_backend': 'memory_raw',
@@ -94,46 +101,40 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        return o
+        return collate_with_seqlen(batch)
 
 
 class MyTransformer(TransformerModel, with_pl=True):
     def __init__(self, *args, **kwargs):
+        encode_chunk_size = kwargs.pop('encode_chunk_size', None)
+        gather_negatives = kwargs.pop('gather_negatives', False)
         super(MyTransformer, self).__init__(*args, **kwargs)
         config = self.config
         self.sim_head = nn.Linear(config.hidden_size, 512, bias=False)
+        # 训练时编码的分块大小, None 为整批一次编码; 分块时显存与 batch 大小解耦, 可增大 train_batch_size 扩大负样本池
+        self.encode_chunk_size = encode_chunk_size
+        # 多卡时汇总所有进程的向量, 负样本数随卡数增加, 见 common.contrastive
+        self.gather_negatives = gather_negatives
 
     def get_model_lr(self):
         return super(MyTransformer, self).get_model_lr() + [
             (self.sim_head, self.config.task_specific_params['learning_rate_for_task'])
         ]
 
-
+    def forward_hidden(self, **inputs):
+        return self.sim_head(self.model(**inputs)[1])
 
     def compute_loss(self, *args,**batch) -> tuple:
         if self.training:
-            batch = {k: torch.repeat_interleave(v, 2, dim=1) for k, v in batch.items()}
-        outputs = self.model(*args,**batch)
-        simcse_logits = self.sim_head(outputs[1])
+            # 每个句子重复两次 (相邻两行), 两次 dropout 互为正样本
+            batch = {k: torch.repeat_interleave(v, 2, dim=0) for k, v in batch.items()}
+        simcse_logits = chunked_encode(self.forward_hidden, batch, self.encode_chunk_size)
         if self.training:
-            loss = compute_simcse_loss(simcse_logits)
+            if self.gather_negatives:
+                # 各进程的句子对相邻排列, 拼接后仍然成对
+                loss = compute_simcse_loss(all_gather_with_grad(simcse_logits)) * get_world_size()
+            else:
+                loss = compute_simcse_loss(simcse_logits)
             outputs = (loss, simcse_logits)
         else:
             outputs = (simcse_logits,)
@@ -205,7 +206,8 @@ if __name__ == '__main__':
                                     collate_fn=dataHelper.collate_fn,
                                     shuffle=False if isinstance(train_datasets, IterableDataset) else True)
 
-    model = MyTransformer(config=config, model_args=model_args, training_args=training_args)
+    model = MyTransformer(config=config, model_args=model_args, training_args=training_args, encode_chunk_size=None,
+                          gather_negatives=False)
 
     if train_datasets is not None:
         trainer.fit(model, train_dataloaders=train_datasets)
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
+import os
 import random
+import sys
 import typing
 
 import torch
@@ -17,6 +19,9 @@ from torch.nn import CrossEntropyLoss
 from torch.utils.data import DataLoader, IterableDataset
 from transformers import HfArgumentParser, BertTokenizer
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from common.collate import collate_with_seqlen
+
 train_info_args = {
     'devices':'1',
     'data_backend': 'memory_raw',
@@ -99,26 +104,7 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['attention_mask'] = o['attention_mask'][:, :max_len]
-        if 'token_type_ids' in o:
-            o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len]
-        o['weight'] = o['weight'][:, :max_len]
-        return o
+        return collate_with_seqlen(batch, seq_keys=('labels', 'weight'))
 
 class MyTransformer(TransformerModel, with_pl=True):
     def __init__(self,*args,**kwargs):
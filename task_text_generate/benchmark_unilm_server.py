@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# 连续批处理生成服务压测: 泊松到达的合成请求, 统计 tokens/s 与延迟 p50/p99
+import asyncio
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch import nn
+from transformers import BertConfig, BertModel
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.unilm_generate import UnilmDecoder
+from common.unilm_server import UnilmServer
+
+bench_args = {
+    # bert config.json, 为 None 时使用小模型; 吞吐与权重无关, 均为随机初始化
+    # 教师与学生延迟对比: 分别使用教师 config.json 与 export_student 导出的目录
+    'config_name': None,
+    'num_requests': 64,
+    # 每秒到达的请求数
+    'request_rate': 16.0,
+    'min_source_length': 32,
+    'max_source_length': 256,
+    'min_new_tokens': 8,
+    'max_new_tokens': 32,
+    # 缓存池槽位数, 槽位数为 1 即逐个请求生成
+    'num_slots': [1, 16],
+    'num_threads': 4,
+    'device': 'cpu',
+    'seed': 42,
+}
+
+
+def build_decoder(config_name, device):
+    if config_name is not None:
+        config = BertConfig.from_pretrained(config_name)
+    else:
+        config = BertConfig(vocab_size=21128, hidden_size=256, num_hidden_layers=4, num_attention_heads=4,
+                            intermediate_size=1024, max_position_embeddings=512)
+    bert = BertModel(config, add_pooling_layer=False).to(device).eval()
+    lm_head = nn.Linear(config.hidden_size, config.vocab_size, bias=False).to(device).eval()
+    return UnilmDecoder(bert, lm_head), config
+
+
+def make_load(args, vocab_size):
+    rng = np.random.RandomState(args['seed'])
+    arrivals = np.cumsum(rng.exponential(1.0 / args['request_rate'], size=args['num_requests']))
+    requests = []
+    for t in arrivals:
+        n = rng.randint(args['min_source_length'], args['max_source_length'] + 1)
+        input_ids = [101] + rng.randint(672, vocab_size, size=n - 2).tolist() + [102]
+        max_new_tokens = int(rng.randint(args['min_new_tokens'], args['max_new_tokens'] + 1))
+        requests.append((float(t), input_ids, max_new_tokens))
+    return requests
+
+
+async def run_load(server: UnilmServer, requests):
+    await server.start()
+    start = time.perf_counter()
+    stats = []
+
+    async def client(arrival, input_ids, max_new_tokens):
+        await asyncio.sleep(max(0.0, start + arrival - time.perf_counter()))
+        t0 = time.perf_counter()
+        first, num = None, 0
+        async for _ in server.stream(input_ids, max_new_tokens=max_new_tokens):
+            if first is None:
+                first = time.perf_counter() - t0
+            num += 1
+        stats.append((first, time.perf_counter() - t0, num))
+
+    await asyncio.gather(*[client(*r) for r in requests])
+    elapsed = time.perf_counter() - start
+    await server.stop()
+    return elapsed, stats
+
+
+def main(args):
+    torch.manual_seed(args['seed'])
+    torch.set_num_threads(args['num_threads'])
+    decoder, config = build_decoder(args['config_name'], args['device'])
+    requests = make_load(args, config.vocab_size)
+    print('requests {} rate {}/s source {}-{} new tokens {}-{}'.format(
+        args['num_requests'], args['request_rate'], args['min_source_length'], args['max_source_length'],
+        args['min_new_tokens'], args['max_new_tokens']))
+    for num_slots in args['num_slots']:
+        # eos 设为 -1, 生成长度由 max_new_tokens 控制
+        server = UnilmServer(decoder, num_slots=num_slots, max_source_length=args['max_source_length'],
+                             max_target_length=args['max_new_tokens'], eos_token_id=-1)
+        elapsed, stats = asyncio.run(run_load(server, requests))
+        ttft = np.asarray([s[0] for s in stats]) * 1000
+        latency = np.asarray([s[1] for s in stats]) * 1000
+        tokens = sum(s[2] for s in stats)
+        print('num_slots {:>3d}: {:.1f} tokens/s, latency p50 {:.0f}ms p99 {:.0f}ms, '
+              'first token p50 {:.0f}ms p99 {:.0f}ms'.format(
+            num_slots, tokens / elapsed, np.percentile(latency, 50), np.percentile(latency, 99),
+            np.percentile(ttft, 50), np.percentile(ttft, 99)))
+
+
+if __name__ == '__main__':
+    main(bench_args)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# 标题生成服务: 加载 task_autotitle_unilm.py 训练的 best.pt, 连续批处理生成, HTTP 接口见 common/unilm_server.serve_http
+# curl -N -X POST http://127.0.0.1:8080/generate -d '{"text": "...", "max_new_tokens": 30}'
+import asyncio
+import logging
+import os
+import sys
+
+import torch
+from deep_training.data_helper import ModelArguments, DataArguments, TrainingArguments
+from deep_training.data_helper import load_tokenizer_and_config_with_args
+from transformers import HfArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.unilm_generate import UnilmDecoder
+from common.unilm_server import UnilmServer, serve_http
+from task_autotitle_unilm import train_info_args, NN_DataHelper, MyTransformer
+
+serve_args = {
+    'ckpt_path': './best.pt',
+    'host': '0.0.0.0',
+    'port': 8080,
+    # 键值缓存池槽位数, 即同时生成的最大请求数
+    'num_slots': 16,
+    # 等待队列长度, 0 不限制
+    'max_queue_size': 0,
+    'device': 'cuda' if torch.cuda.is_available() else 'cpu',
+}
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO)
+    parser = HfArgumentParser((ModelArguments, TrainingArguments, DataArguments))
+    model_args, training_args, data_args = parser.parse_dict(train_info_args)
+
+    dataHelper = NN_DataHelper(data_args.data_backend)
+    tokenizer, config, label2id, id2label = load_tokenizer_and_config_with_args(dataHelper, model_args, training_args,
+                                                                                data_args)
+    model = MyTransformer.load_from_checkpoint(args['ckpt_path'], config=config, model_args=model_args,
+                                               training_args=training_args)
+    model = model.to(args['device']).eval()
+
+    decoder = UnilmDecoder(model.model.model, model.model.lm_head)
+    # 与 generate 一致: 源文本最长 max_seq_length - max_target_length
+    server = UnilmServer(decoder, num_slots=args['num_slots'],
+                         max_source_length=data_args.max_seq_length - data_args.max_target_length,
+                         max_target_length=data_args.max_target_length,
+                         eos_token_id=tokenizer.sep_token_id,
+                         max_queue_size=args['max_queue_size'])
+    logging.info('serving {} on {}:{}'.format(args['ckpt_path'], args['host'], args['port']))
+    asyncio.run(serve_http(server, tokenizer, host=args['host'], port=args['port']))
+
+
+if __name__ == '__main__':
+    main(serve_args)
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import json
+import os
+import sys
 import typing
 
 import numpy as np
@@ -16,6 +18,10 @@ from torch.utils.data import DataLoader, IterableDataset
 from transformers import BertTokenizer
 from transformers import HfArgumentParser
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen
+from common.unilm_generate import UnilmDecoder, unilm_generate
+
 train_info_args = {
     'devices':  1,
     'data_backend': 'memory_raw',
@@ -75,27 +81,28 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len]
-        return o
+        return collate_with_seqlen(batch, seq_keys=('labels',))
 
 class MyTransformer(TransformerModelForUnilm, with_pl=True):
     def __init__(self, *args,**kwargs):
         super(MyTransformer, self).__init__(*args,**kwargs)
 
+    @torch.no_grad()
+    def generate(self,tokenizer: BertTokenizer,texts: typing.List[str],max_seq_length=512,max_target_length=50,
+                 num_beams=1,do_sample=False,**kwargs):
+        '''
+            增量解码 (键值缓存) 生成标题, num_beams > 1 束搜索, do_sample 使用 top_k / top_p 采样
+        '''
+        self.eval()
+        decoder = UnilmDecoder(self.model.model, self.model.lm_head)
+        o = tokenizer(texts, max_length=max_seq_length - max_target_length, truncation=True, padding=True,
+                      return_tensors='pt')
+        device = self.model.lm_head.weight.device
+        outputs = unilm_generate(decoder, o['input_ids'].to(device), o['attention_mask'].sum(-1),
+                                 max_target_length=max_target_length, eos_token_id=tokenizer.sep_token_id,
+                                 num_beams=num_beams, do_sample=do_sample, **kwargs)
+        return [tokenizer.decode(ids, skip_special_tokens=True).replace(' ', '') for ids in outputs]
+
 
 
 
@@ -176,4 +183,10 @@ if __name__== '__main__':
             trainer.validate(model, dataloaders=eval_datasets,ckpt_path='./best.pt')
 
         if test_datasets is not None:
-            trainer.test(model, dataloaders=test_datasets,ckpt_path='best.pt')
\ No newline at end of file
+            trainer.test(model, dataloaders=test_datasets,ckpt_path='best.pt')
+
+        model = MyTransformer.load_from_checkpoint('./best.pt', config=config, model_args=model_args,
+                                                   training_args=training_args)
+        texts = ['针对最近我国赴美留学人数发生过几次暴跌的现象，美国驻华大使馆发布了一份报告。']
+        print(model.generate(tokenizer, texts, max_seq_length=data_args.max_seq_length,
+                             max_target_length=data_args.max_target_length, num_beams=4))
\ No newline at end of file
@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
+import copy
 import json
+import os
+import sys
 import typing
 
 import numpy as np
@@ -17,6 +20,12 @@ from torch.utils.data import DataLoader, IterableDataset
 from transformers import BertTokenizer
 from transformers import HfArgumentParser
 from deep_training.utils.trainer import SimpleModelCheckpoint
+from fastdatasets.torch_dataset import Dataset as torch_Dataset
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.collate import collate_with_seqlen
+from common.distill_cache import collate_with_teacher_topk, topk_kl_loss, write_teacher_topk_records, \
+    load_teacher_topk_dataset
 
 train_info_args = {
     'devices':  1,
@@ -77,22 +86,10 @@ class NN_DataHelper(DataHelper):
 
     @staticmethod
     def collate_fn(batch):
-        o = {}
-        for i, b in enumerate(batch):
-            if i == 0:
-                for k in b:
-                    o[k] = [torch.tensor(b[k])]
-            else:
-                for k in b:
-                    o[k].append(torch.tensor(b[k]))
-        for k in o:
-            o[k] = torch.stack(o[k])
-
-        max_len = torch.max(o.pop('seqlen'))
-        o['input_ids'] = o['input_ids'][:, :max_len]
-        o['token_type_ids'] = o['token_type_ids'][:, :max_len]
-        o['labels'] = o['labels'][:, :max_len]
-        return o
+        # 带教师 top-k logits 的记录 (write_teacher_topk_records)
+        if 'teacher_topk_ids' in batch[0]:
+            return collate_with_teacher_topk(batch, seq_keys=('labels',))
+        return collate_with_seqlen(batch, seq_keys=('labels',))
 
 #教师12层
 class TeacherTransformer(TransformerModelForUnilm, with_pl=True):
@@ -120,15 +117,23 @@ class TeacherTransformer(TransformerModelForUnilm, with_pl=True):
             outputs = (lm_logits,)
         return outputs
 
-#学生6层
+#学生6层, 只构建并加载检查点的前 num_layers 层
 class StudentTransformer(TransformerModelForUnilm, with_pl=True):
-    def __init__(self,teacher_model, *args,**kwargs):
+    def __init__(self,teacher_model=None, *args,**kwargs):
+        num_layers = kwargs.pop('num_layers', 6)
+        # 截断配置的副本 (config 与教师共用), from_pretrained 时多余的层不会被构建
+        config = copy.deepcopy(kwargs['config'])
+        config.num_hidden_layers = num_layers
+        kwargs['config'] = config
         super(StudentTransformer, self).__init__(*args,**kwargs)
         self.teacher_model = teacher_model
         self.kl_loss = KLDivLoss('sum')
 
     def compute_loss(self, *args,**batch) -> tuple:
         labels = batch.pop('labels', None)
+        teacher_topk_ids = batch.pop('teacher_topk_ids', None)
+        teacher_topk_values = batch.pop('teacher_topk_values', None)
+        teacher_mask = batch.pop('teacher_mask', None)
 
         inputs = {k:v for k,v in batch.items()}
         inputs['attention_mask'] = unilm_mask(inputs['token_type_ids'])
@@ -136,10 +141,8 @@ class StudentTransformer(TransformerModelForUnilm, with_pl=True):
             inputs.pop('token_type_ids')
 
 
-        outputs = self.model(*args,**inputs,output_hidden_states=True)
-        # hidden_states = outputs[0]
-        #第六层
-        hidden_states = outputs[2][-6]
+        outputs = self.model(*args,**inputs)
+        hidden_states = outputs[0]
         lm_logits = self.model.lm_head(hidden_states)
         if labels is not None:
             labels = labels.long()
@@ -147,8 +150,16 @@ class StudentTransformer(TransformerModelForUnilm, with_pl=True):
             shift_labels = labels[..., 1:].contiguous()
             loss_student = self.model.loss_fct(shift_logits.view(-1, shift_logits.size(-1)), shift_labels.view(-1))
 
-            teacher_logits = self.teacher_model.compute_loss(*args,**batch)[0]
-            kl_Loss = self.kl_loss([teacher_logits,lm_logits])
+            if teacher_topk_ids is not None:
+                # 离线缓存的教师 top-k logits, 只在 top-k 支撑集上计算 kl
+                kl_Loss = topk_kl_loss(lm_logits, teacher_topk_ids, teacher_topk_values, teacher_mask)
+            else:
+                # 在线运行冻结的教师
+                if self.teacher_model is None:
+                    raise ValueError('student needs teacher top-k fields (load_teacher_topk_dataset) or a teacher_model')
+                with torch.no_grad():
+                    teacher_logits = self.teacher_model.compute_loss(*args,**batch)[0]
+                kl_Loss = self.kl_loss([teacher_logits,lm_logits])
             loss_dict = {
                 'loss_student': loss_student,
                 'kl_Loss': kl_Loss,
@@ -160,6 +171,15 @@ class StudentTransformer(TransformerModelForUnilm, with_pl=True):
             outputs = (lm_logits,)
         return outputs
 
+    def export_student(self, output_dir):
+        '''
+            单独保存截断后的学生模型: bert 以 save_pretrained 保存 (num_hidden_layers 为学生层数), lm_head 保存为 lm_head.bin,
+            可由 BertModel.from_pretrained 加载后配合 common.unilm_generate 推理
+        '''
+        os.makedirs(output_dir, exist_ok=True)
+        self.model.model.save_pretrained(output_dir)
+        torch.save(self.model.lm_head.state_dict(), os.path.join(output_dir, 'lm_head.bin'))
+
 
 
 
@@ -215,33 +235,58 @@ if __name__== '__main__':
                                                                        shuffle=False,
                                                                        mode='test'))
 
-    train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
-                                             process_index=trainer.global_rank, infinite=True,
-                                             with_record_iterable_dataset=True)
-    
-    if train_datasets is not None:
-        train_datasets = DataLoader(train_datasets, batch_size=training_args.train_batch_size,
-                                    collate_fn=dataHelper.collate_fn,
-                                    shuffle=False if isinstance(train_datasets, IterableDataset) else True)
-
-
     #是否首先训练模型
     is_training_teacher = True
+    #教师 top-k logits 离线缓存, 学生训练读取缓存, 不再逐步运行教师; False 时每步在线运行冻结的教师
+    use_teacher_cache = True
+    teacher_topk = 32
+    teacher_topk_file = os.path.join(data_args.output_dir, 'teacher_topk.record')
 
-
+    train_datasets = None
     if is_training_teacher:#训练teacher 模型
         model = TeacherTransformer(config=config, model_args=model_args, training_args=training_args)
     else: #蒸馏模型
-        teacher_weight = './best_teacher.pt'
-        #加载训练好的权重
-        teacher_model = TeacherTransformer.load_from_checkpoint(teacher_weight,config=config, model_args=model_args,
-                                                                training_args=training_args)
-        for k, p in teacher_model.named_parameters():
-            p.requires_grad = False
-        model = StudentTransformer(teacher_model,config=config,model_args=model_args,training_args=training_args)
+        teacher_model = None
+        if data_args.do_train and (not use_teacher_cache or not os.path.exists(teacher_topk_file)):
+            teacher_weight = './best_teacher.pt'
+            #加载训练好的权重
+            teacher_model = TeacherTransformer.load_from_checkpoint(teacher_weight,config=config, model_args=model_args,
+                                                                    training_args=training_args)
+            for k, p in teacher_model.named_parameters():
+                p.requires_grad = False
+            teacher_model.eval()
+        if use_teacher_cache:
+            if teacher_model is not None:
+                device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+                teacher_model.to(device)
+                write_teacher_topk_records(lambda batch: teacher_model.compute_loss(**{k: v for k, v in batch.items() if k != 'labels'})[0],
+                                           dataHelper.load_dataset(dataHelper.train_files),
+                                           teacher_topk_file,
+                                           collate_fn=dataHelper.collate_fn,
+                                           topk=teacher_topk,
+                                           batch_size=training_args.train_batch_size,
+                                           device=device)
+                teacher_model = None
+                torch.cuda.empty_cache()
+            if data_args.do_train:
+                train_datasets = torch_Dataset(load_teacher_topk_dataset(teacher_topk_file))
+        model = StudentTransformer(teacher_model,config=config,model_args=model_args,training_args=training_args,num_layers=6)
+
+    if train_datasets is None:
+        train_datasets = dataHelper.load_dataset(dataHelper.train_files, shuffle=True, num_processes=trainer.world_size,
+                                                 process_index=trainer.global_rank, infinite=True,
+                                                 with_record_iterable_dataset=True)
+
+    if train_datasets is not None:
+        train_datasets = DataLoader(train_datasets, batch_size=training_args.train_batch_size,
+                                    collate_fn=dataHelper.collate_fn,
+                                    shuffle=False if isinstance(train_datasets, IterableDataset) else True)
 
     if train_datasets is not None:
         trainer.fit(model, train_dataloaders=train_datasets)
+        # 多卡时只在 rank 0 导出, 避免各进程同时写同一目录
+        if not is_training_teacher and trainer.global_rank == 0:
+            model.export_student(os.path.join(data_args.output_dir, 'student'))
     else:
         eval_datasets = dataHelper.load_dataset(dataHelper.eval_files)
         test_datasets = dataHelper.load_dataset(dataHelper.test_files)